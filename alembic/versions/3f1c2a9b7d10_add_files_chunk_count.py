@@ -0,0 +1,27 @@
+"""add files.chunk_count
+
+Revision ID: 3f1c2a9b7d10
+Revises: 
+Create Date: 2026-10-17 10:12:31.402158
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c2a9b7d10'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('files', sa.Column('chunk_count', sa.Integer(),
+                  nullable=True, comment='検索インデックスのチャンク数'))
+
+
+def downgrade() -> None:
+    op.drop_column('files', 'chunk_count')
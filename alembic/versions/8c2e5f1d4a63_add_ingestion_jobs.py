@@ -0,0 +1,55 @@
+"""add ingestion_jobs
+
+Revision ID: 8c2e5f1d4a63
+Revises: 3f1c2a9b7d10
+Create Date: 2026-10-17 23:05:47.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c2e5f1d4a63'
+down_revision: Union[str, None] = '3f1c2a9b7d10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'ingestion_jobs',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False, comment='ジョブID'),
+        sa.Column('file_id', sa.String(length=255), nullable=True, comment='ファイルID'),
+        sa.Column('category', sa.String(length=20), nullable=True, comment='カテゴリ'),
+        sa.Column('status', sa.String(length=20), nullable=True,
+                  comment='ジョブ状態 queued:待機中 running:処理中 succeeded:成功 failed:失敗'),
+        sa.Column('stage', sa.String(length=20), nullable=True,
+                  comment='処理段階 parsing:解析中 indexing:インデックス登録中'),
+        sa.Column('progress', sa.SmallInteger(), nullable=True, comment='進捗(%)'),
+        sa.Column('attempts', sa.SmallInteger(), nullable=True, comment='試行回数'),
+        sa.Column('last_error', sa.String(length=1000), nullable=True, comment='最後のエラー'),
+        sa.Column('run_after', sa.DateTime(), nullable=True, comment='実行可能日時'),
+        sa.Column('locked_by', sa.String(length=255), nullable=True, comment='処理中のワーカー'),
+        sa.Column('locked_at', sa.DateTime(), nullable=True, comment='処理開始日時'),
+        sa.Column('created_by', sa.String(length=225), nullable=False, comment='作成者'),
+        sa.Column('updated_by', sa.String(length=225), nullable=False, comment='更新者'),
+        sa.Column('created_at', sa.DateTime(), nullable=False, comment='作成日付'),
+        sa.Column('updated_at', sa.DateTime(), nullable=False, comment='更新日付'),
+        sa.PrimaryKeyConstraint('id'),
+        comment='取り込みジョブ',
+    )
+    op.create_index(op.f('ix_ingestion_jobs_id'), 'ingestion_jobs', ['id'], unique=True)
+    op.create_index(op.f('ix_ingestion_jobs_file_id'), 'ingestion_jobs', ['file_id'], unique=False)
+    op.create_index(op.f('ix_ingestion_jobs_status'), 'ingestion_jobs', ['status'], unique=False)
+    op.create_index(op.f('ix_ingestion_jobs_run_after'), 'ingestion_jobs', ['run_after'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_ingestion_jobs_run_after'), table_name='ingestion_jobs')
+    op.drop_index(op.f('ix_ingestion_jobs_status'), table_name='ingestion_jobs')
+    op.drop_index(op.f('ix_ingestion_jobs_file_id'), table_name='ingestion_jobs')
+    op.drop_index(op.f('ix_ingestion_jobs_id'), table_name='ingestion_jobs')
+    op.drop_table('ingestion_jobs')
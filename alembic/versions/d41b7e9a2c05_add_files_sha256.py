@@ -0,0 +1,27 @@
+"""add files.sha256
+
+Revision ID: d41b7e9a2c05
+Revises: 8c2e5f1d4a63
+Create Date: 2026-10-17 23:48:12.530961
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41b7e9a2c05'
+down_revision: Union[str, None] = '8c2e5f1d4a63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('files', sa.Column('sha256', sa.String(length=64),
+                  nullable=True, comment='ファイル内容のSHA-256'))
+
+
+def downgrade() -> None:
+    op.drop_column('files', 'sha256')
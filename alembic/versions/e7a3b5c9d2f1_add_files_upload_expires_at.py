@@ -0,0 +1,27 @@
+"""add files.upload_expires_at
+
+Revision ID: e7a3b5c9d2f1
+Revises: d41b7e9a2c05
+Create Date: 2026-10-18 10:12:40.218734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a3b5c9d2f1'
+down_revision: Union[str, None] = 'd41b7e9a2c05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('files', sa.Column('upload_expires_at', sa.DateTime(),
+                  nullable=True, comment='直接アップロードの有効期限'))
+
+
+def downgrade() -> None:
+    op.drop_column('files', 'upload_expires_at')
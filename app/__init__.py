@@ -3,8 +3,9 @@ from quart import Quart
 from quart_cors import cors
 from app.api import config_blueprint
 from app.config import config
-from app.extensions import init_clients
+from app.extensions import init_clients, init_async_clients, close_clients
 from app.database import init_db, create_tables
+from app.services.registry import init_services
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -28,6 +29,14 @@ def create_app():
     async def startup():
         await init_db(app)
         await create_tables(app)
+        await init_async_clients(app)
+        await init_services(app)
+        app.config['ingestion_queue'].start()
+
+    @app.after_serving
+    async def shutdown():
+        await app.config['ingestion_queue'].stop()
+        await close_clients(app)
 
     # blueprint setting
     config_blueprint(app)
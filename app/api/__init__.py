@@ -4,6 +4,7 @@ from app.api.chat import chat_bp
 from app.api.answer import answer_bp
 from app.api.file import file_bp
 from app.api.recruitment import recruitment_bp
+from app.api.metrics import metrics_bp
 
 
 def config_blueprint(app: Quart):
@@ -13,4 +14,5 @@ def config_blueprint(app: Quart):
     api_bp.register_blueprint(answer_bp, url_prefix="/answers")
     api_bp.register_blueprint(file_bp, url_prefix="/files")
     api_bp.register_blueprint(recruitment_bp, url_prefix="/recruitments")
+    api_bp.register_blueprint(metrics_bp, url_prefix="/metrics")
     app.register_blueprint(api_bp)
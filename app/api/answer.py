@@ -1,10 +1,15 @@
+import json
 from datetime import datetime
-from quart import (Blueprint, jsonify, request, g)
+from quart import (Blueprint, Response, jsonify, request, g, stream_with_context)
 from azure.search.documents.models import VectorQuery
 from app.services.file_service import FileService
 from app.services.chat_service import ChatService
 from app.services.openai_service import OpenaiService
-from app.services.searchai_service import SearchManager
+from app.services.searchai_service import RESULT_FIELDS, SearchManager
+from app.services.context_assembler import ContextAssembler
+from app.services.prompt_assembler import Source
+from app.services.registry import (get_openai_service, get_file_service, get_search_manager,
+                                   get_context_assembler, get_token_ledger)
 from app.utils.decorators import token_required
 from app.utils.log_utils import get_logger
 from app.utils.commom import extract_urls
@@ -14,6 +19,68 @@ answer_bp = Blueprint("answer", __name__)
 logger = get_logger("aoai_backend")
 
 
+async def retrieveSources(openai_service: OpenaiService, file_service: FileService,
+                          search_manager: SearchManager, context_assembler: ContextAssembler,
+                          chat_id, chat_type, history, turn_tokens, email) -> list[Source]:
+    if chat_type == "gpt":
+        # check URL exist
+        urls = extract_urls(history[-1]["user"])
+        if (len(urls) > 0):
+            # save URL content
+            for url in urls:
+                file_url = await file_service.saveUrl(url, chat_id, email)
+                file_sections = await file_service.parse_url(file_url)
+                if file_sections:
+                    # save file to Azure Search AI
+                    await search_manager.update_content(file_sections)
+                await file_service.updateChunkCount(file_url.id, len(file_sections))
+
+        # check file exist
+        files = await file_service.getFilesByChatId(chat_id)
+        if len(files) == 0:
+            return []
+        file_ids = [file.id for file in files]
+    elif chat_type == "retrieve":
+        files = []
+        file_ids = []
+    else:
+        return []
+
+    # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+    query_text = await openai_service.generateSearchQuery(history, turn_tokens)
+    # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+    filter = search_manager.build_filter(chat_type, file_ids)
+    query_vector = await openai_service.compute_text_embedding(query_text)
+    vectors: list[VectorQuery] = []
+    vectors.append(query_vector)
+    # candidates for MMR only when their vectors can be had without embedding: returned with
+    # the hits, or from the chunk store; otherwise just the sources
+    returns_embeddings = search_manager.returns_embeddings(files)
+    select = RESULT_FIELDS + ["embedding"] if returns_embeddings else None
+    top = context_assembler.candidates if returns_embeddings or search_manager.stores_chunk_embeddings \
+        else context_assembler.max_sources
+    results = await search_manager.search(top, query_text, filter, vectors, select=select, files=files)
+    # STEP 2-2: keep diverse hits and merge overlapping chunks, the prompt fits them in its token budget
+    return await context_assembler.assemble(results, query_vector.vector, True)
+
+
+async def updateChatAfterAnswer(openai_service: OpenaiService, chat_id, history, answer, email) -> dict:
+    # チャット更新
+    chat_update_data = {
+        "updated_by": email,
+        "updated_at": datetime.now()}
+    if len(history) == 1:
+        chat_update_data["name"] = await openai_service.generateChatName(history, answer)
+    return await ChatService.updateChat(chat_id, chat_update_data)
+
+
+def server_sent_event(data: dict, event: str = None) -> str:
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+
 @answer_bp.route("", methods=["POST"])
 @token_required
 async def makeAnswer():
@@ -22,70 +89,63 @@ async def makeAnswer():
     request_json = await request.get_json()
     email = g.get('email')
     try:
-        chat_service = ChatService()
-        openai_service = OpenaiService()
-        file_service = FileService()
-        search_manager = SearchManager()
+        openai_service = get_openai_service()
+        file_service = get_file_service()
+        search_manager = get_search_manager()
+        context_assembler = get_context_assembler()
         chat_id = request_json["chat_id"]
         chat_type = request_json["chat_type"]
         history = request_json["history"]
-        answer: str = ""
-        if chat_type == "gpt":
-            # check URL exist
-            urls = extract_urls(history[-1]["user"])
-            if (len(urls) > 0):
-                # save URL content
-                for url in urls:
-                    file_url = await file_service.saveUrl(url, chat_id, email)
-                    file_sections = await file_service.parse_url(file_url)
-                    if file_sections:
-                        # save file to Azure Search AI
-                        await search_manager.update_content(file_sections)
+        # token counts of the past turns, so that only the new question is tokenized
+        turn_tokens = await get_token_ledger().turn_tokens(chat_id, chat_type, history)
+        # STEP 1-2: search sources
+        sources = await retrieveSources(openai_service, file_service, search_manager, context_assembler,
+                                        chat_id, chat_type, history, turn_tokens, email)
+        if request_json.get("stream"):
+            return streamAnswer(openai_service, chat_id, chat_type, history, sources, turn_tokens, email)
 
-            # check file exist
-            files = await file_service.getFilesByChatId(chat_id)
-            if len(files) > 0:
-                # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-                query_text = await openai_service.generateSearchQuery(history)
-                # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-                file_ids = [file.id for file in files]
-                filter = search_manager.build_filter(chat_type, file_ids)
-                vectors: list[VectorQuery] = []
-                vectors.append(await openai_service.compute_text_embedding(query_text))
-                results = await search_manager.search(3, query_text, filter, vectors)
-                sources_content = search_manager.get_sources_content(
-                    results, True)
-                sources = "\n".join(sources_content)
-                # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-                answer = await openai_service.answerQueation(
-                    chat_id, chat_type, history, sources)
-            else:
-                answer = await openai_service.answerQueation(chat_id, chat_type, history, "")
-        elif chat_type == "retrieve":
-            # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-            query_text = await openai_service.generateSearchQuery(history)
-            # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-            filter = search_manager.build_filter(chat_type, [])
-            vectors: list[VectorQuery] = []
-            vectors.append(await openai_service.compute_text_embedding(query_text))
-            results = await search_manager.search(3, query_text, filter, vectors)
-            sources_content = search_manager.get_sources_content(
-                results, True)
-            sources = "\n".join(sources_content)
+        answer: str = ""
+        if chat_type in ("gpt", "retrieve"):
             # STEP 3: Generate a contextual and content specific answer using the search results and chat history
             answer = await openai_service.answerQueation(
-                chat_id, chat_type, history, sources)
-
-        # チャット更新
-        chat_update_data = {
-            "updated_by": email,
-            "updated_at": datetime.now()}
-        if len(history) == 1:
-            chat_update_data["name"] = await openai_service.generateChatName(history, answer)
-        await chat_service.updateChat(chat_id, chat_update_data)
+                chat_id, chat_type, history, sources, turn_tokens)
+        await updateChatAfterAnswer(openai_service, chat_id, history, answer, email)
         return jsonify({"answer": answer}), 200
     except ServiceException as se:
         return jsonify({"message": str(se)}), se.status_code
     except Exception as e:
         logger.exception(f"回答を生成する際に、エラーが発生します。{e}")
         return jsonify({"message": "回答を生成する際に、エラーが発生します"}), 500
+
+
+def streamAnswer(openai_service: OpenaiService, chat_id, chat_type, history, sources, turn_tokens,
+                 email) -> Response:
+    """
+    Streams the answer as server-sent events:
+    `data: {"delta": ...}` for each token chunk, then `event: done` with the full
+    answer and the updated chat, or `event: error` with a message.
+    """
+    @stream_with_context
+    async def event_stream():
+        try:
+            answer_parts: list[str] = []
+            # STEP 3: Generate a contextual and content specific answer using the search results and chat history
+            async for delta in openai_service.answerQueationStream(chat_id, chat_type, history, sources,
+                                                                   turn_tokens):
+                answer_parts.append(delta)
+                yield server_sent_event({"delta": delta})
+            answer = "".join(answer_parts)
+            chat = await updateChatAfterAnswer(openai_service, chat_id, history, answer, email)
+            yield server_sent_event({"answer": answer, "chat": chat}, event="done")
+        except ServiceException as se:
+            yield server_sent_event({"message": str(se)}, event="error")
+        except Exception as e:
+            logger.exception(f"回答を生成する際に、エラーが発生します。{e}")
+            yield server_sent_event({"message": "回答を生成する際に、エラーが発生します"}, event="error")
+
+    response = Response(event_stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # disable proxy buffering so that events reach the browser immediately
+    response.headers["X-Accel-Buffering"] = "no"
+    response.timeout = None
+    return response
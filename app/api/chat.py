@@ -1,7 +1,6 @@
-from quart import (Blueprint, jsonify, request, g)
+from quart import (Blueprint, current_app, jsonify, request, g)
 from app.services.chat_service import ChatService
-from app.services.searchai_service import SearchManager
-from app.services.file_service import FileService
+from app.services.registry import get_chat_service, get_chat_deletion_service
 from app.utils.decorators import token_required
 from app.utils.log_utils import get_logger
 from app.exceptions.service_exception import ServiceException
@@ -70,20 +69,12 @@ async def updateChat(chat_id: str):
 async def deleteChat(chat_id: str):
     try:
         chat_type = request.args.get('chat_type')
-        file_service = FileService()
-        chat_service = ChatService()
-        search_manager = SearchManager()
-        files = await file_service.getFilesByChatId(chat_id)
-        if len(files) > 0:
-            for file in files:
-                # delete file in storage
-                await file_service.deleteFile(file)
-                # delete search file in searchAI
-                await search_manager.remove_content(file.id, chat_type)
-
-        # delete chat and file data in DB delete chat content data in cosmosDB
-        await chat_service.deleteChat(chat_id, chat_type)
-        return "", 200
+        # delete chat and file data in DB
+        files = await ChatService.deleteChat(chat_id)
+        # delete files in storage, sections in searchAI and chat contents in cosmosDB in the background
+        current_app.add_background_task(
+            get_chat_deletion_service().deleteChatResources, chat_id, chat_type, files)
+        return "", 202
     except ServiceException as se:
         return jsonify({"message": str(se)}), se.status_code
     except Exception as e:
@@ -95,7 +86,7 @@ async def deleteChat(chat_id: str):
 @token_required
 async def getChatContents(chat_id: str):
     try:
-        chat_service = ChatService()
+        chat_service = get_chat_service()
         chat_type = request.args.get('chat_type')
         res = await chat_service.getChatContents(chat_id, chat_type)
         return jsonify(res), 200
@@ -1,6 +1,11 @@
-from quart import (Blueprint, send_file, jsonify, request, g)
+import hmac
+from typing import List
+from quart import (Blueprint, Response, current_app, jsonify, redirect, request, g)
+from werkzeug.exceptions import RequestEntityTooLarge
+from app.services.blob_downloader import RangeNotSatisfiable, content_disposition
 from app.services.file_service import FileService
-from app.services.searchai_service import SearchManager
+from app.models import file as file_models
+from app.services.registry import get_file_service, get_search_manager, get_ingestion_queue
 from app.utils.decorators import token_required
 from app.utils.log_utils import get_logger
 from app.exceptions.service_exception import ServiceException
@@ -9,30 +14,28 @@ from app.exceptions.service_exception import ServiceException
 file_bp = Blueprint("file", __name__)
 logger = get_logger("aoai_backend")
 
+STORAGE_EVENT_ACCOUNT = "storage-event"
+
 
 @file_bp.route("", methods=["POST"])
 @token_required
 async def saveFiles():
     try:
-        request_data = await request.form
-        request_files = await request.files
         email = g.get('email')
-        chat_id = request_data["chat_id"]
-        chat_type = request_data["chat_type"]
-        category = request_data["category"]
+        boundary = request.mimetype_params.get("boundary")
+        if request.mimetype != "multipart/form-data" or not boundary:
+            return jsonify({"message": "multipart/form-data で送信してください。"}), 415
+        # save file to Mysql and Storage, streamed from the request body
+        file_service = get_file_service()
+        form, files = await file_service.saveFiles(request.body, boundary.encode("latin-1"), email)
         # ファイルが存在する時。
-        if len(request_files) > 0:
-            # save file to Mysql and Storage
-            file_service = FileService()
-            files = await file_service.saveFiles(request_files, chat_id,
-                                                 chat_type, category, email)
-            # save file to Azure Search AI
-            search_manager = SearchManager()
-            for file in files:
-                sections = await file_service.parse_file(file, category)
-                if sections:
-                    await search_manager.update_content(sections)
+        if len(files) > 0:
+            # parse and save to Azure Search AI in the background, see GET /status
+            jobs = await get_ingestion_queue().enqueue(files, form["category"], email)
+            return jsonify({"files": [file.json for file in files], "jobs": jobs}), 202
         return "", 200
+    except RequestEntityTooLarge:
+        return jsonify({"message": "ファイルサイズが上限を超えています。"}), 413
     except ServiceException as se:
         return jsonify({"message": str(se)}), se.status_code
     except Exception as e:
@@ -40,6 +43,93 @@ async def saveFiles():
         return jsonify({"message": "予想以外のエラーが発生します。"}), 500
 
 
+@file_bp.route("uploads", methods=["POST"])
+@token_required
+async def createUploads():
+    """
+    Direct upload, step 1: {"chat_id", "chat_type", "category", "files": [{"name", "size"}]}
+    gives per file an `upload_url` to PUT the content to, then POST /<file_id>/complete.
+    """
+    try:
+        email = g.get('email')
+        fields = await request.get_json(silent=True)
+        if not isinstance(fields, dict):
+            return jsonify({"message": "リクエストが正しくありません。"}), 400
+        sessions = await get_file_service().createUploadSessions(fields, email)
+        return jsonify({"files": sessions}), 201
+    except ServiceException as se:
+        return jsonify({"message": str(se)}), se.status_code
+    except Exception as e:
+        logger.exception(f"アップロードを準備する際に、エラーが発生します。: {str(e)}")
+        return jsonify({"message": "予想以外のエラーが発生します。"}), 500
+
+
+@file_bp.route("<string:file_id>/complete", methods=["POST"])
+@token_required
+async def completeUpload(file_id: str):
+    """Direct upload, step 2: the content is in storage, ingest it. Calling it again only returns the status."""
+    try:
+        email = g.get('email')
+        file = await get_file_service().completeUpload(file_id, email)
+        if file is not None:
+            jobs = await get_ingestion_queue().enqueue([file], file.category, email)
+            return jsonify({"files": [file.json], "jobs": jobs}), 202
+        return jsonify((await get_ingestion_queue().getProgress([file_id]))[0]), 200
+    except ServiceException as se:
+        return jsonify({"message": str(se)}), se.status_code
+    except Exception as e:
+        logger.exception(f"アップロードを完了する際に、エラーが発生します。: {str(e)}")
+        return jsonify({"message": "予想以外のエラーが発生します。"}), 500
+
+
+@file_bp.route("events", methods=["POST"])
+async def storageEvents():
+    """
+    Event Grid webhook of the storage account: completes direct uploads on
+    BlobCreated, for browsers that never call /complete. Authenticated with
+    `?key=` as Event Grid cannot send a user token.
+    """
+    key = current_app.config.get("STORAGE_EVENT_KEY")
+    if not key:
+        return jsonify({"message": "ストレージイベントが無効です。"}), 404
+    if not hmac.compare_digest(request.args.get("key", ""), key):
+        return jsonify({"message": "認証に失敗しました。"}), 401
+    events = await request.get_json(silent=True)
+    if isinstance(events, dict):
+        events = [events]
+    if not isinstance(events, list):
+        return jsonify({"message": "リクエストが正しくありません。"}), 400
+    container = current_app.config.get("STORAGE_CONTAINER")
+    completed: List[file_models.File] = []
+    try:
+        file_service = get_file_service()
+        for event in events:
+            event_type = event.get("eventType") or event.get("type")
+            if event_type == "Microsoft.EventGrid.SubscriptionValidationEvent":
+                return jsonify({"validationResponse": event["data"]["validationCode"]}), 200
+            if event_type != "Microsoft.Storage.BlobCreated":
+                continue
+            prefix, _, file_id = event.get("subject", "").partition("/blobs/")
+            if not file_id or not prefix.endswith(f"/containers/{container}"):
+                continue
+            try:
+                file = await file_service.completeUpload(file_id, STORAGE_EVENT_ACCOUNT)
+            except ServiceException as se:
+                # blobs uploaded through POST /files, or removed since
+                logger.info("Ignored storage event of %s: %s", file_id, str(se))
+                continue
+            if file is not None:
+                completed.append(file)
+        for category in {file.category for file in completed}:
+            await get_ingestion_queue().enqueue(
+                [file for file in completed if file.category == category], category, STORAGE_EVENT_ACCOUNT)
+        return "", 200
+    except Exception as e:
+        # Event Grid delivers the events again
+        logger.exception(f"ストレージイベントを処理する際に、エラーが発生します。: {str(e)}")
+        return jsonify({"message": "予想以外のエラーが発生します。"}), 500
+
+
 @file_bp.route("", methods=["GET"])
 @token_required
 async def getFiles():
@@ -54,18 +144,53 @@ async def getFiles():
         return jsonify({"message": "予想以外のエラーが発生します。"}), 500
 
 
+@file_bp.route("status", methods=["GET"])
+@token_required
+async def getFilesStatus():
+    """Ingestion status of the files of a chat (`chat_id`) or of the given files (`file_ids`, comma separated)."""
+    try:
+        chat_id = request.args.get("chat_id")
+        if chat_id:
+            file_ids = [file.id for file in await FileService.getFilesByChatId(chat_id)]
+        else:
+            file_ids = [file_id for file_id in request.args.get("file_ids", "").split(",") if file_id]
+        if not file_ids:
+            return jsonify([]), 200
+        return jsonify(await get_ingestion_queue().getProgress(file_ids)), 200
+    except ServiceException as se:
+        return jsonify({"message": str(se)}), se.status_code
+    except Exception as e:
+        logger.exception(f"取り込み状況を取得する際に、エラーが発生します。: {str(e)}")
+        return jsonify({"message": "予想以外のエラーが発生します。"}), 500
+
+
+@file_bp.route("<string:file_id>/status", methods=["GET"])
+@token_required
+async def getFileStatus(file_id: str):
+    try:
+        progress = await get_ingestion_queue().getProgress([file_id])
+        if not progress:
+            return jsonify({"message": "ファイルが存在しません。"}), 404
+        return jsonify(progress[0]), 200
+    except ServiceException as se:
+        return jsonify({"message": str(se)}), se.status_code
+    except Exception as e:
+        logger.exception(f"取り込み状況を取得する際に、エラーが発生します。: {str(e)}")
+        return jsonify({"message": "予想以外のエラーが発生します。"}), 500
+
+
 @file_bp.route("<string:file_id>", methods=["DELETE"])
 @token_required
 async def deleteFile(file_id: str):
     try:
-        file_service = FileService()
-        search_manager = SearchManager()
+        file_service = get_file_service()
+        search_manager = get_search_manager()
         # delete file in DB
         file = await file_service.deleteDBFile(file_id)
         # delete file in storage
         await file_service.deleteFile(file)
         # delete search file in searchAI
-        await search_manager.remove_content(file.id, file.chat_type)
+        await search_manager.remove_files([file])
 
         return "", 200
     except ServiceException as se:
@@ -78,21 +203,33 @@ async def deleteFile(file_id: str):
 @file_bp.route("<string:file_id>", methods=["GET"])
 @token_required
 async def getFile(file_id: str):
+    """
+    Streams the file, or the byte range asked with `Range` (for PDF viewers),
+    or redirects to a short-lived storage URL when redirects are enabled.
+    """
     try:
-        file_name = request.args.get('file_name')
-        file_service = FileService()
-        file_content = file_service.read_file_from_storage(file_id)
-        # Assuming the content type and filename are known or can be inferred
-        return await send_file(
-            file_content,
-            # Set appropriate MIME type based on the file type
-            mimetype='application/octet-stream',
-            as_attachment=True,  # Forces download on the frontend
-            # Sets the downloaded filename, customize if needed
-            attachment_filename=f"{file_name}"
-        )
+        file_name = request.args.get('file_name') or file_id
+        file_service = get_file_service()
+        if file_service.download_redirect or request.args.get("redirect") == "true":
+            return redirect(file_service.getDownloadUrl(file_id, file_name))
+
+        download = await file_service.openDownload(
+            file_id, request.headers.get("Range"), request.headers.get("If-Range"))
+        response = Response(download.chunks, status=206 if download.partial else 200,
+                            mimetype='application/octet-stream')
+        response.headers["Content-Length"] = str(max(download.length, 0))
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["ETag"] = download.etag
+        # Forces download on the frontend
+        response.headers["Content-Disposition"] = content_disposition(file_name)
+        if download.partial:
+            response.headers["Content-Range"] = download.content_range
+        response.timeout = None
+        return response
+    except RangeNotSatisfiable as rn:
+        return jsonify({"message": str(rn)}), rn.status_code, {"Content-Range": f"bytes */{rn.size}"}
     except ServiceException as se:
         return jsonify({"message": str(se)}), se.status_code
     except Exception as e:
-        logger.exception(f"APIチャット削除にエラーが発生します。: {e}")
+        logger.exception(f"ファイルを取得する際に、エラーが発生します。: {e}")
         return jsonify({"message": "予想以外のエラーが発生します。"}), 500
@@ -0,0 +1,11 @@
+from quart import (Blueprint, jsonify)
+from app.utils import metrics
+from app.utils.decorators import token_required
+
+metrics_bp = Blueprint("metrics", __name__)
+
+
+@metrics_bp.route("", methods=["GET"])
+@token_required
+async def getMetrics():
+    return jsonify(metrics.snapshot()), 200
@@ -20,6 +20,10 @@ class Config():
     MSAL_CLIENT_ID = os.getenv('MSAL_CLIENT_ID')
     MSAL_AUTHORITY = os.getenv('MSAL_AUTHORITY')
     MSAL_REDIRECT_PATH = os.getenv('MSAL_REDIRECT_PATH')
+    MSAL_JWKS_TTL = int(os.getenv('MSAL_JWKS_TTL', 3600))
+    MSAL_JWKS_MIN_REFRESH_INTERVAL = int(
+        os.getenv('MSAL_JWKS_MIN_REFRESH_INTERVAL', 60))
+    MSAL_CLAIMS_CACHE_SIZE = int(os.getenv('MSAL_CLAIMS_CACHE_SIZE', 1024))
 
     # Azure openAI
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
@@ -29,27 +33,114 @@ class Config():
         "gpt-4o": os.getenv("AZURE_OPENAI_GPT4O"),
         "text-embedding-ada-002": os.getenv("AZURE_OPENAI_EMBEDING")
     }
+    # quota of the embedding deployment (unset: no client-side budget)
+    AZURE_OPENAI_EMBEDDING_TPM = int(os.getenv("AZURE_OPENAI_EMBEDDING_TPM", 0)) or None
+    AZURE_OPENAI_EMBEDDING_RPM = int(os.getenv("AZURE_OPENAI_EMBEDDING_RPM", 0)) or None
+    # text-embedding-3 only: shorter vectors, must match SEARCH_VECTOR_DIMENSIONS
+    AZURE_OPENAI_EMBEDDING_DIMENSIONS = int(os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS", 0)) or None
+    # model of the embedding deployment, e.g. text-embedding-3-large (unset: the deployment name)
+    AZURE_OPENAI_EMBEDDING_MODEL = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL")
+    AZURE_OPENAI_EMBEDDING_MAX_CONCURRENCY = int(
+        os.getenv("AZURE_OPENAI_EMBEDDING_MAX_CONCURRENCY", 4))
+    # seconds a call may spend retrying (see RetryPolicy)
+    AZURE_OPENAI_EMBEDDING_RETRY_DEADLINE = int(
+        os.getenv("AZURE_OPENAI_EMBEDDING_RETRY_DEADLINE", 300))
+    AZURE_OPENAI_COMPLETION_RETRY_DEADLINE = int(
+        os.getenv("AZURE_OPENAI_COMPLETION_RETRY_DEADLINE", 60))
+    # query embedding cache (EMBEDDING_CACHE_PATH unset: memory only)
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 1024))
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+    EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", 256))
+    # embeddings of ingested chunks by content hash, a SQLite file shared by the workers
+    # (CHUNK_EMBEDDING_STORE_PATH unset: every chunk is embedded)
+    CHUNK_EMBEDDING_STORE_PATH = os.getenv("CHUNK_EMBEDDING_STORE_PATH")
+    CHUNK_EMBEDDING_STORE_MAX_MB = int(os.getenv("CHUNK_EMBEDDING_STORE_MAX_MB", 1024))
 
     # CosmosDB
     COSMOSDB_ENDPOINT = os.getenv("AZURE_COSMOSDB_URI")
     COSMOSDB_KEY = os.getenv("AZURE_COSMOSDB_KEY")
     COSMOSDB_DATABASE = os.getenv("AZURE_COSMOSDB_DATABASE")
+    COSMOSDB_MAX_CONNECTIONS = int(os.getenv("AZURE_COSMOSDB_MAX_CONNECTIONS", 100))
+    # legacy: ChatInformation only / dual: write both, read ChatInformation
+    # partitioned: ChatContents only (after script/migrate_chat_contents.py)
+    CHAT_CONTENT_STORE_MODE = os.getenv("CHAT_CONTENT_STORE_MODE", "dual")
 
     # storage
     STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
     STORAGE_CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER")
     STORAGE_KEY = os.getenv("AZURE_STORAGE_KEY")
+    # another blob endpoint than the account's, e.g. Azurite: http://127.0.0.1:10000/devstoreaccount1
+    STORAGE_ACCOUNT_URL = os.getenv("AZURE_STORAGE_ACCOUNT_URL")
+    STORAGE_MAX_CONNECTIONS = int(os.getenv("AZURE_STORAGE_MAX_CONNECTIONS", 100))
+    # uploads are streamed to storage in blocks of this size, this many at once per file
+    STORAGE_UPLOAD_BLOCK_SIZE_MB = int(os.getenv("AZURE_STORAGE_UPLOAD_BLOCK_SIZE_MB", 4))
+    STORAGE_UPLOAD_MAX_CONCURRENCY = int(os.getenv("AZURE_STORAGE_UPLOAD_MAX_CONCURRENCY", 4))
+    # downloads redirect to a read-only SAS URL valid this many seconds (or with ?redirect=true)
+    STORAGE_DOWNLOAD_REDIRECT = os.getenv("AZURE_STORAGE_DOWNLOAD_REDIRECT", "false").lower() == "true"
+    STORAGE_DOWNLOAD_SAS_TTL = int(os.getenv("AZURE_STORAGE_DOWNLOAD_SAS_TTL", 300))
+    # browsers upload straight to storage with a create-only SAS URL valid this many seconds
+    STORAGE_UPLOAD_SAS_TTL = int(os.getenv("AZURE_STORAGE_UPLOAD_SAS_TTL", 900))
+    STORAGE_UPLOAD_MAX_SIZE_MB = int(os.getenv("AZURE_STORAGE_UPLOAD_MAX_SIZE_MB", 1024))
+    # files announced in one POST /files/uploads
+    STORAGE_UPLOAD_MAX_FILES = int(os.getenv("AZURE_STORAGE_UPLOAD_MAX_FILES", 20))
+    # key of the Event Grid subscription posting BlobCreated events to /files/events (disabled if unset)
+    STORAGE_EVENT_KEY = os.getenv("AZURE_STORAGE_EVENT_KEY")
 
     # search ai
     SEARCH_SERVICE = os.getenv("AZURE_SEARCH_SERVICE")
     SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
     SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
+    # keep a retrievable copy of the vectors in indexes created from now on
+    SEARCH_EMBEDDING_STORED = os.getenv("SEARCH_EMBEDDING_STORED", "false").lower() == "true"
+    # vector profile of indexes created from now on (see script/rebuild_index.py)
+    SEARCH_VECTOR_DIMENSIONS = int(os.getenv("SEARCH_VECTOR_DIMENSIONS", 1536))
+    # none / scalar / binary
+    SEARCH_VECTOR_COMPRESSION = os.getenv("SEARCH_VECTOR_COMPRESSION", "none")
+    SEARCH_VECTOR_RESCORE = os.getenv("SEARCH_VECTOR_RESCORE", "true").lower() == "true"
+    SEARCH_VECTOR_OVERSAMPLING = float(os.getenv("SEARCH_VECTOR_OVERSAMPLING", 4))
+    # HNSW parameters of indexes created from now on (see script/tune_hnsw.py)
+    SEARCH_HNSW_M = int(os.getenv("SEARCH_HNSW_M", 4))
+    SEARCH_HNSW_EF_CONSTRUCTION = int(os.getenv("SEARCH_HNSW_EF_CONSTRUCTION", 400))
+    SEARCH_HNSW_EF_SEARCH = int(os.getenv("SEARCH_HNSW_EF_SEARCH", 500))
+    # nearest neighbors fed from the vector query into the hybrid ranking
+    SEARCH_KNN = int(os.getenv("SEARCH_KNN", 50))
+    # cached results per worker; the TTL bounds staleness across workers
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 512))
+    SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 300))
+    # chat scopes of up to this many sections are searched in process (0: never)
+    LOCAL_SEARCH_MAX_CHUNKS = int(os.getenv("LOCAL_SEARCH_MAX_CHUNKS", 200))
+    LOCAL_SEARCH_CACHE_CHUNKS = int(os.getenv("LOCAL_SEARCH_CACHE_CHUNKS", 20000))
+    # sources of the answer prompt (see ContextAssembler)
+    CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 10))
+    CONTEXT_MAX_SOURCES = int(os.getenv("CONTEXT_MAX_SOURCES", 3))
+    CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.5))
+    # token budgets of the answer prompt (see PromptAssembler), history defaults to what is left
+    PROMPT_SOURCES_TOKEN_BUDGET = int(os.getenv("PROMPT_SOURCES_TOKEN_BUDGET", 3000))
+    PROMPT_HISTORY_TOKEN_BUDGET = int(os.getenv("PROMPT_HISTORY_TOKEN_BUDGET", 0)) or None
+    TOKEN_COUNTER_CACHE_SIZE = int(os.getenv("TOKEN_COUNTER_CACHE_SIZE", 4096))
+    # chats whose past turn token counts are kept in memory (see TokenLedger)
+    TOKEN_LEDGER_SIZE = int(os.getenv("TOKEN_LEDGER_SIZE", 1024))
+
+    # background ingestion of uploaded files (see IngestionQueue), per process
+    INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", 2))
+    INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", 3))
+    INGESTION_RETRY_BACKOFF = int(os.getenv("INGESTION_RETRY_BACKOFF", 30))
+    INGESTION_POLL_INTERVAL = int(os.getenv("INGESTION_POLL_INTERVAL", 5))
+    INGESTION_JOB_TIMEOUT = int(os.getenv("INGESTION_JOB_TIMEOUT", 1800))
+    INGESTION_UPLOAD_GRACE = int(os.getenv("INGESTION_UPLOAD_GRACE", 3600))
+    # uploads kept for their ingestion job instead of downloading them again (see UploadHandoff)
+    UPLOAD_SPOOL_MAX_MEMORY_MB = int(os.getenv("UPLOAD_SPOOL_MAX_MEMORY_MB", 4))
+    UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR")
+    UPLOAD_HANDOFF_TTL = int(os.getenv("UPLOAD_HANDOFF_TTL", 3600))
 
     # Document Intelligence
     DOCUMENTINTELLIGENCE_SERVICE = os.getenv(
         "AZURE_DOCUMENTINTELLIGENCE_SERVICE")
     DOCUMENTINTELLIGENCE_KEY = os.getenv("AZURE_DOCUMENTINTELLIGENCE_KEY")
 
+    # background jobs
+    DELETION_MAX_CONCURRENCY = int(os.getenv("DELETION_MAX_CONCURRENCY", 8))
+
     # Connon
     FRONTEND_DOMAIN = os.getenv("FRONTEND_DOMAIN")
 
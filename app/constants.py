@@ -14,5 +14,21 @@ EMBEDING_MODEL = "text-embedding-ada-002"
 COMPANY_CONTAINER = "CompanyInformation"
 JOBINFO_CONTAINER = "JobInfoInformation"
 CHAT_CONTAINER = "ChatInformation"
+CHAT_CONTENT_CONTAINER = "ChatContents"
+# chat content store mode (see ChatContentRepository)
+CHAT_STORE_LEGACY = "legacy"
+CHAT_STORE_DUAL = "dual"
+CHAT_STORE_PARTITIONED = "partitioned"
 
 
+# files.status
+FILE_STATUS_UPLOADING = 0
+FILE_STATUS_SUCCESS = 1
+FILE_STATUS_FAILURE = 2
+# ingestion_jobs.status and stage (see IngestionQueue)
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_STAGE_PARSING = "parsing"
+JOB_STAGE_INDEXING = "indexing"
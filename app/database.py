@@ -24,6 +24,7 @@ async def create_tables(app: Quart):
     from app.models.file import File
     from app.models.folder import Folder
     from app.models.recruitment import Recruitment
+    from app.models.ingestionjob import IngestionJob
 
     engine: AsyncEngine = app.config.get('db_engine')
     async with engine.begin() as conn:
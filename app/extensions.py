@@ -1,10 +1,16 @@
+import aiohttp
 from quart import Quart, current_app
 from azure.cosmos import CosmosClient
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.core.pipeline.transport import AioHttpTransport
 from openai import AsyncAzureOpenAI
 from azure.storage.blob import BlobServiceClient, ContainerClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.core.credentials import AzureKeyCredential
+from app.utils.jwks import JwksKeyStore, JWKS_URL_TEMPLATE
+from app.utils.token_cache import TokenClaimsCache
 
 
 def init_clients(app: Quart):
@@ -15,6 +21,15 @@ def init_clients(app: Quart):
     app.config['storage_client'] = initialize_storage_client(app)
     app.config['searchai_client'] = initialize_searchai_client(app)
     app.config['search_index_client'] = initialize_searchai_index_client(app)
+    app.config['jwks_key_store'] = initialize_jwks_key_store(app)
+    app.config['token_claims_cache'] = TokenClaimsCache(
+        maxsize=app.config.get("MSAL_CLAIMS_CACHE_SIZE", 1024))
+
+
+async def init_async_clients(app: Quart):
+    # async clients own an aiohttp session, so they are created on the serving loop
+    app.config['async_cosmos_client'] = initialize_async_cosmos_client(app)
+    app.config['async_storage_client'] = initialize_async_storage_client(app)
 
 
 def initialize_openai_client(app: Quart) -> AsyncAzureOpenAI:
@@ -52,14 +67,43 @@ def initialize_cosmos_client(app: Quart) -> CosmosClient:
     return CosmosClient(url=cosmos_endpoint, credential=cosmos_key)
 
 
+def initialize_async_cosmos_client(app: Quart) -> AsyncCosmosClient:
+    cosmos_endpoint = app.config["COSMOSDB_ENDPOINT"]
+    if not cosmos_endpoint:
+        raise ValueError(
+            "COSMOSDB_ENDPOINT is not set in the app configuration")
+
+    cosmos_key = app.config["COSMOSDB_KEY"]
+    if not cosmos_key:
+        raise ValueError("COSMOSDB_KEY is not set in the app configuration")
+
+    # one shared connection pool for all Cosmos calls on this worker
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=app.config.get("COSMOSDB_MAX_CONNECTIONS", 100)))
+    transport = AioHttpTransport(session=session, session_owner=True)
+    return AsyncCosmosClient(url=cosmos_endpoint, credential=cosmos_key, transport=transport)
+
+
 def initialize_storage_client(app: Quart) -> BlobServiceClient:
     STORAGE_ACCOUNT = app.config.get("STORAGE_ACCOUNT")
     STORAGE_KEY = app.config.get("STORAGE_KEY")
     blob_service = BlobServiceClient(
-        account_url=f"https://{STORAGE_ACCOUNT}.blob.core.windows.net", credential=STORAGE_KEY)
+        account_url=app.config.get("STORAGE_ACCOUNT_URL") or f"https://{STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=STORAGE_KEY)
     return blob_service
 
 
+def initialize_async_storage_client(app: Quart) -> AsyncBlobServiceClient:
+    STORAGE_ACCOUNT = app.config.get("STORAGE_ACCOUNT")
+    STORAGE_KEY = app.config.get("STORAGE_KEY")
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=app.config.get("STORAGE_MAX_CONNECTIONS", 100)))
+    transport = AioHttpTransport(session=session, session_owner=True)
+    return AsyncBlobServiceClient(
+        account_url=app.config.get("STORAGE_ACCOUNT_URL") or f"https://{STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=STORAGE_KEY, transport=transport)
+
+
 def initialize_searchai_client(app: Quart) -> SearchClient:
     SEARCH_SERVICE = app.config.get("SEARCH_SERVICE")
     SEARCH_KEY = app.config.get("SEARCH_KEY")
@@ -77,6 +121,22 @@ def initialize_searchai_index_client(app: Quart) -> SearchIndexClient:
                              credential=AzureKeyCredential(SEARCH_KEY))
 
 
+def initialize_jwks_key_store(app: Quart) -> JwksKeyStore:
+    tenant_id = app.config.get("MSAL_TENANT_ID")
+    return JwksKeyStore(
+        jwks_url=JWKS_URL_TEMPLATE.format(tenant_id=tenant_id),
+        ttl=app.config.get("MSAL_JWKS_TTL", 3600),
+        min_refresh_interval=app.config.get("MSAL_JWKS_MIN_REFRESH_INTERVAL", 60))
+
+
+async def close_clients(app: Quart):
+    await app.config['jwks_key_store'].close()
+    if app.config.get('async_cosmos_client') is not None:
+        await app.config['async_cosmos_client'].close()
+    if app.config.get('async_storage_client') is not None:
+        await app.config['async_storage_client'].close()
+
+
 def get_openai_client() -> AsyncAzureOpenAI:
     client = current_app.config['openai_client']
     if client is None:
@@ -91,6 +151,13 @@ def get_cosmos_client() -> CosmosClient:
     return client
 
 
+def get_async_cosmos_client() -> AsyncCosmosClient:
+    client = current_app.config.get('async_cosmos_client')
+    if client is None:
+        raise RuntimeError('Async CosmosDB Client has not been initialized.')
+    return client
+
+
 def get_storage_client() -> BlobServiceClient:
     client = current_app.config['storage_client']
     if client is None:
@@ -98,6 +165,13 @@ def get_storage_client() -> BlobServiceClient:
     return client
 
 
+def get_async_storage_client() -> AsyncBlobServiceClient:
+    client = current_app.config.get('async_storage_client')
+    if client is None:
+        raise RuntimeError('Async Storage Client has not been initialized.')
+    return client
+
+
 def get_searchai_client() -> SearchClient:
     client = current_app.config['searchai_client']
     if client is None:
@@ -110,3 +184,17 @@ def get_searchai_index_client() -> SearchIndexClient:
     if client is None:
         raise RuntimeError('search index Client has not been initialized.')
     return client
+
+
+def get_jwks_key_store() -> JwksKeyStore:
+    store = current_app.config['jwks_key_store']
+    if store is None:
+        raise RuntimeError('JWKS key store has not been initialized.')
+    return store
+
+
+def get_token_claims_cache() -> TokenClaimsCache:
+    cache = current_app.config['token_claims_cache']
+    if cache is None:
+        raise RuntimeError('Token claims cache has not been initialized.')
+    return cache
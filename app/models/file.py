@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from json import dumps, loads
-from sqlalchemy import Column, String, Integer, SmallInteger, DECIMAL
+from sqlalchemy import Column, String, Integer, SmallInteger, DECIMAL, DateTime
 from app.models.base import MixinColumn
 from app.database import Base
 from app.utils.jsonEncoder import CustomJSONEncoder
@@ -23,6 +23,9 @@ class File(Base, MixinColumn):
         SmallInteger, comment="ファイル状態 0:アップロード中 1:アップロード成功 2:アップロード失敗")
     folder_id = Column(Integer, index=True, comment="フォルダーID")
     category = Column(String(20), comment="カテゴリ")
+    chunk_count = Column(Integer, comment="検索インデックスのチャンク数")
+    sha256 = Column(String(64), comment="ファイル内容のSHA-256")
+    upload_expires_at = Column(DateTime, comment="直接アップロードの有効期限")
 
     @property
     def json(self):
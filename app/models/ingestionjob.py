@@ -0,0 +1,33 @@
+from dataclasses import dataclass
+from json import dumps, loads
+from sqlalchemy import Column, String, Integer, SmallInteger, DateTime
+from app.models.base import MixinColumn
+from app.database import Base
+from app.utils.jsonEncoder import CustomJSONEncoder
+
+
+@dataclass
+class IngestionJob(Base, MixinColumn):
+    __tablename__ = "ingestion_jobs"
+    __table_args__ = {
+        'comment': '取り込みジョブ'
+    }
+    id = Column(Integer, unique=True, primary_key=True,
+                autoincrement=True, index=True, comment="ジョブID")
+    file_id = Column(String(255), index=True, comment="ファイルID")
+    category = Column(String(20), comment="カテゴリ")
+    status = Column(String(20), index=True,
+                    comment="ジョブ状態 queued:待機中 running:処理中 succeeded:成功 failed:失敗")
+    stage = Column(String(20), comment="処理段階 parsing:解析中 indexing:インデックス登録中")
+    progress = Column(SmallInteger, default=0, comment="進捗(%)")
+    attempts = Column(SmallInteger, default=0, comment="試行回数")
+    last_error = Column(String(1000), comment="最後のエラー")
+    run_after = Column(DateTime, index=True, comment="実行可能日時")
+    locked_by = Column(String(255), comment="処理中のワーカー")
+    locked_at = Column(DateTime, comment="処理開始日時")
+
+    @property
+    def json(self):
+        data = {k: v for k, v in self.__dict__.items()
+                       if not k.startswith('_')}
+        return loads(dumps(data, cls=CustomJSONEncoder))
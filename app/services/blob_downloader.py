@@ -0,0 +1,117 @@
+import re
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+from urllib.parse import quote
+from azure.core import MatchConditions
+from azure.storage.blob import BlobSasPermissions
+from azure.storage.blob.aio import ContainerClient
+from app.services.blob_sas import blob_sas_url
+from app.utils import metrics
+from app.exceptions.service_exception import ServiceException
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(ServiceException):
+    def __init__(self, size: int):
+        super().__init__("指定された範囲が正しくありません。", status_code=416)
+        self.size = size
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """
+    First and last byte (inclusive) of a single `Range: bytes=...` header, or
+    None to send the whole content, which is also the answer to ranges not
+    supported here (several ranges, other units).
+    """
+    match = RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # no byte of an empty blob can be sent
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable(size)
+        # the last N bytes
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(size)
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def content_disposition(filename: str) -> str:
+    # RFC 6266, non ASCII names (Japanese) only survive in filename*
+    fallback = filename.encode("ascii", "ignore").decode().replace('"', "").strip() or "download"
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+@dataclass
+class BlobDownload:
+    size: int
+    start: int
+    end: int
+    partial: bool
+    etag: str
+    content_type: Optional[str]
+    chunks: AsyncIterator[bytes]
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start + 1
+
+    @property
+    def content_range(self) -> str:
+        return f"bytes {self.start}-{self.end}/{self.size}"
+
+
+async def _no_chunks() -> AsyncIterator[bytes]:
+    return
+    yield
+
+
+class BlobDownloader():
+    """
+    Streams blobs, or a byte range of them, chunk by chunk from the async
+    Blob client, so that no download is held whole in memory. The range is
+    read from the version whose properties were returned (ETag condition).
+    `sas_url` gives a read-only URL valid for `sas_ttl` seconds instead, for
+    clients to download from storage directly.
+    """
+
+    def __init__(self, container_client: ContainerClient, account_key: Optional[str] = None,
+                 sas_ttl: int = 300):
+        self.container_client = container_client
+        self.account_key = account_key
+        self.sas_ttl = sas_ttl
+
+    async def open(self, blob_name: str, range_header: Optional[str] = None,
+                   if_range: Optional[str] = None) -> BlobDownload:
+        blob_client = self.container_client.get_blob_client(blob_name)
+        properties = await blob_client.get_blob_properties()
+        byte_range = None
+        # a range of a version the client no longer has is answered with the whole content
+        if if_range is None or if_range == properties.etag:
+            byte_range = parse_range(range_header, properties.size)
+        start, end = byte_range or (0, properties.size - 1)
+        if properties.size == 0:
+            chunks = _no_chunks()
+        else:
+            downloader = await blob_client.download_blob(
+                offset=start, length=end - start + 1, max_concurrency=1,
+                etag=properties.etag, match_condition=MatchConditions.IfNotModified)
+            chunks = downloader.chunks()
+        metrics.increment("storage.download.bytes", max(end - start + 1, 0))
+        metrics.increment("storage.download.ranges" if byte_range else "storage.download.full")
+        return BlobDownload(properties.size, start, end, byte_range is not None, properties.etag,
+                            properties.content_settings.content_type, chunks)
+
+    def sas_url(self, blob_name: str, filename: str) -> str:
+        url, _ = blob_sas_url(self.container_client.get_blob_client(blob_name), self.account_key,
+                              BlobSasPermissions(read=True), self.sas_ttl, content_disposition(filename))
+        metrics.increment("storage.download.redirects")
+        return url
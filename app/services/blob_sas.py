@@ -0,0 +1,19 @@
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobClient
+
+
+def blob_sas_url(blob_client: BlobClient, account_key: Optional[str], permission: BlobSasPermissions,
+                 ttl: int, content_disposition: Optional[str] = None) -> tuple[str, datetime]:
+    """URL of the blob with a SAS scoped to it alone, valid `ttl` seconds, and its expiry."""
+    expiry = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+    sas = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=account_key,
+        permission=permission,
+        expiry=expiry,
+        content_disposition=content_disposition)
+    return f"{blob_client.url}?{sas}", expiry
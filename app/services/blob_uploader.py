@@ -0,0 +1,97 @@
+import base64
+import asyncio
+import hashlib
+from datetime import datetime
+from dataclasses import dataclass
+from typing import AsyncIterable, Awaitable, Callable, Optional, Set
+from azure.storage.blob import BlobProperties, BlobSasPermissions, ContentSettings
+from azure.storage.blob.aio import ContainerClient
+from app.services.blob_sas import blob_sas_url
+from app.utils import metrics
+
+
+@dataclass
+class UploadedBlob:
+    name: str
+    url: str
+    size: int
+    sha256: str
+
+
+class BlockBlobUploader():
+    """
+    Streams content to a block blob: chunks are gathered into `block_size`
+    blocks, up to `max_concurrency` blocks are staged at once, and the block
+    list is committed at the end, so an upload holds at most
+    (`max_concurrency` + 1) blocks in memory whatever the size of the file.
+    The size and SHA-256 are computed on the way and the SHA-256 is saved in
+    the blob metadata.
+    `sas_url` lets a client upload a blob to storage itself instead, with a
+    URL allowed to create that blob only, for `sas_ttl` seconds: once it
+    exists it cannot be overwritten through the URL.
+    """
+
+    def __init__(self, container_client: ContainerClient, block_size: int = 4 * 1024 * 1024,
+                 max_concurrency: int = 4, account_key: Optional[str] = None, sas_ttl: int = 900):
+        self.container_client = container_client
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.account_key = account_key
+        self.sas_ttl = sas_ttl
+
+    async def upload(self, blob_name: str, chunks: AsyncIterable[bytes], content_type: Optional[str] = None,
+                     on_chunk: Optional[Callable[[bytes], Awaitable[None]]] = None) -> UploadedBlob:
+        blob_client = self.container_client.get_blob_client(blob_name)
+        sha256 = hashlib.sha256()
+        size = 0
+        block_ids: list[str] = []
+        pending: Set[asyncio.Task] = set()
+        buffer = bytearray()
+
+        async def stage(data: bytes):
+            # block ids of a blob must all have the same length
+            block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+            block_ids.append(block_id)
+            while len(pending) >= self.max_concurrency:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                for task in done:
+                    task.result()
+            pending.add(asyncio.create_task(blob_client.stage_block(block_id, data, length=len(data))))
+
+        try:
+            async for chunk in chunks:
+                sha256.update(chunk)
+                size += len(chunk)
+                if on_chunk is not None:
+                    await on_chunk(chunk)
+                buffer += chunk
+                while len(buffer) >= self.block_size:
+                    await stage(bytes(buffer[: self.block_size]))
+                    del buffer[: self.block_size]
+            if buffer:
+                await stage(bytes(buffer))
+            if pending:
+                await asyncio.gather(*pending)
+            await blob_client.commit_block_list(
+                block_ids, content_settings=ContentSettings(content_type=content_type),
+                metadata={"sha256": sha256.hexdigest()})
+        except BaseException:
+            # staged blocks that are never committed are discarded by the service
+            for task in pending:
+                task.cancel()
+            raise
+        metrics.increment("storage.upload.bytes", size)
+        metrics.increment("storage.upload.blocks", len(block_ids))
+        return UploadedBlob(blob_name, blob_client.url, size, sha256.hexdigest())
+
+    def sas_url(self, blob_name: str) -> tuple[str, datetime]:
+        metrics.increment("storage.upload.sas_issued")
+        return blob_sas_url(self.container_client.get_blob_client(blob_name), self.account_key,
+                            BlobSasPermissions(create=True), self.sas_ttl)
+
+    async def properties(self, blob_name: str) -> BlobProperties:
+        return await self.container_client.get_blob_client(blob_name).get_blob_properties()
+
+    async def delete(self, blob_name: str):
+        await self.container_client.delete_blob(blob_name)
@@ -0,0 +1,120 @@
+from uuid import uuid1
+from typing import Any, List, Optional
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient, ContainerProxy
+from azure.cosmos.exceptions import CosmosBatchOperationError, CosmosResourceNotFoundError
+from app.constants import (CHAT_CONTAINER, CHAT_CONTENT_CONTAINER,
+                           CHAT_STORE_LEGACY, CHAT_STORE_DUAL, CHAT_STORE_PARTITIONED)
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+# transactional batches are limited to 100 operations
+MAX_BATCH_OPERATIONS = 100
+
+
+class ChatContentRepository():
+    """
+    Awaitable access to the chat contents (question/answer turns) stored in Cosmos DB.
+
+    Contents live in `ChatContents`, partitioned by `/chat_id`, so reading or
+    deleting one chat is a single-partition operation. The legacy
+    `ChatInformation` container (partitioned by `/type`) stays reachable
+    while existing items are migrated:
+
+    - legacy: read and write `ChatInformation` only
+    - dual: write both containers, read `ChatInformation`
+    - partitioned: read and write `ChatContents` only
+    """
+
+    def __init__(self, container: Optional[ContainerProxy], legacy_container: Optional[ContainerProxy] = None,
+                 mode: str = CHAT_STORE_DUAL):
+        if mode not in (CHAT_STORE_LEGACY, CHAT_STORE_DUAL, CHAT_STORE_PARTITIONED):
+            raise ValueError(f"Unknown chat content store mode: {mode}")
+        self.container = container
+        self.legacy_container = legacy_container
+        self.mode = mode
+
+    @classmethod
+    async def create(cls, cosmos_client: CosmosClient, database_id: str,
+                     mode: str = CHAT_STORE_DUAL) -> "ChatContentRepository":
+        database = await cosmos_client.create_database_if_not_exists(id=database_id)
+        container = None
+        legacy_container = None
+        if mode != CHAT_STORE_LEGACY:
+            container = await database.create_container_if_not_exists(
+                id=CHAT_CONTENT_CONTAINER, partition_key=PartitionKey(path="/chat_id"))
+        if mode != CHAT_STORE_PARTITIONED:
+            legacy_container = await database.create_container_if_not_exists(
+                id=CHAT_CONTAINER, partition_key=PartitionKey(path="/type"))
+        return cls(container, legacy_container, mode)
+
+    @property
+    def writes_partitioned(self) -> bool:
+        return self.mode != CHAT_STORE_LEGACY
+
+    @property
+    def writes_legacy(self) -> bool:
+        return self.mode != CHAT_STORE_PARTITIONED
+
+    async def add(self, chat_id: str, chat_type: str, index: int, question: str, answer: str,
+                  question_tokens: Optional[int] = None, answer_tokens: Optional[int] = None) -> dict[str, Any]:
+        chat_content = {"id": str(uuid1()),
+                        "type": chat_type,
+                        "chat_id": chat_id,
+                        "index": index,
+                        "question": question,
+                        "answer": answer}
+        if question_tokens is not None and answer_tokens is not None:
+            # see TokenLedger
+            chat_content["question_tokens"] = question_tokens
+            chat_content["answer_tokens"] = answer_tokens
+        if self.writes_legacy:
+            await self.legacy_container.create_item(chat_content)
+        if self.writes_partitioned:
+            # upsert so that a concurrent migration copy cannot make this fail
+            await self.container.upsert_item(chat_content)
+        return chat_content
+
+    async def list(self, chat_id: str, chat_type: str) -> list[dict[str, Any]]:
+        if self.mode == CHAT_STORE_PARTITIONED:
+            QUERY = "SELECT * FROM c WHERE c.chat_id=@chat_id ORDER BY c.index"
+            params = [dict(name="@chat_id", value=chat_id)]
+            results = self.container.query_items(
+                query=QUERY, parameters=params, partition_key=chat_id)
+        else:
+            QUERY = "SELECT * FROM c WHERE c.type=@type AND c.chat_id=@chat_id ORDER BY c.index"
+            params = [dict(name="@type", value=chat_type),
+                      dict(name="@chat_id", value=chat_id)]
+            results = self.legacy_container.query_items(
+                query=QUERY, parameters=params, partition_key=chat_type)
+        return [item async for item in results]
+
+    async def delete_all(self, chat_id: str, chat_type: str) -> int:
+        """Deletes every content of the chat with transactional batches, one partition at a time."""
+        items = await self.list(chat_id, chat_type)
+        item_ids = [item["id"] for item in items]
+        if self.writes_legacy:
+            await self.__delete_in_batches(self.legacy_container, item_ids, chat_type)
+        if self.writes_partitioned:
+            await self.__delete_in_batches(self.container, item_ids, chat_id)
+        return len(items)
+
+    async def __delete_in_batches(self, container: ContainerProxy, item_ids: List[str], partition_key: str):
+        for i in range(0, len(item_ids), MAX_BATCH_OPERATIONS):
+            batch = item_ids[i: i + MAX_BATCH_OPERATIONS]
+            try:
+                await container.execute_item_batch(
+                    batch_operations=[("delete", (item_id,)) for item_id in batch],
+                    partition_key=partition_key)
+            except CosmosBatchOperationError:
+                # a missing item fails the whole batch (e.g. not yet copied in dual mode)
+                for item_id in batch:
+                    await self.__delete_if_exists(container, item_id, partition_key)
+
+    async def __delete_if_exists(self, container: ContainerProxy, item_id: str, partition_key: str):
+        try:
+            await container.delete_item(item=item_id, partition_key=partition_key)
+        except CosmosResourceNotFoundError:
+            # not copied yet (dual) or already gone
+            pass
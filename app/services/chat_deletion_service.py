@@ -0,0 +1,49 @@
+import asyncio
+from typing import List
+from app.models import file as file_models
+from app.services.chat_content_repository import ChatContentRepository
+from app.services.file_service import FileService
+from app.services.searchai_service import SearchManager
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+
+class ChatDeletionService():
+    """
+    Removes everything a deleted chat leaves outside MySQL: the blobs of its
+    files, their sections in the search index and the chat contents in Cosmos DB.
+    The three stores are cleaned concurrently, blob deletes are bounded by
+    `max_concurrency`, index sections are deleted by key in batched calls and
+    Cosmos items are deleted in transactional batches.
+    """
+
+    def __init__(self, file_service: FileService, search_manager: SearchManager,
+                 chat_content_repository: ChatContentRepository, max_concurrency: int = 8):
+        self.file_service = file_service
+        self.search_manager = search_manager
+        self.chat_content_repository = chat_content_repository
+        self.max_concurrency = max_concurrency
+
+    async def deleteChatResources(self, chat_id: str, chat_type: str, files: List[file_models.File]):
+        results = await asyncio.gather(
+            self.__delete_blobs(files),
+            self.search_manager.remove_files(files),
+            self.chat_content_repository.delete_all(chat_id, chat_type),
+            return_exceptions=True,
+        )
+        for target, result in zip(["storage", "search index", "cosmos"], results):
+            if isinstance(result, BaseException):
+                logger.error(
+                    f"チャットのリソースを削除する際にエラーが発生します。chat_id: {chat_id}, {target}: {result}")
+        logger.info("Deleted resources of chat %s (%d files)",
+                    chat_id, len(files))
+
+    async def __delete_blobs(self, files: List[file_models.File]):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def delete(file: file_models.File):
+            async with semaphore:
+                await self.file_service.deleteFile(file)
+
+        await asyncio.gather(*[delete(file) for file in files])
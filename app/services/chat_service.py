@@ -1,12 +1,10 @@
 from uuid import uuid1
-from quart import current_app
-from azure.cosmos import PartitionKey
+from typing import List
 from sqlalchemy import desc
 from sqlalchemy.future import select
-from app.extensions import get_cosmos_client
 from app.database import get_db_session, db_transaction
 from app.models import chat as chat_models, file as file_models
-from app.constants import CHAT_CONTAINER
+from app.services.chat_content_repository import ChatContentRepository
 from app.utils.log_utils import get_logger
 from app.exceptions.service_exception import ServiceException
 
@@ -14,11 +12,8 @@ logger = get_logger("aoai_backend")
 
 
 class ChatService():
-    def __init__(self):
-        cosmos_db = get_cosmos_client().create_database_if_not_exists(
-            id=current_app.config["COSMOSDB_DATABASE"])
-        self.chat_cosmos = cosmos_db.create_container_if_not_exists(id=CHAT_CONTAINER,
-                                                                    partition_key=PartitionKey(path="/type"))
+    def __init__(self, chat_content_repository: ChatContentRepository):
+        self.chat_content_repository = chat_content_repository
 
     @classmethod
     async def saveChat(self, chat_type, openai_model, email):
@@ -79,13 +74,16 @@ class ChatService():
             logger.exception(f"チャットを更新する際にエラーが発生します。: {e}")
             raise ServiceException("チャット更新する際にエラーが発生します。", status_code=500)
 
-    async def deleteChat(self, chat_id, chat_type):
+    @classmethod
+    async def deleteChat(self, chat_id) -> List[file_models.File]:
+        """Deletes the chat and its file rows, returning the files whose blobs and index documents remain."""
         try:
             async with db_transaction() as session:
                 stmt = select(chat_models.Chat).where(
                     chat_models.Chat.id == chat_id)
                 result = await session.execute(stmt)
                 chat = result.scalars().first()
+                files: List[file_models.File] = []
                 if chat:
                     file_stmt = select(file_models.File).where(
                         file_models.File.chat_id == chat_id)
@@ -94,26 +92,14 @@ class ChatService():
                     for file in files:
                         await session.delete(file)
                     await session.delete(chat)
-            # delete chat content
-            results = await self.getChatContents(chat_id, chat_type)
-            for item in list(results):
-                self.chat_cosmos.delete_item(
-                    item=item, partition_key=chat_type)
+            return files
         except Exception as e:
             logger.exception(f"チャットを削除する際にエラーが発生します。: {e}")
             raise ServiceException("チャットを削除する際にエラーが発生します。", status_code=500)
 
     async def getChatContents(self, chat_id, chat_type):
-        QUERY = "SELECT * FROM c WHERE c.type=@type AND c.chat_id=@chat_id ORDER BY c.index"
         try:
-
-            params = [dict(name="@type", value=chat_type),
-                    dict(name="@chat_id", value=chat_id)]
-            results = self.chat_cosmos.query_items(
-                query=QUERY, parameters=params, enable_cross_partition_query=True
-            )
-            items = [item for item in results]
-            return items
+            return await self.chat_content_repository.list(chat_id, chat_type)
         except Exception as e:
             logger.exception(f"チャット内容を取得する際にエラーが発生します。: {e}")
             raise ServiceException("チャット内容を取得する際にエラーが発生します。", status_code=500)
@@ -0,0 +1,150 @@
+import re
+from typing import Awaitable, Callable, List, Optional
+import numpy as np
+from app.services.prompt_assembler import Source, TokenCounter
+from app.services.searchai_service import Document
+from app.utils import metrics
+from app.utils.commom import nonewlines
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+ORDINAL = re.compile(r"-(\d+)$")
+# shortest suffix/prefix match treated as the splitter's overlap rather than a coincidence
+MIN_OVERLAP = 20
+
+
+def mmr(query: np.ndarray, vectors: np.ndarray, k: int, lambda_: float) -> List[int]:
+    """
+    Maximal marginal relevance: picks `k` rows of `vectors` that are relevant to
+    `query` but not similar to each other. Returns their indices in pick order.
+    """
+    vectors = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+    query = query / (np.linalg.norm(query) + 1e-12)
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(len(vectors))
+    available = np.ones(len(vectors), dtype=bool)
+    picked: List[int] = []
+    for _ in range(min(k, len(vectors))):
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * redundancy, -np.inf)
+        index = int(np.argmax(scores))
+        picked.append(index)
+        available[index] = False
+        redundancy = np.maximum(redundancy, similarity[:, index])
+    return picked
+
+
+def merge_overlapping(first: str, second: str) -> Optional[str]:
+    """Joins two texts if one contains the other or the end of `first` is the start of `second`."""
+    if second in first:
+        return first
+    if first in second:
+        return second
+    probe = second[:MIN_OVERLAP]
+    position = first.find(probe)
+    while position != -1:
+        if second.startswith(first[position:]):
+            return first[:position] + second
+        position = first.find(probe, position + 1)
+    return None
+
+
+class ContextAssembler:
+    """
+    Turns search hits into the sources of the answer prompt:
+      1. MMR over the hit embeddings keeps `max_sources` relevant, non-redundant hits,
+         when every hit has a vector at hand (returned with the hit, or found by
+         `lookup`, which must not embed); otherwise the top hits are kept
+      2. hits of the same sourcepage are ordered by chunk ordinal and their
+         overlapping text (the splitter's ~10% overlap, or repeated captions) merged
+    Fitting the sources into the prompt is left to PromptAssembler. Source
+    tokens and those saved against the plain concatenation go to the metrics
+    as `context.*`.
+    """
+
+    def __init__(self, lookup: Callable[[List[str]], Awaitable[dict[str, List[float]]]],
+                 token_counter: TokenCounter, max_sources: int = 3, mmr_lambda: float = 0.5,
+                 candidates: int = 10):
+        self.lookup = lookup
+        self.token_counter = token_counter
+        # hits to retrieve for MMR to choose from
+        self.candidates = max(candidates, max_sources)
+        self.max_sources = max_sources
+        self.mmr_lambda = mmr_lambda
+
+    async def assemble(self, results: List[Document], query_vector: Optional[List[float]],
+                       use_semantic_captions: bool) -> List[Source]:
+        texts = [self.__text(doc, use_semantic_captions) for doc in results]
+        hits = [(doc, text) for doc, text in zip(results, texts) if text]
+        if not hits:
+            return []
+
+        embeddings = None
+        if query_vector is not None and len(hits) > self.max_sources:
+            embeddings = await self.__embeddings(hits)
+        if embeddings is not None:
+            picked = mmr(np.asarray(query_vector, dtype=np.float32),
+                         np.asarray(embeddings, dtype=np.float32), self.max_sources, self.mmr_lambda)
+            hits = [hits[index] for index in picked]
+        else:
+            hits = hits[: self.max_sources]
+
+        sources = self.__merge(hits)
+        # what concatenating the top hits verbatim would have cost
+        raw_tokens = sum(self.token_counter.count(doc.sourcepage + ": " + nonewlines(text))
+                         for doc, text in zip(results[: self.max_sources], texts))
+        source_tokens = sum(self.token_counter.count(source.render()) for source in sources)
+        logger.info("Assembled %d sources from %d hits, %d tokens (%d without assembly)",
+                    len(sources), len(results), source_tokens, raw_tokens)
+        metrics.increment("context.tokens", source_tokens)
+        metrics.increment("context.tokens_saved", max(raw_tokens - source_tokens, 0))
+        return sources
+
+    async def __embeddings(self, hits: List[tuple[Document, str]]) -> Optional[List[List[float]]]:
+        """Vectors of the hits' chunks, or None when any is not at hand."""
+        missing = [doc.content or text for doc, text in hits if doc.embedding is None]
+        found: dict[str, List[float]] = {}
+        if missing:
+            try:
+                found = await self.lookup(missing)
+            except Exception as e:
+                logger.warning(f"チャンクのベクトルを取得できません。: {str(e)}")
+                metrics.increment("context.mmr_skipped")
+                return None
+        embeddings = [doc.embedding if doc.embedding is not None else found.get(doc.content or text)
+                      for doc, text in hits]
+        if any(embedding is None for embedding in embeddings):
+            metrics.increment("context.mmr_skipped")
+            return None
+        return embeddings
+
+    @staticmethod
+    def __text(doc: Document, use_semantic_captions: bool) -> str:
+        if use_semantic_captions and doc.captions:
+            return " . ".join(caption.text for caption in doc.captions)
+        return doc.content or ""
+
+    @staticmethod
+    def __merge(hits: List[tuple[Document, str]]) -> List[Source]:
+        """Merges overlapping texts per sourcepage; a group scores as its best hit."""
+        groups: dict[str, List[tuple[int, str]]] = {}
+        scores: dict[str, float] = {}
+        for doc, text in hits:
+            match = ORDINAL.search(doc.id or "")
+            groups.setdefault(doc.sourcepage, []).append((int(match.group(1)) if match else 0, text))
+            score = doc.reranker_score if doc.reranker_score is not None else doc.score or 0.0
+            scores[doc.sourcepage] = max(scores.get(doc.sourcepage, score), score)
+
+        sources = []
+        for sourcepage, parts in groups.items():
+            parts.sort()
+            texts = [parts[0][1]]
+            for _, text in parts[1:]:
+                joined = merge_overlapping(texts[-1], text)
+                if joined is None:
+                    texts.append(text)
+                else:
+                    texts[-1] = joined
+            sources.append(Source(sourcepage, " ... ".join(texts), scores[sourcepage]))
+        return sources
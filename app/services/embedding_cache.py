@@ -0,0 +1,211 @@
+import os
+import re
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+from app.utils import metrics
+
+
+def normalize_text(text: str) -> str:
+    """NFKC-normalizes the text and collapses whitespace, so trivially different queries share a key."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def embedding_model_key(deployment: str, dimensions: Optional[int] = None) -> str:
+    """Identifies the vectors of a deployment, at reduced `dimensions` if given."""
+    return f"{deployment}@{dimensions}" if dimensions else deployment
+
+
+def pack_vector(vector: List[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(data: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class SqliteVectorStore:
+    """
+    On-disk key -> float32 vector store backed by SQLite. When the stored
+    vectors exceed `max_bytes`, the least recently used ones are evicted.
+    Vectors are tagged with the model key they were put with, so that tools
+    reading the store can tell vectors of different models apart.
+    The file may be shared by several worker processes: the size is summed
+    from the table inside each write transaction, not counted per process.
+    Calls are blocking; async callers run them in a worker thread.
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL, "
+            "model TEXT)")
+        # stores created before vectors were tagged
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(vectors)")]
+        if "model" not in columns:
+            self.connection.execute("ALTER TABLE vectors ADD COLUMN model TEXT")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS vectors_accessed_at ON vectors (accessed_at)")
+        self.connection.commit()
+
+    def get_many(self, keys: List[str]) -> dict[str, List[float]]:
+        if not keys:
+            return {}
+        found: dict[str, List[float]] = {}
+        with self.lock:
+            # stay below SQLite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i: i + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM vectors WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                found.update({key: unpack_vector(data) for key, data in rows})
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE vectors SET accessed_at = ? WHERE key = ?", [(now, key) for key in found])
+            self.connection.commit()
+        return found
+
+    def get(self, key: str) -> Optional[List[float]]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, vectors: dict[str, List[float]], model: Optional[str] = None):
+        if not vectors:
+            return
+        now = time.time()
+        rows = [(key, pack_vector(vector), now) for key, vector in vectors.items()]
+        with self.lock:
+            # take the write lock up front, so that no other process writes between the sum and the eviction
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO vectors (key, vector, size, accessed_at, model) VALUES (?, ?, ?, ?, ?)",
+                    [(key, data, len(data), accessed_at, model) for key, data, accessed_at in rows])
+                self.__evict()
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+    def put(self, key: str, vector: List[float], model: Optional[str] = None):
+        self.put_many({key: vector}, model)
+
+    def __evict(self):
+        if self.max_bytes is None:
+            return
+        total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM vectors").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        # evict down to 90% of the limit so that every insert does not trigger an eviction
+        target = self.max_bytes * 0.9
+        rows = self.connection.execute(
+            "SELECT key, size FROM vectors ORDER BY accessed_at").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total_bytes <= target:
+                break
+            evicted.append((key,))
+            total_bytes -= size
+        self.connection.executemany("DELETE FROM vectors WHERE key = ?", evicted)
+        metrics.increment("embedding_store.evicted", len(evicted))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class EmbeddingCache:
+    """
+    Cache of query embeddings keyed by deployment name and normalized text.
+    An in-process LRU sits in front of an optional `SqliteVectorStore` that
+    survives restarts. Hits and misses are counted per tier in the metrics
+    (`embedding_cache.*`), along with the overall `embedding_cache.hit_ratio`.
+    """
+
+    def __init__(self, maxsize: int = 1024, disk_store: Optional[SqliteVectorStore] = None):
+        self.maxsize = maxsize
+        self.disk_store = disk_store
+        self.entries: OrderedDict[str, List[float]] = OrderedDict()
+
+    @staticmethod
+    def key(deployment: str, text: str) -> str:
+        return hashlib.sha256(f"{deployment}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    async def get_or_compute(self, deployment: str, text: str,
+                             compute: Callable[[], Awaitable[List[float]]]) -> List[float]:
+        key = self.key(deployment, text)
+        vector = self.entries.get(key)
+        if vector is not None:
+            self.entries.move_to_end(key)
+            metrics.increment("embedding_cache.hit.memory")
+            self.__update_hit_ratio()
+            return vector
+
+        if self.disk_store is not None:
+            vector = await asyncio.to_thread(self.disk_store.get, key)
+            if vector is not None:
+                metrics.increment("embedding_cache.hit.disk")
+                self.__update_hit_ratio()
+                self.__remember(key, vector)
+                return vector
+
+        metrics.increment("embedding_cache.miss")
+        self.__update_hit_ratio()
+        vector = await compute()
+        self.__remember(key, vector)
+        if self.disk_store is not None:
+            await asyncio.to_thread(self.disk_store.put, key, vector, deployment)
+        return vector
+
+    @staticmethod
+    def __update_hit_ratio():
+        hits = metrics.get_counter("embedding_cache.hit.memory") + \
+            metrics.get_counter("embedding_cache.hit.disk")
+        total = hits + metrics.get_counter("embedding_cache.miss")
+        metrics.set_value("embedding_cache.hit_ratio", hits / total)
+
+    def __remember(self, key: str, vector: List[float]):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class ChunkEmbeddingStore:
+    """
+    Persistent embeddings of ingested chunks, keyed by the SHA-256 of the
+    embedding deployment and the exact chunk text, so that re-uploaded files,
+    URLs shared between chats and repeated boilerplate are embedded only once.
+    """
+
+    def __init__(self, store: SqliteVectorStore):
+        self.store = store
+
+    @staticmethod
+    def key(deployment: str, text: str) -> str:
+        return hashlib.sha256(f"{deployment}\0{text}".encode("utf-8")).hexdigest()
+
+    async def get_many(self, deployment: str, texts: List[str]) -> dict[str, List[float]]:
+        """Returns the stored embeddings of `texts`, by text."""
+        keys = {self.key(deployment, text): text for text in texts}
+        found = await asyncio.to_thread(self.store.get_many, list(keys))
+        return {keys[key]: vector for key, vector in found.items()}
+
+    async def put_many(self, deployment: str, embeddings: dict[str, List[float]]):
+        await asyncio.to_thread(self.store.put_many, {
+            self.key(deployment, text): vector for text, vector in embeddings.items()}, deployment)
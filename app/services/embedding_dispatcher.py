@@ -0,0 +1,146 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Optional
+from openai import RateLimitError
+from app.services.retry_policy import RetryPolicy
+from app.utils import metrics
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+
+class EmbeddingBatch:
+    """
+    Represents a batch of text that is going to be embedded
+    """
+
+    def __init__(self, texts: List[str], token_length: int):
+        self.texts = texts
+        self.token_length = token_length
+
+
+class TokenBucket:
+    """
+    Per-minute budget that refills continuously. `acquire` waits until `amount`
+    is available; callers are served in arrival order.
+    """
+
+    def __init__(self, per_minute: Optional[float]):
+        self.capacity = per_minute
+        self.tokens = per_minute or 0
+        self.rate = (per_minute or 0) / 60
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount: float):
+        if not self.capacity:
+            return
+        # a single request larger than the budget waits for a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self.__refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def drain(self):
+        """Empties the bucket, e.g. when the service reported that the quota is used up."""
+        self.__refill()
+        self.tokens = 0
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Limits the number of requests in flight. The limit is halved on every rate
+    limit and grows back by one after `limit` consecutive successes.
+    """
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def on_success(self):
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_limit:
+            self.limit += 1
+            self.successes = 0
+
+    def on_rate_limited(self):
+        self.limit = max(1, self.limit // 2)
+        self.successes = 0
+
+
+class EmbeddingDispatcher:
+    """
+    Keeps several embedding batches in flight within a tokens-per-minute and a
+    requests-per-minute budget, backs off adaptively on `RateLimitError` and
+    returns the embeddings in input order. One dispatcher is shared by all
+    requests of the worker, so the budget applies process-wide.
+    """
+
+    def __init__(self, retry_policy: RetryPolicy, tokens_per_minute: Optional[int] = None,
+                 requests_per_minute: Optional[int] = None, max_concurrency: int = 4):
+        self.retry_policy = retry_policy
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.concurrency = AdaptiveConcurrencyLimit(max_concurrency)
+
+    async def dispatch(self, batches: List[EmbeddingBatch],
+                       embed: Callable[[EmbeddingBatch], Awaitable[List[List[float]]]]) -> List[List[float]]:
+        tasks = [asyncio.create_task(self.__run(batch, embed))
+                 for batch in batches]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return [embedding for result in results for embedding in result]
+
+    async def __run(self, batch: EmbeddingBatch,
+                    embed: Callable[[EmbeddingBatch], Awaitable[List[List[float]]]]) -> List[List[float]]:
+        async def attempt():
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(batch.token_length)
+            return await embed(batch)
+
+        async with self.concurrency.slot():
+            embeddings = await self.retry_policy.call(attempt, on_retry=self.__on_retry)
+            self.concurrency.on_success()
+            metrics.increment("openai.embeddings.requests")
+            metrics.increment("openai.embeddings.tokens", batch.token_length)
+            return embeddings
+
+    def __on_retry(self, error: Exception, delay: float):
+        if not isinstance(error, RateLimitError):
+            return
+        self.concurrency.on_rate_limited()
+        self.token_bucket.drain()
+        metrics.increment("openai.embeddings.rate_limited")
+        logger.info(
+            "Rate limited on the OpenAI embeddings API, lowering concurrency to %d and sleeping %.2fs before retrying...",
+            self.concurrency.limit, delay)
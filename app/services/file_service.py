@@ -1,16 +1,19 @@
 import os
 import re
+import asyncio
 from io import BytesIO
 from uuid import uuid1
+from datetime import datetime
 from quart import current_app
-from sqlalchemy import desc, not_, and_
+from sqlalchemy import desc, not_, and_, update
 from sqlalchemy.future import select
-from typing import List, Optional
-from werkzeug.datastructures import MultiDict, FileStorage
-from azure.storage.blob import BlobClient
+from typing import IO, Any, AsyncIterable, List, Optional
+from azure.core.exceptions import ResourceNotFoundError
+from werkzeug.exceptions import RequestEntityTooLarge
 from azure.core.credentials import AzureKeyCredential
 from langchain_community.document_loaders import WebBaseLoader
-from app.extensions import get_storage_client
+from app.constants import FILE_STATUS_UPLOADING, FILE_STATUS_FAILURE
+from app.extensions import get_storage_client, get_async_storage_client
 from app.database import get_db_session, db_transaction
 from app.models import file as file_models
 from app.services.parser.fileprocessor import FileProcessor
@@ -20,6 +23,10 @@ from app.services.parser.htmlparser import LocalHTMLParser
 from app.services.parser.jsonparser import JsonParser
 from app.services.parser.textparser import TextParser
 from app.services.textsplitter import SentenceTextSplitter, SimpleTextSplitter
+from app.services.blob_downloader import BlobDownload, BlobDownloader
+from app.services.blob_uploader import BlockBlobUploader, UploadedBlob
+from app.services.upload_handoff import Spool, UploadHandoff
+from app.utils.multipart import MultipartReader
 from app.services.searchai_service import Section
 from app.utils.log_utils import get_logger
 from app.exceptions.service_exception import ServiceException
@@ -35,6 +42,24 @@ class FileService():
         ).get_container_client(current_app.config.get("STORAGE_CONTAINER"))
         self.file_processors: dict[str,
                                    FileProcessor] = self.__setup_file_processors()
+        self.upload_handoff = UploadHandoff(
+            max_memory=current_app.config.get("UPLOAD_SPOOL_MAX_MEMORY_MB", 4) * 1024 * 1024,
+            ttl=current_app.config.get("UPLOAD_HANDOFF_TTL", 3600),
+            directory=current_app.config.get("UPLOAD_SPOOL_DIR"))
+        async_container_client = get_async_storage_client().get_container_client(
+            current_app.config.get("STORAGE_CONTAINER"))
+        self.blob_downloader = BlobDownloader(
+            async_container_client, account_key=current_app.config.get("STORAGE_KEY"),
+            sas_ttl=current_app.config.get("STORAGE_DOWNLOAD_SAS_TTL", 300))
+        self.download_redirect = current_app.config.get("STORAGE_DOWNLOAD_REDIRECT", False)
+        self.blob_uploader = BlockBlobUploader(
+            async_container_client,
+            block_size=current_app.config.get("STORAGE_UPLOAD_BLOCK_SIZE_MB", 4) * 1024 * 1024,
+            max_concurrency=current_app.config.get("STORAGE_UPLOAD_MAX_CONCURRENCY", 4),
+            account_key=current_app.config.get("STORAGE_KEY"),
+            sas_ttl=current_app.config.get("STORAGE_UPLOAD_SAS_TTL", 900))
+        self.upload_max_size = current_app.config.get("STORAGE_UPLOAD_MAX_SIZE_MB", 1024) * 1024 * 1024
+        self.upload_max_files = current_app.config.get("STORAGE_UPLOAD_MAX_FILES", 20)
 
     def __setup_file_processors(
         local_pdf_parser: bool = False,
@@ -80,58 +105,241 @@ class FileService():
             ".txt": FileProcessor(TextParser(), sentence_text_splitter),
         }
 
-    def read_file_from_storage(self, file_id: str) -> BytesIO:
+    async def read_file_from_storage(self, file_id: str) -> IO[bytes]:
+        """Downloads the file into a spool, in memory or on disk depending on its size."""
+        spool = self.upload_handoff.spool()
         try:
-            blob_client = self.storage_client.get_blob_client(
-                container=current_app.config.get("STORAGE_CONTAINER"), blob=file_id)
-            downloader = blob_client.download_blob(max_concurrency=1)
-            file_content = downloader.readall()
-            return BytesIO(file_content)
+            download = await self.blob_downloader.open(file_id)
+            async for chunk in download.chunks:
+                await spool.write(chunk)
+            return spool.finish()
         except Exception as e:
+            spool.close()
             logger.error(f"ファイルを読み込む時にエラーが発生します。 {file_id}: {str(e)}")
             raise ServiceException("ファイルを読み込む時にエラーが発生します。", status_code=500)
 
-    async def saveFiles(self, files: MultiDict[str, FileStorage], chat_id: str, chat_type: str, category: str, email: str) -> List[file_models.File]:
-        files_res: List[file_models.File] = []
+    async def openDownload(self, file_id: str, range_header: Optional[str] = None,
+                           if_range: Optional[str] = None) -> BlobDownload:
         try:
-            async with get_db_session() as session:
-                for index in files:
-                    file: FileStorage = files[index]
-                    file_id = str(uuid1())
-                    file_name = file.filename
-                    # content_type = file.content_type
-                    file_content: bytes = file.read()
-                    file_size_mb: float = len(file_content) / (1024 * 1024)
+            return await self.blob_downloader.open(file_id, range_header, if_range)
+        except ServiceException:
+            raise
+        except ResourceNotFoundError:
+            raise ServiceException("ファイルが存在しません。", status_code=404)
+        except Exception as e:
+            logger.exception(f"ファイルを読み込む時にエラーが発生します。 {file_id}: {str(e)}")
+            raise ServiceException("ファイルを読み込む時にエラーが発生します。", status_code=500)
+
+    def getDownloadUrl(self, file_id: str, file_name: str) -> str:
+        """A short-lived read-only URL of the file in storage."""
+        return self.blob_downloader.sas_url(file_id, file_name)
 
+    async def saveFiles(self, body: AsyncIterable[bytes], boundary: bytes,
+                        email: str) -> tuple[dict[str, str], List[file_models.File]]:
+        """
+        Streams the files of a multipart/form-data body to storage as they
+        arrive, then saves them to MySQL with the form fields (chat_id,
+        chat_type, category), which may come before or after the files.
+        Returns the form fields and the saved files.
+        """
+        fields: dict[str, str] = {}
+        uploads: List[tuple[str, UploadedBlob, Spool]] = []
+        file_name = None
+        try:
+            async for part in MultipartReader(
+                    body, boundary, max_size=current_app.config.get("MAX_CONTENT_LENGTH")).parts():
+                if part.filename is None:
+                    fields[part.name] = (await part.read()).decode("utf-8")
+                    continue
+                if not part.filename:
+                    # file input left empty
+                    continue
+                file_name = part.filename
+                file_id = str(uuid1())
+                # kept for the ingestion job, in memory or on disk depending on its size
+                spool = self.upload_handoff.spool()
+                try:
                     # save to storage
-                    uploaded_blob: BlobClient = self.storage_container_client.upload_blob(
-                        file_id,
-                        file_content,
-                        overwrite=True
-                    )
-                    file_url = uploaded_blob.url
-                    # save to mysql
-                    new_file_record = file_models.File(
+                    uploaded_blob = await self.blob_uploader.upload(
+                        file_id, part.chunks(), part.content_type, on_chunk=spool.write)
+                except BaseException:
+                    spool.close()
+                    raise
+                uploads.append((file_name, uploaded_blob, spool))
+
+            missing = [name for name in ("chat_id", "chat_type", "category") if not fields.get(name)]
+            if missing:
+                raise ServiceException(f"{', '.join(missing)}が指定されていません。", status_code=400)
+
+            # save to mysql
+            async with get_db_session() as session:
+                files_res = [file_models.File(
+                    id=uploaded_blob.name,
+                    name=name,
+                    chat_id=fields["chat_id"],
+                    chat_type=fields["chat_type"],
+                    file_url=uploaded_blob.url,
+                    file_size_mb=uploaded_blob.size / (1024 * 1024),
+                    sha256=uploaded_blob.sha256,
+                    status=FILE_STATUS_UPLOADING,
+                    category=fields["category"],
+                    created_by=email,
+                    updated_by=email
+                ) for name, uploaded_blob, _ in uploads]
+                session.add_all(files_res)
+                await session.commit()
+                for new_file_record in files_res:
+                    await session.refresh(new_file_record)
+        except BaseException as e:
+            await self.__discardUploads(uploads)
+            if isinstance(e, (ServiceException, RequestEntityTooLarge)) or not isinstance(e, Exception):
+                raise
+            logger.exception(
+                f"ファイルをアップロードする際に、エラーが発生します。 {file_name}: {str(e)}")
+            raise ServiceException("ファイルを読み込む時にエラーが発生します。", status_code=500)
+
+        for _, uploaded_blob, spool in uploads:
+            self.upload_handoff.put(uploaded_blob.name, spool.finish())
+        return fields, files_res
+
+    async def __discardUploads(self, uploads: List[tuple[str, UploadedBlob, Spool]]):
+        for _, uploaded_blob, spool in uploads:
+            spool.close()
+            try:
+                await self.blob_uploader.delete(uploaded_blob.name)
+            except Exception as e:
+                logger.warning(f"アップロード済みのファイルを削除できません。 {uploaded_blob.name}: {str(e)}")
+
+    async def createUploadSessions(self, fields: dict[str, Any], email: str) -> List[dict[str, Any]]:
+        """
+        First step of a direct upload: saves the files announced in
+        `fields["files"]` ({"name", "size"}) to MySQL with no size yet, and
+        returns for each a SAS URL the browser uploads the file to (Put Blob
+        or Put Block/Put Block List), then calls completeUpload.
+        """
+        missing = [name for name in ("chat_id", "chat_type", "category", "files") if not fields.get(name)]
+        if missing:
+            raise ServiceException(f"{', '.join(missing)}が指定されていません。", status_code=400)
+        uploads = fields["files"]
+        if not isinstance(uploads, list):
+            raise ServiceException("filesはリストで指定してください。", status_code=400)
+        if len(uploads) > self.upload_max_files:
+            raise ServiceException(
+                f"一度にアップロードできるファイルは{self.upload_max_files}件までです。", status_code=400)
+        for upload in uploads:
+            name = upload.get("name") if isinstance(upload, dict) else None
+            if not name or not isinstance(name, str):
+                raise ServiceException("ファイル名が指定されていません。", status_code=400)
+            if os.path.splitext(name)[1] not in self.file_processors:
+                raise ServiceException("ファイル形式またはファイル拡張子が正しくありません。", status_code=400)
+            try:
+                size = int(upload.get("size") or 0)
+            except (TypeError, ValueError):
+                raise ServiceException("ファイルサイズが正しくありません。", status_code=400)
+            if size > self.upload_max_size:
+                raise ServiceException("ファイルサイズが上限を超えています。", status_code=413)
+
+        sessions = []
+        try:
+            async with get_db_session() as session:
+                files_res = []
+                for upload in uploads:
+                    file_id = str(uuid1())
+                    upload_url, expires_at = self.blob_uploader.sas_url(file_id)
+                    files_res.append(file_models.File(
                         id=file_id,
-                        name=file_name,
-                        chat_id=chat_id,
-                        chat_type=chat_type,
-                        file_url=file_url,
-                        file_size_mb=file_size_mb,
-                        category=category,
+                        name=upload["name"],
+                        chat_id=fields["chat_id"],
+                        chat_type=fields["chat_type"],
+                        file_url=upload_url.split("?", 1)[0],
+                        # set by completeUpload once the blob is in storage
+                        file_size_mb=None,
+                        status=FILE_STATUS_UPLOADING,
+                        category=fields["category"],
+                        # failed by IngestionQueue if never completed
+                        upload_expires_at=expires_at.astimezone().replace(tzinfo=None),
                         created_by=email,
                         updated_by=email
-                    )
-                    session.add(new_file_record)
-                    await session.commit()
-                    await session.refresh(new_file_record)
-                    files_res.append(new_file_record)
+                    ))
+                    sessions.append({
+                        "file_id": file_id,
+                        "name": upload["name"],
+                        "upload_url": upload_url,
+                        "expires_at": expires_at.isoformat(),
+                        "headers": {"x-ms-blob-type": "BlockBlob"},
+                    })
+                session.add_all(files_res)
+                await session.commit()
+        except Exception as e:
+            logger.exception(f"アップロードを準備する際に、エラーが発生します。: {str(e)}")
+            raise ServiceException("アップロードを準備する際に、エラーが発生します。", status_code=500)
+        return sessions
 
-            return files_res
+    async def completeUpload(self, file_id: str, email: str) -> Optional[file_models.File]:
+        """
+        Second step of a direct upload: checks the blob is in storage and
+        records its size. Returns the file to ingest, or None if the upload
+        was already completed (by the browser or a storage event), so that
+        the file is enqueued once whoever calls first. An upload failed after
+        its SAS URL expired cannot be completed any more.
+        """
+        async with get_db_session() as session:
+            file = (await session.execute(
+                select(file_models.File).where(file_models.File.id == file_id))).scalars().first()
+        if file is None:
+            raise ServiceException("ファイルが存在しません。", status_code=404)
+        if file.file_size_mb is not None:
+            return None
+        if file.status != FILE_STATUS_UPLOADING:
+            raise ServiceException("アップロードの有効期限が切れました。", status_code=410)
+        try:
+            properties = await self.blob_uploader.properties(file_id)
+        except ResourceNotFoundError:
+            if file.upload_expires_at is not None and file.upload_expires_at < datetime.now():
+                raise ServiceException("アップロードの有効期限が切れました。", status_code=410)
+            raise ServiceException("ファイルがまだアップロードされていません。", status_code=409)
+        # a SAS URL cannot limit the size of what is uploaded with it
+        too_large = properties.size > self.upload_max_size
+        if too_large:
+            try:
+                await self.blob_uploader.delete(file_id)
+            except Exception as e:
+                logger.warning(f"アップロード済みのファイルを削除できません。 {file_id}: {str(e)}")
+        try:
+            async with db_transaction() as session:
+                values = dict(file_size_mb=properties.size / (1024 * 1024),
+                              sha256=(properties.metadata or {}).get("sha256"), updated_by=email)
+                if too_large:
+                    values["status"] = FILE_STATUS_FAILURE
+                result = await session.execute(
+                    update(file_models.File)
+                    .where(file_models.File.id == file_id, file_models.File.file_size_mb.is_(None),
+                           file_models.File.status == FILE_STATUS_UPLOADING)
+                    .values(**values))
+                completed = result.rowcount == 1
         except Exception as e:
-            logger.exception(
-                f"ファイルをアップロードする際に、エラーが発生します。 {file_name}: {str(e)}")
-            raise ServiceException("ファイルを読み込む時にエラーが発生します。", status_code=500)
+            logger.exception(f"アップロードを完了する際に、エラーが発生します。 {file_id}: {str(e)}")
+            raise ServiceException("アップロードを完了する際に、エラーが発生します。", status_code=500)
+        if too_large:
+            raise ServiceException("ファイルサイズが上限を超えています。", status_code=413)
+        if not completed:
+            return None
+        async with get_db_session() as session:
+            return (await session.execute(
+                select(file_models.File).where(file_models.File.id == file_id))).scalars().first()
+
+    async def deleteUpload(self, file_id: str):
+        """Deletes what was uploaded for a direct upload given up, if anything."""
+        try:
+            await self.blob_uploader.delete(file_id)
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"アップロード済みのファイルを削除できません。 {file_id}: {str(e)}")
+
+    def releaseUpload(self, file_id: str):
+        """Drops the content kept for ingestion once the file is ingested or given up."""
+        self.upload_handoff.release(file_id)
 
     async def saveUrl(self, url: str, chat_id: str, email: str) -> file_models.File:
         try:
@@ -168,8 +376,17 @@ class FileService():
             raise ServiceException(
                 "ファイル形式またはファイル拡張子が正しくありません。", status_code=500)
         logger.info("Ingesting '%s'", file.name)
-        file_content = self.read_file_from_storage(file.id)
-        pages = [page async for page in processor.parser.parse(content=file_content)]
+        # the content captured by saveFiles when uploaded to this worker
+        file_content = self.upload_handoff.open(file.id)
+        downloaded = file_content is None
+        if downloaded:
+            file_content = await self.read_file_from_storage(file.id)
+        try:
+            pages = [page async for page in processor.parser.parse(content=file_content)]
+        finally:
+            # the handoff keeps its content for a retry
+            if downloaded:
+                file_content.close()
         logger.info("Splitting '%s' into sections", file.name)
         sections = [
             Section(split_page, content=file, category=category) for split_page in processor.splitter.split_pages(pages)
@@ -197,7 +414,7 @@ class FileService():
                 return
             blob_client = self.storage_container_client.get_blob_client(
                 file.id)
-            blob_client.delete_blob()
+            await asyncio.to_thread(blob_client.delete_blob)
         except Exception as e:
             logger.exception(f"AzureStorageにファイルを削除する際に、エラーが発生します。: {str(e)}")
             raise ServiceException("ファイルを削除する際に、エラーが発生します。", status_code=500)
@@ -234,6 +451,20 @@ class FileService():
             logger.exception(f"ファイルを取得する際に、エラーが発生します。: {str(e)}")
             raise ServiceException("ファイルを取得する際に、エラーが発生します。", status_code=500)
 
+    @classmethod
+    async def updateChunkCount(self, file_id: str, chunk_count: int):
+        try:
+            async with db_transaction() as session:
+                file_stmt = select(file_models.File).where(
+                    file_models.File.id == file_id)
+                file_result = await session.execute(file_stmt)
+                file = file_result.scalars().first()
+                if file:
+                    file.chunk_count = chunk_count
+        except Exception as e:
+            logger.exception(f"チャンク数を更新する際に、エラーが発生します。: {str(e)}")
+            raise ServiceException("ファイルを更新する際に、エラーが発生します。", status_code=500)
+
     @classmethod
     async def deleteDBFile(self, file_id: str) -> file_models.File:
         async with db_transaction() as session:
@@ -0,0 +1,287 @@
+import os
+import socket
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, List, Optional
+from quart import Quart
+from sqlalchemy import update, desc
+from sqlalchemy.future import select
+from app.constants import (FILE_STATUS_UPLOADING, FILE_STATUS_SUCCESS, FILE_STATUS_FAILURE,
+                           JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED,
+                           JOB_STAGE_PARSING, JOB_STAGE_INDEXING)
+from app.database import get_db_session, db_transaction
+from app.models import file as file_models
+from app.models.ingestionjob import IngestionJob
+from app.services.file_service import FileService
+from app.services.searchai_service import SearchManager
+from app.utils import metrics
+from app.utils.log_utils import get_logger
+from app.exceptions.service_exception import ServiceException
+
+logger = get_logger("aoai_backend")
+
+WORKER_ACCOUNT = "ingestion-worker"
+# share of the progress given to parsing, the rest follows the indexed sections
+PARSED_PROGRESS = 10
+
+
+class IngestionQueue():
+    """
+    Parses, embeds and indexes uploaded files in the background.
+
+    Jobs are rows of `ingestion_jobs`, so they survive restarts and are shared
+    by every worker process: a job is claimed with a conditional update
+    (`status` still queued), which only one worker can win. Each process runs
+    `workers` tasks that poll for due jobs every `poll_interval` seconds, or
+    sooner when a job is enqueued here.
+
+    A failed job is retried after `retry_backoff` seconds, doubled on every
+    attempt, up to `max_attempts`. A job left running longer than
+    `job_timeout` (its worker died) is queued again. The file follows its job
+    in `files.status`: uploading until indexed, then success or failure.
+
+    Direct uploads never completed are failed `upload_grace` seconds after
+    their SAS URL expired (an upload started before the expiry may still be
+    running until then), and whatever was uploaded is deleted.
+    """
+
+    def __init__(self, app: Quart, file_service: FileService, search_manager: SearchManager,
+                 workers: int = 2, max_attempts: int = 3, retry_backoff: int = 30,
+                 poll_interval: int = 5, job_timeout: int = 1800, upload_grace: int = 3600):
+        self.app = app
+        self.file_service = file_service
+        self.search_manager = search_manager
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.upload_grace = upload_grace
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.wakeup = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.__work()) for _ in range(self.workers)]
+        logger.info("Started %d ingestion workers (%s)", self.workers, self.worker_id)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # hand the interrupted jobs over to the other workers right away
+        async with db_transaction() as session:
+            await session.execute(
+                update(IngestionJob)
+                .where(IngestionJob.status == JOB_RUNNING, IngestionJob.locked_by == self.worker_id)
+                .values(status=JOB_QUEUED, locked_by=None, locked_at=None, run_after=datetime.now()))
+
+    async def enqueue(self, files: List[file_models.File], category: str, email: str) -> List[dict[str, Any]]:
+        try:
+            async with db_transaction() as session:
+                jobs = [IngestionJob(file_id=file.id, category=category, status=JOB_QUEUED, progress=0,
+                                     attempts=0, run_after=datetime.now(), created_by=email, updated_by=email)
+                        for file in files]
+                session.add_all(jobs)
+                await session.flush()
+                res = [job.json for job in jobs]
+        except Exception as e:
+            logger.exception(f"取り込みジョブを登録する際に、エラーが発生します。: {str(e)}")
+            raise ServiceException("取り込みジョブを登録する際に、エラーが発生します。", status_code=500)
+        metrics.increment("ingestion.enqueued", len(res))
+        self.wakeup.set()
+        return res
+
+    async def getProgress(self, file_ids: List[str]) -> List[dict[str, Any]]:
+        """Status of the given files with their latest job."""
+        try:
+            async with get_db_session() as session:
+                files = (await session.execute(
+                    select(file_models.File).where(file_models.File.id.in_(file_ids)))).scalars().all()
+                jobs = (await session.execute(
+                    select(IngestionJob).where(IngestionJob.file_id.in_(file_ids))
+                    .order_by(desc(IngestionJob.id)))).scalars().all()
+        except Exception as e:
+            logger.exception(f"取り込み状況を取得する際に、エラーが発生します。: {str(e)}")
+            raise ServiceException("取り込み状況を取得する際に、エラーが発生します。", status_code=500)
+        latest: dict[str, IngestionJob] = {}
+        for job in jobs:
+            latest.setdefault(job.file_id, job)
+        res = []
+        for file in files:
+            job = latest.get(file.id)
+            res.append({
+                "file_id": file.id,
+                "name": file.name,
+                "status": file.status,
+                "chunk_count": file.chunk_count,
+                "job": None if job is None else {
+                    "id": job.id,
+                    "status": job.status,
+                    "stage": job.stage,
+                    "progress": job.progress,
+                    "attempts": job.attempts,
+                    "last_error": job.last_error,
+                },
+            })
+        return res
+
+    async def __work(self):
+        async with self.app.app_context():
+            while True:
+                # cleared before looking, so that a job enqueued meanwhile wakes us up
+                self.wakeup.clear()
+                try:
+                    job = await self.__claim()
+                except Exception as e:
+                    logger.exception(f"取り込みジョブを取得する際に、エラーが発生します。: {str(e)}")
+                    job = None
+                if job is None:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                try:
+                    await self.__run(job)
+                except Exception as e:
+                    # left running, queued again after job_timeout
+                    logger.exception(f"取り込みジョブを更新する際に、エラーが発生します。 {job.id}: {str(e)}")
+
+    async def __claim(self) -> Optional[IngestionJob]:
+        now = datetime.now()
+        await self.__expire_uploads(now)
+        async with get_db_session() as session:
+            # jobs whose worker went away
+            await session.execute(
+                update(IngestionJob)
+                .where(IngestionJob.status == JOB_RUNNING,
+                       IngestionJob.locked_at < now - timedelta(seconds=self.job_timeout))
+                .values(status=JOB_QUEUED, locked_by=None, locked_at=None, run_after=now))
+            await session.commit()
+
+            job_ids = (await session.execute(
+                select(IngestionJob.id)
+                .where(IngestionJob.status == JOB_QUEUED, IngestionJob.run_after <= now)
+                .order_by(IngestionJob.id).limit(self.workers))).scalars().all()
+            for job_id in job_ids:
+                result = await session.execute(
+                    update(IngestionJob)
+                    .where(IngestionJob.id == job_id, IngestionJob.status == JOB_QUEUED)
+                    .values(status=JOB_RUNNING, attempts=IngestionJob.attempts + 1,
+                            locked_by=self.worker_id, locked_at=now, updated_by=WORKER_ACCOUNT))
+                await session.commit()
+                if result.rowcount == 1:
+                    return (await session.execute(
+                        select(IngestionJob).where(IngestionJob.id == job_id))).scalars().first()
+                # claimed by another worker
+                metrics.increment("ingestion.claim_conflicts")
+        return None
+
+    async def __expire_uploads(self, now: datetime):
+        async with get_db_session() as session:
+            file_ids = (await session.execute(
+                select(file_models.File.id)
+                .where(file_models.File.status == FILE_STATUS_UPLOADING,
+                       file_models.File.file_size_mb.is_(None),
+                       file_models.File.upload_expires_at < now - timedelta(seconds=self.upload_grace)))
+            ).scalars().all()
+            for file_id in file_ids:
+                # unless completed or expired by another worker meanwhile
+                result = await session.execute(
+                    update(file_models.File)
+                    .where(file_models.File.id == file_id, file_models.File.status == FILE_STATUS_UPLOADING,
+                           file_models.File.file_size_mb.is_(None))
+                    .values(status=FILE_STATUS_FAILURE, updated_by=WORKER_ACCOUNT))
+                await session.commit()
+                if result.rowcount == 1:
+                    logger.warning("Upload of file %s expired before it was completed", file_id)
+                    metrics.increment("ingestion.uploads_expired")
+                    await self.file_service.deleteUpload(file_id)
+
+    async def __run(self, job: IngestionJob):
+        async with get_db_session() as session:
+            file = (await session.execute(
+                select(file_models.File).where(file_models.File.id == job.file_id))).scalars().first()
+        if file is None:
+            self.file_service.releaseUpload(job.file_id)
+            await self.__finish(job.id, JOB_FAILED, "ファイルが削除されました。")
+            return
+        if job.attempts > self.max_attempts:
+            await self.__fail(job, file, "試行回数の上限に達しました。", retry=False)
+            return
+        if os.path.splitext(file.name)[1] not in self.file_service.file_processors:
+            await self.__fail(job, file, "ファイル形式またはファイル拡張子が正しくありません。", retry=False)
+            return
+
+        logger.info("Ingesting file %s (job %d, attempt %d)", file.id, job.id, job.attempts)
+        started = datetime.now()
+        try:
+            await self.__progress(job.id, JOB_STAGE_PARSING, 0)
+            sections = await self.file_service.parse_file(file, job.category)
+            await self.__progress(job.id, JOB_STAGE_INDEXING, PARSED_PROGRESS)
+
+            async def on_progress(done: int, total: int):
+                await self.__progress(job.id, JOB_STAGE_INDEXING,
+                                      PARSED_PROGRESS + (100 - PARSED_PROGRESS) * done // total)
+
+            if sections:
+                await self.search_manager.update_content(sections, on_progress=on_progress)
+        except Exception as e:
+            logger.exception(f"ファイルを取り込む際に、エラーが発生します。 {file.id}: {str(e)}")
+            await self.__fail(job, file, str(e), retry=True)
+            return
+
+        self.file_service.releaseUpload(file.id)
+        if not await self.__succeed(job, file, len(sections)):
+            # deleted while it was being indexed
+            await self.search_manager.remove_files([file])
+        metrics.increment("ingestion.succeeded")
+        metrics.increment("ingestion.seconds", (datetime.now() - started).total_seconds())
+
+    async def __progress(self, job_id: int, stage: str, progress: int):
+        async with db_transaction() as session:
+            await session.execute(
+                update(IngestionJob).where(IngestionJob.id == job_id)
+                .values(stage=stage, progress=progress, updated_by=WORKER_ACCOUNT))
+
+    async def __succeed(self, job: IngestionJob, file: file_models.File, chunk_count: int) -> bool:
+        async with db_transaction() as session:
+            result = await session.execute(
+                update(file_models.File).where(file_models.File.id == file.id)
+                .values(status=FILE_STATUS_SUCCESS, chunk_count=chunk_count, updated_by=WORKER_ACCOUNT))
+            await session.execute(
+                update(IngestionJob).where(IngestionJob.id == job.id)
+                .values(status=JOB_SUCCEEDED, stage=None, progress=100, last_error=None,
+                        locked_by=None, locked_at=None, updated_by=WORKER_ACCOUNT))
+        logger.info("Ingested file %s into %d sections (job %d)", file.id, chunk_count, job.id)
+        return result.rowcount == 1
+
+    async def __fail(self, job: IngestionJob, file: file_models.File, error: str, retry: bool):
+        if retry and job.attempts < self.max_attempts:
+            delay = self.retry_backoff * 2 ** (job.attempts - 1)
+            async with db_transaction() as session:
+                await session.execute(
+                    update(IngestionJob).where(IngestionJob.id == job.id)
+                    .values(status=JOB_QUEUED, last_error=error[:1000], locked_by=None, locked_at=None,
+                            run_after=datetime.now() + timedelta(seconds=delay), updated_by=WORKER_ACCOUNT))
+            logger.warning("Ingestion of file %s failed (attempt %d), retrying in %ds",
+                           file.id, job.attempts, delay)
+            metrics.increment("ingestion.retried")
+            return
+        self.file_service.releaseUpload(file.id)
+        async with db_transaction() as session:
+            await session.execute(
+                update(file_models.File)
+                .where(file_models.File.id == file.id, file_models.File.status == FILE_STATUS_UPLOADING)
+                .values(status=FILE_STATUS_FAILURE, updated_by=WORKER_ACCOUNT))
+        await self.__finish(job.id, JOB_FAILED, error)
+
+    async def __finish(self, job_id: int, status: str, error: str):
+        async with db_transaction() as session:
+            await session.execute(
+                update(IngestionJob).where(IngestionJob.id == job_id)
+                .values(status=status, last_error=error[:1000],
+                        locked_by=None, locked_at=None, updated_by=WORKER_ACCOUNT))
+        metrics.increment("ingestion.failed")
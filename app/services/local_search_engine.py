@@ -0,0 +1,187 @@
+import re
+import math
+import asyncio
+from collections import Counter, OrderedDict
+from typing import Any, Awaitable, Callable, List, Optional
+import numpy as np
+from azure.search.documents.models import VectorizedQuery, VectorQuery
+from app.utils import metrics
+
+# latin words and digits, and runs of CJK characters (split into bigrams)
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+")
+# constant of reciprocal rank fusion, as used by Azure AI Search hybrid queries
+RRF_K = 60
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token.isascii() or len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i: i + 2] for i in range(len(token) - 1))
+    return tokens
+
+
+class LocalChunk:
+    """A section held in memory: its search document fields, vector and term frequencies."""
+
+    def __init__(self, fields: dict[str, Any], vector: List[float]):
+        self.fields = fields
+        self.vector = np.asarray(vector, dtype=np.float32)
+        self.terms = Counter(tokenize(fields.get("content") or ""))
+        self.length = sum(self.terms.values())
+
+
+class LocalSearchEngine:
+    """
+    Hybrid search over the sections of a few files, in process: cosine
+    similarity over the chunk embeddings and BM25 over the content, fused with
+    reciprocal rank fusion like an Azure AI Search hybrid query. There is no
+    semantic ranker, so documents come back without captions or reranker score.
+
+    Sections are kept per file in an LRU bounded by `max_chunks`. Files that are
+    not held yet are fetched with `load(file_ids)`, which returns the search
+    documents of those files with their "embedding". A file is only held once
+    all of its `chunk_count` sections were loaded (the index lags behind
+    ingestion), until then it is loaded again on every search.
+    """
+
+    def __init__(self, load: Callable[[List[str]], Awaitable[List[dict[str, Any]]]], max_chunks: int = 20000):
+        self.load = load
+        self.max_chunks = max_chunks
+        self.files: OrderedDict[str, List[LocalChunk]] = OrderedDict()
+        self.chunk_count = 0
+        self.lock = asyncio.Lock()
+
+    def add(self, documents: List[dict[str, Any]]):
+        """Holds the given documents, replacing whatever was held for their files."""
+        by_file: dict[str, List[LocalChunk]] = {}
+        for document in documents:
+            fields = {k: v for k, v in document.items() if k != "embedding"}
+            by_file.setdefault(document["file_id"], []).append(
+                LocalChunk(fields, document["embedding"]))
+        for file_id, chunks in by_file.items():
+            self.remove([file_id])
+            self.files[file_id] = chunks
+            self.chunk_count += len(chunks)
+        while self.chunk_count > self.max_chunks and len(self.files) > 1:
+            _, chunks = self.files.popitem(last=False)
+            self.chunk_count -= len(chunks)
+
+    def remove(self, file_ids: List[str]):
+        for file_id in file_ids:
+            chunks = self.files.pop(file_id, None)
+            if chunks is not None:
+                self.chunk_count -= len(chunks)
+
+    def holds(self, file_ids: List[str]) -> bool:
+        return all(file_id in self.files for file_id in file_ids)
+
+    async def search(
+        self,
+        top: int,
+        query_text: Optional[str],
+        chunk_counts: dict[str, int],
+        vectors: List[VectorQuery],
+        minimum_search_score: Optional[float] = 0.0,
+        select: Optional[List[str]] = None,
+    ) -> Optional[List[dict[str, Any]]]:
+        """
+        Returns the `top` best sections of the files of `chunk_counts` (file id: number
+        of sections) as search documents (with `@search.score`), or None when not all
+        of their sections could be loaded.
+        """
+        chunks = await self.__chunks(chunk_counts)
+        if chunks is None:
+            metrics.increment("search.local.incomplete")
+            return None
+        if not chunks:
+            return []
+
+        rankings = []
+        for vector_query in vectors:
+            if isinstance(vector_query, VectorizedQuery):
+                rankings.append(self.__vector_ranking(chunks, vector_query))
+        if query_text:
+            rankings.append(self.__bm25_ranking(chunks, query_text))
+
+        scores: dict[int, float] = {}
+        for ranking in rankings:
+            for rank, index in enumerate(ranking):
+                scores[index] = scores.get(index, 0.0) + 1 / (RRF_K + rank + 1)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+        documents = []
+        for index, score in best:
+            if score < (minimum_search_score or 0):
+                continue
+            chunk = chunks[index]
+            document = {k: v for k, v in chunk.fields.items() if not select or k in select}
+            if select and "embedding" in select:
+                document["embedding"] = chunk.vector.tolist()
+            document["@search.score"] = score
+            documents.append(document)
+            if len(documents) == top:
+                break
+        metrics.increment("search.local")
+        return documents
+
+    async def __chunks(self, chunk_counts: dict[str, int]) -> Optional[List[LocalChunk]]:
+        missing = [file_id for file_id in chunk_counts if file_id not in self.files]
+        if missing:
+            async with self.lock:
+                missing = [file_id for file_id in missing if file_id not in self.files]
+                if missing:
+                    loaded: dict[str, List[dict[str, Any]]] = {file_id: [] for file_id in missing}
+                    for document in await self.load(missing):
+                        loaded.setdefault(document["file_id"], []).append(document)
+                    complete = [file_id for file_id in missing if len(loaded[file_id]) == chunk_counts[file_id]]
+                    self.add([document for file_id in complete for document in loaded[file_id]])
+                    # files without sections are held too, so they are not loaded again
+                    for file_id in complete:
+                        self.files.setdefault(file_id, [])
+                    metrics.increment("search.local.files_loaded", len(complete))
+                    if len(complete) < len(missing):
+                        return None
+        chunks = []
+        for file_id in chunk_counts:
+            if file_id not in self.files:
+                # evicted meanwhile
+                return None
+            self.files.move_to_end(file_id)
+            chunks.extend(self.files[file_id])
+        return chunks
+
+    @staticmethod
+    def __vector_ranking(chunks: List[LocalChunk], vector_query: VectorizedQuery) -> List[int]:
+        matrix = np.stack([chunk.vector for chunk in chunks])
+        query = np.asarray(vector_query.vector, dtype=np.float32)
+        similarities = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+        order = np.argsort(-similarities)
+        return order[: vector_query.k_nearest_neighbors or len(chunks)].tolist()
+
+    @staticmethod
+    def __bm25_ranking(chunks: List[LocalChunk], query_text: str) -> List[int]:
+        terms = set(tokenize(query_text))
+        if not terms:
+            return []
+        average_length = sum(chunk.length for chunk in chunks) / len(chunks) or 1
+        document_frequency = {term: sum(1 for chunk in chunks if term in chunk.terms) for term in terms}
+        scores = []
+        for index, chunk in enumerate(chunks):
+            score = 0.0
+            for term in terms:
+                frequency = chunk.terms.get(term, 0)
+                if not frequency:
+                    continue
+                idf = math.log(1 + (len(chunks) - document_frequency[term] + 0.5) /
+                               (document_frequency[term] + 0.5))
+                score += idf * frequency * (BM25_K1 + 1) / (
+                    frequency + BM25_K1 * (1 - BM25_B + BM25_B * chunk.length / average_length))
+            if score > 0:
+                scores.append((score, index))
+        scores.sort(reverse=True)
+        return [index for _, index in scores]
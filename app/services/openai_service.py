@@ -1,53 +1,68 @@
 import re
 import json
+import asyncio
 import tiktoken
-from uuid import uuid1
 from quart import current_app
-from typing import List
-from azure.cosmos import PartitionKey
-from tenacity import (
-    AsyncRetrying,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_random_exponential,
-)
+from typing import AsyncGenerator, List, Optional
 from openai.types.chat import (
     ChatCompletion,
+    ChatCompletionChunk,
     ChatCompletionMessageParam,
     ChatCompletionToolParam,
 )
 from azure.search.documents.models import VectorizedQuery
 
-from openai import RateLimitError
-from openai_messages_token_helper import build_messages, get_token_limit
-from app.extensions import get_openai_client, get_cosmos_client
+from openai import NOT_GIVEN, AsyncStream
+from app.extensions import get_openai_client
+from app.services.chat_content_repository import ChatContentRepository
+from app.services.embedding_cache import EmbeddingCache, embedding_model_key
+from app.services.embedding_dispatcher import EmbeddingBatch, EmbeddingDispatcher
+from app.services.prompt_assembler import PromptAssembler, Source, TokenCounter
+from app.services.retry_policy import RetryPolicy
+from app.services.token_ledger import TokenLedger
 from app.utils.log_utils import get_logger
 from app.exceptions.service_exception import ServiceException
 from openai.types.chat import ChatCompletionMessageParam
-from app.constants import GPT_4O_MODEL, EMBEDING_MODEL, CHAT_CONTAINER
+from app.constants import GPT_4O_MODEL, EMBEDING_MODEL
 
 logger = get_logger("aoai_backend")
 
-
-class EmbeddingBatch:
-    """
-    Represents a batch of text that is going to be embedded
-    """
-
-    def __init__(self, texts: List[str], token_length: int):
-        self.texts = texts
-        self.token_length = token_length
+ANSWER_RESPONSE_TOKEN_LIMIT = 2048
 
 
 class OpenaiService():
 
-    def __init__(self):
-        self.openai_client = get_openai_client()
+    def __init__(self, chat_content_repository: Optional[ChatContentRepository] = None,
+                 embedding_cache: Optional[EmbeddingCache] = None,
+                 prompt_assembler: Optional[PromptAssembler] = None,
+                 token_ledger: Optional[TokenLedger] = None):
+        # retries are handled by RetryPolicy instead of the SDK
+        self.openai_client = get_openai_client().with_options(max_retries=0)
         self.openai_model = current_app.config["OPENAI_MODEL"]
-        cosmos_db = get_cosmos_client().create_database_if_not_exists(
-            id=current_app.config["COSMOSDB_DATABASE"])
-        self.chat_cosmos = cosmos_db.create_container_if_not_exists(id=CHAT_CONTAINER,
-                                                                    partition_key=PartitionKey(path="/type"))
+        self.chat_content_repository = chat_content_repository
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self.prompt_assembler = prompt_assembler or PromptAssembler(
+            TokenCounter(), response_tokens=ANSWER_RESPONSE_TOKEN_LIMIT,
+            sources_budget=current_app.config.get("PROMPT_SOURCES_TOKEN_BUDGET", 3000),
+            history_budget=current_app.config.get("PROMPT_HISTORY_TOKEN_BUDGET"))
+        self.token_ledger = token_ledger
+        # reduced output size, text-embedding-3 deployments only
+        self.embedding_dimensions = current_app.config.get(
+            "AZURE_OPENAI_EMBEDDING_DIMENSIONS") or NOT_GIVEN
+        self.search_knn = current_app.config.get("SEARCH_KNN", 50)
+        self.embedding_retry_policy = RetryPolicy(
+            "embeddings", deadline=current_app.config.get("AZURE_OPENAI_EMBEDDING_RETRY_DEADLINE", 300))
+        self.completion_retry_policy = RetryPolicy(
+            "completions", deadline=current_app.config.get("AZURE_OPENAI_COMPLETION_RETRY_DEADLINE", 60))
+        self.embedding_dispatcher = EmbeddingDispatcher(
+            self.embedding_retry_policy,
+            tokens_per_minute=current_app.config.get(
+                "AZURE_OPENAI_EMBEDDING_TPM"),
+            requests_per_minute=current_app.config.get(
+                "AZURE_OPENAI_EMBEDDING_RPM"),
+            max_concurrency=current_app.config.get(
+                "AZURE_OPENAI_EMBEDDING_MAX_CONCURRENCY", 4),
+        )
 
     def __calculate_token_length(self, text: str):
         encoding = tiktoken.encoding_for_model(
@@ -86,53 +101,55 @@ class OpenaiService():
 
         return batches
 
-    def __before_retry_sleep(self, retry_state):
-        logger.info(
-            "Rate limited on the OpenAI embeddings API, sleeping before retrying...")
+    @property
+    def embedding_model_key(self) -> str:
+        """Identifies the vectors this service produces, for caches keyed by model."""
+        return embedding_model_key(
+            self.openai_model[EMBEDING_MODEL],
+            None if self.embedding_dimensions is NOT_GIVEN else self.embedding_dimensions)
+
+    def estimate_embedding_usage(self, texts: List[str]) -> tuple[int, int]:
+        """Tokens and requests that create_embedding_batch would spend on `texts`."""
+        batches = self.__split_text_into_batches(texts)
+        return sum(batch.token_length for batch in batches), len(batches)
 
     async def create_embedding_batch(self, texts: List[str]) -> List[List[float]]:
         try:
             batches = self.__split_text_into_batches(texts)
-            embeddings = []
-            for batch in batches:
-                async for attempt in AsyncRetrying(
-                    retry=retry_if_exception_type(RateLimitError),
-                    wait=wait_random_exponential(min=15, max=60),
-                    stop=stop_after_attempt(15),
-                    before_sleep=self.__before_retry_sleep,
-                ):
-                    with attempt:
-                        emb_response = await self.openai_client.embeddings.create(
-                            model=self.openai_model[EMBEDING_MODEL], input=batch.texts
-                        )
-                        embeddings.extend(
-                            [data.embedding for data in emb_response.data])
-                        logger.info(
-                            "Computed embeddings in batch. Batch size: %d, Token count: %d",
-                            len(batch.texts),
-                            batch.token_length,
-                        )
-            return embeddings
+            return await self.embedding_dispatcher.dispatch(batches, self.__embed_batch)
         except Exception as e:
             logger.exception(f"エンベディング（バッチ）する際にエラーが発生します。: {e}")
             raise ServiceException(
                 "エンベディング（バッチ）する際にエラーが発生します。", status_code=500)
 
+    async def __embed_batch(self, batch: EmbeddingBatch) -> List[List[float]]:
+        emb_response = await self.openai_client.embeddings.create(
+            model=self.openai_model[EMBEDING_MODEL], input=batch.texts,
+            dimensions=self.embedding_dimensions
+        )
+        logger.info(
+            "Computed embeddings in batch. Batch size: %d, Token count: %d",
+            len(batch.texts),
+            batch.token_length,
+        )
+        return [data.embedding for data in emb_response.data]
+
+    async def __embed_text(self, text: str, retry_policy: RetryPolicy) -> List[float]:
+        async def compute():
+            emb_response = await retry_policy.call(
+                lambda: self.openai_client.embeddings.create(
+                    model=self.openai_model[EMBEDING_MODEL], input=text,
+                    dimensions=self.embedding_dimensions
+                ))
+            logger.info(
+                "Computed embedding for text section. Character count: %d", len(text))
+            return emb_response.data[0].embedding
+
+        return await self.embedding_cache.get_or_compute(self.embedding_model_key, text, compute)
+
     async def create_embedding_single(self, text: str) -> List[float]:
         try:
-            async for attempt in AsyncRetrying(
-                retry=retry_if_exception_type(RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
-                stop=stop_after_attempt(15),
-                before_sleep=self.__before_retry_sleep,
-            ):
-                with attempt:
-                    emb_response = await self.openai_client.embeddings.create(
-                        model=self.openai_model[EMBEDING_MODEL], input=text
-                    )
-                    logger.info(
-                        "Computed embedding for text section. Character count: %d", len(text))
-            return emb_response.data[0].embedding
+            return await self.__embed_text(text, self.embedding_retry_policy)
         except Exception as e:
             logger.exception(f"エンベディング（シングル）する際にエラーが発生します。: {e}")
             raise ServiceException(
@@ -140,18 +157,14 @@ class OpenaiService():
 
     async def compute_text_embedding(self, q: str):
         try:
-            embedding = await self.openai_client.embeddings.create(
-                model=self.openai_model[EMBEDING_MODEL],
-                input=q
-            )
-            query_vector = embedding.data[0].embedding
-            return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="embedding")
+            query_vector = await self.__embed_text(q, self.completion_retry_policy)
+            return VectorizedQuery(vector=query_vector, k_nearest_neighbors=self.search_knn, fields="embedding")
         except Exception as e:
             logger.exception(f"エンベディング（検索）する際にエラーが発生します。: {e}")
             raise ServiceException(
                 "エンベディングする際にエラーが発生します。", status_code=500)
 
-    async def generateSearchQuery(self, history) -> str:
+    async def generateSearchQuery(self, history, turn_tokens: Optional[List[int]] = None) -> str:
         NO_RESPONSE = "0"
         query_prompt_template = """Below is a history of the conversation so far, and a new question asked by the user that needs to be answered by searching in a knowledge base.
         You have access to Azure AI Search index with 100's of documents.
@@ -188,31 +201,21 @@ class OpenaiService():
                 },
             }
         ]
-        messages: list[ChatCompletionMessageParam] = []
         try:
-            for item in history[:-1]:
-                messages.append({"role": "user", "content": item["user"]})
-                messages.append({"role": "assistant", "content": item["bot"]})
             user_query_request = "Generate search query for: " + \
                 history[-1]["user"]
-            query_messages = build_messages(
-                model=GPT_4O_MODEL,
-                system_prompt=query_prompt_template,
-                tools=tools,
-                few_shots=query_prompt_few_shots,
-                past_messages=messages,
-                new_user_content=user_query_request,
-                max_tokens=get_token_limit(
-                    GPT_4O_MODEL) - query_response_token_limit,
-            )
-            chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-                messages=query_messages,
-                model=self.openai_model[GPT_4O_MODEL],
-                temperature=0.0,
-                max_tokens=query_response_token_limit,
-                n=1,
-                tools=tools,
-            )
+            query_messages = self.prompt_assembler.build_query(
+                query_prompt_template, query_prompt_few_shots, tools, history,
+                user_query_request, query_response_token_limit, turn_tokens)
+            chat_completion: ChatCompletion = await self.completion_retry_policy.call(
+                lambda: self.openai_client.chat.completions.create(
+                    messages=query_messages,
+                    model=self.openai_model[GPT_4O_MODEL],
+                    temperature=0.0,
+                    max_tokens=query_response_token_limit,
+                    n=1,
+                    tools=tools,
+                ))
             response_message = chat_completion.choices[0].message
             if response_message.tool_calls:
                 for tool in response_message.tool_calls:
@@ -234,53 +237,93 @@ class OpenaiService():
             raise ServiceException(
                 "検索内容を生成する際にエラーが発生します。", status_code=500)
 
-    async def answerQueation(self, chat_id, chat_type, history, sources):
+    def __build_answer_messages(self, history, sources: List[Source],
+                                turn_tokens: Optional[List[int]]) -> list[ChatCompletionMessageParam]:
         system_message = """You are an assistant. Please provide helpful, accurate, and concise responses based on the conversation history and the user's last question.
         If asking a clarifying question to the user would help, ask the question.
         If the question is not in English, answer in the language used in the question."""
 
-        messages: list[ChatCompletionMessageParam] = []
-        try:
-            # Loop through the chat history except the last message
-            for item in history[:-1]:
-                messages.append({"role": "user", "content": item["user"]})
-                messages.append({"role": "assistant", "content": item["bot"]})
+        return self.prompt_assembler.build(system_message, history, sources, turn_tokens=turn_tokens)
 
-            response_token_limit = 2048
-            new_user_content = history[-1]["user"] if not sources else history[-1]["user"] + \
-                "\n\nSources:\n" + sources
+    async def __save_chat_content(self, chat_id, chat_type, history, answer):
+        if self.token_ledger is None:
+            await self.chat_content_repository.add(
+                chat_id, chat_type, len(history), history[-1]["user"], answer)
+            return
+        turn = self.token_ledger.record(chat_id, len(history), history[-1]["user"], answer)
+        await self.chat_content_repository.add(
+            chat_id, chat_type, len(history), history[-1]["user"], answer,
+            question_tokens=turn.user_tokens, answer_tokens=turn.bot_tokens)
 
-            queation_messages = build_messages(
-                model=GPT_4O_MODEL,
-                system_prompt=system_message,
-                past_messages=messages,
-                new_user_content=new_user_content,
-                max_tokens=get_token_limit(
-                    GPT_4O_MODEL) - response_token_limit,
-            )
-            # Add the last user message
-            messages.append({"role": "user", "content": history[-1]["user"]})
-            completion = await self.openai_client.beta.chat.completions.parse(
-                model=self.openai_model[GPT_4O_MODEL],
-                messages=queation_messages,
-                temperature=0.3,
-                max_tokens=response_token_limit
-            )
+    async def answerQueation(self, chat_id, chat_type, history, sources: List[Source],
+                             turn_tokens: Optional[List[int]] = None):
+        try:
+            queation_messages = self.__build_answer_messages(history, sources, turn_tokens)
+            completion = await self.completion_retry_policy.call(
+                lambda: self.openai_client.beta.chat.completions.parse(
+                    model=self.openai_model[GPT_4O_MODEL],
+                    messages=queation_messages,
+                    temperature=0.3,
+                    max_tokens=ANSWER_RESPONSE_TOKEN_LIMIT
+                ))
             answer = completion.choices[0].message.content
             # save the chat content
-            chat_content = {"id": str(uuid1()),
-                            "type": chat_type,
-                            "chat_id": chat_id,
-                            "index": len(history),
-                            "question": history[-1]["user"],
-                            "answer": answer}
-            self.chat_cosmos.create_item(chat_content)
+            await self.__save_chat_content(chat_id, chat_type, history, answer)
             return answer
         except Exception as e:
             logger.exception(f"回答を生成する際にエラーが発生します。: {e}")
             raise ServiceException(
                 "回答を生成する際にエラーが発生します。", status_code=500)
 
+    async def answerQueationStream(self, chat_id, chat_type, history, sources: List[Source],
+                                   turn_tokens: Optional[List[int]] = None) -> AsyncGenerator[str, None]:
+        """
+        Streams the answer as it is generated, yielding each content delta.
+        The completed answer is saved once the stream ends. When the consumer
+        goes away mid-stream the upstream response is closed and nothing is saved.
+        """
+        try:
+            queation_messages = self.__build_answer_messages(history, sources, turn_tokens)
+            # only opening the stream is retried, a broken stream is not resumed
+            stream: AsyncStream[ChatCompletionChunk] = await self.completion_retry_policy.call(
+                lambda: self.openai_client.chat.completions.create(
+                    model=self.openai_model[GPT_4O_MODEL],
+                    messages=queation_messages,
+                    temperature=0.3,
+                    max_tokens=ANSWER_RESPONSE_TOKEN_LIMIT,
+                    stream=True
+                ))
+        except Exception as e:
+            logger.exception(f"回答を生成する際にエラーが発生します。: {e}")
+            raise ServiceException(
+                "回答を生成する際にエラーが発生します。", status_code=500)
+
+        answer_parts: list[str] = []
+        try:
+            async for chunk in stream:
+                # Azure sends chunks without choices for content filter results
+                if chunk.choices and chunk.choices[0].delta.content:
+                    delta = chunk.choices[0].delta.content
+                    answer_parts.append(delta)
+                    yield delta
+        except (asyncio.CancelledError, GeneratorExit):
+            logger.info("回答のストリーミング中にクライアントが切断しました。chat_id: %s", chat_id)
+            raise
+        except Exception as e:
+            logger.exception(f"回答を生成する際にエラーが発生します。: {e}")
+            raise ServiceException(
+                "回答を生成する際にエラーが発生します。", status_code=500)
+        finally:
+            await stream.close()
+
+        try:
+            await self.__save_chat_content(
+                chat_id, chat_type, history, "".join(answer_parts))
+        except Exception as e:
+            logger.exception(f"回答を保存する際にエラーが発生します。: {e}")
+            raise ServiceException(
+                "回答を保存する際にエラーが発生します。", status_code=500)
+
     async def generateChatName(self, history, answer) -> str:
         try:
             system_message = """You are tasked with creating a brief and precise title based on the conversation. The title should be clear, directly related to the discussion, and must not exceed 20 characters."""
@@ -288,12 +331,13 @@ class OpenaiService():
             messages.append({"role": "system", "content": system_message})
             messages.append({"role": "user", "content": history[-1]["user"]})
             messages.append({"role": "assistant", "content": answer})
-            completion = await self.openai_client.beta.chat.completions.parse(
-                model=self.openai_model[GPT_4O_MODEL],
-                messages=messages,
-                temperature=0.3,
-                max_tokens=50
-            )
+            completion = await self.completion_retry_policy.call(
+                lambda: self.openai_client.beta.chat.completions.parse(
+                    model=self.openai_model[GPT_4O_MODEL],
+                    messages=messages,
+                    temperature=0.3,
+                    max_tokens=50
+                ))
             title = completion.choices[0].message.content
             return title
         except Exception as e:
@@ -0,0 +1,185 @@
+import json
+import hashlib
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import List, Optional
+import tiktoken
+from openai.types.chat import ChatCompletionMessageParam
+from openai_messages_token_helper import get_token_limit
+from app.constants import GPT_4O_MODEL
+from app.utils import metrics
+from app.utils.commom import nonewlines
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+# tokens the chat format adds around every message, and to prime the reply
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+# a trimmed source shorter than this is not worth its tokens
+MIN_TRIMMED_SOURCE_TOKENS = 50
+
+
+class TokenCounter:
+    """Counts tokens with the model's tokenizer, caching the counts of recently seen texts."""
+
+    def __init__(self, model: str = GPT_4O_MODEL, maxsize: int = 4096):
+        self.encoding = tiktoken.encoding_for_model(model)
+        self.maxsize = maxsize
+        self.counts: OrderedDict[bytes, int] = OrderedDict()
+
+    def count(self, text: str) -> int:
+        key = hashlib.sha1(text.encode("utf-8")).digest()
+        count = self.counts.get(key)
+        if count is not None:
+            self.counts.move_to_end(key)
+            metrics.increment("token_counter.hit")
+            return count
+        metrics.increment("token_counter.miss")
+        count = len(self.encoding.encode(text))
+        self.counts[key] = count
+        while len(self.counts) > self.maxsize:
+            self.counts.popitem(last=False)
+        return count
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return self.encoding.decode(self.encoding.encode(text)[:max_tokens])
+
+
+@dataclass
+class Source:
+    """A source for the answer prompt, ranked by `score` (reranker score when available)."""
+    sourcepage: str
+    text: str
+    score: float = 0.0
+
+    def render(self) -> str:
+        return self.sourcepage + ": " + nonewlines(self.text)
+
+
+@dataclass
+class PromptStats:
+    system_tokens: int = 0
+    history_tokens: int = 0
+    question_tokens: int = 0
+    sources_tokens: int = 0
+    history_turns: int = 0
+    history_turns_dropped: int = 0
+    sources: int = 0
+    sources_dropped: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.system_tokens + self.history_tokens + self.question_tokens + self.sources_tokens + REPLY_OVERHEAD
+
+
+class PromptAssembler:
+    """
+    Builds the answer prompt within the model's context window minus
+    `response_tokens`, with separate budgets: the system prompt and the question
+    are always kept, sources get up to `sources_budget` tokens (lowest score
+    dropped or trimmed first) and history gets the rest, capped by
+    `history_budget`, dropping the oldest turns first. Sizes are logged per
+    request and summed in the metrics as `prompt.*`.
+    """
+
+    def __init__(self, token_counter: TokenCounter, model: str = GPT_4O_MODEL, response_tokens: int = 2048,
+                 sources_budget: int = 3000, history_budget: Optional[int] = None):
+        self.token_counter = token_counter
+        self.response_tokens = response_tokens
+        self.context_tokens = get_token_limit(model) - response_tokens
+        self.sources_budget = sources_budget
+        self.history_budget = history_budget
+
+    def build(self, system_prompt: str, history, sources: List[Source],
+              stats: Optional[PromptStats] = None,
+              turn_tokens: Optional[List[int]] = None) -> list[ChatCompletionMessageParam]:
+        """`turn_tokens` are the tokens of the past turns when known (see TokenLedger)."""
+        stats = stats if stats is not None else PromptStats()
+        count = self.token_counter.count
+        question = history[-1]["user"]
+        stats.system_tokens = count(system_prompt) + MESSAGE_OVERHEAD
+        stats.question_tokens = count(question) + MESSAGE_OVERHEAD
+        available = self.context_tokens - stats.system_tokens - stats.question_tokens - REPLY_OVERHEAD
+
+        sources_content = self.__pack_sources(sources, min(self.sources_budget, max(available, 0)), stats)
+        available -= stats.sources_tokens
+
+        history_budget = available if self.history_budget is None else min(available, self.history_budget)
+        past_messages = self.fit_history(history, history_budget, stats, turn_tokens)
+
+        new_user_content = question if not sources_content else question + "\n\nSources:\n" + sources_content
+        self.__record(stats)
+        return [{"role": "system", "content": system_prompt},
+                *past_messages,
+                {"role": "user", "content": new_user_content}]
+
+    def build_query(self, system_prompt: str, few_shots: list[ChatCompletionMessageParam], tools: list,
+                    history, new_user_content: str, response_tokens: int,
+                    turn_tokens: Optional[List[int]] = None) -> list[ChatCompletionMessageParam]:
+        """Messages of a tool call prompt (e.g. the search query), keeping as much history as fits."""
+        count = self.token_counter.count
+        used = count(system_prompt) + count(json.dumps(tools)) + count(new_user_content) + \
+            sum(count(message["content"]) for message in few_shots) + \
+            (len(few_shots) + 2) * MESSAGE_OVERHEAD + REPLY_OVERHEAD
+        budget = self.context_tokens + self.response_tokens - response_tokens - used
+        past_messages = self.fit_history(history, budget, PromptStats(), turn_tokens)
+        return [{"role": "system", "content": system_prompt},
+                *few_shots,
+                *past_messages,
+                {"role": "user", "content": new_user_content}]
+
+    def fit_history(self, history, budget: int, stats: PromptStats,
+                    turn_tokens: Optional[List[int]] = None) -> list[ChatCompletionMessageParam]:
+        """The most recent past turns of `history` that fit in `budget` tokens, oldest first."""
+        past = history[:-1]
+        past_messages: list[ChatCompletionMessageParam] = []
+        for index in range(len(past) - 1, -1, -1):
+            item = past[index]
+            tokens = turn_tokens[index] if turn_tokens is not None and index < len(turn_tokens) else \
+                self.token_counter.count(item["user"]) + self.token_counter.count(item["bot"])
+            tokens += 2 * MESSAGE_OVERHEAD
+            if stats.history_tokens + tokens > budget:
+                break
+            stats.history_tokens += tokens
+            stats.history_turns += 1
+            past_messages[:0] = [{"role": "user", "content": item["user"]},
+                                 {"role": "assistant", "content": item["bot"]}]
+        stats.history_turns_dropped = len(past) - stats.history_turns
+        return past_messages
+
+    def __pack_sources(self, sources: List[Source], budget: int, stats: PromptStats) -> str:
+        packed = []
+        # "\n\nSources:\n" and the newlines between sources
+        used = self.token_counter.count("\n\nSources:\n") if sources else 0
+        for source in sorted(sources, key=lambda source: source.score, reverse=True):
+            rendered = source.render()
+            tokens = self.token_counter.count(rendered) + 1
+            if used + tokens > budget:
+                remaining = budget - used - 1
+                if remaining >= MIN_TRIMMED_SOURCE_TOKENS:
+                    packed.append(self.token_counter.truncate(rendered, remaining))
+                    used += remaining + 1
+                else:
+                    stats.sources_dropped += 1
+                continue
+            packed.append(rendered)
+            used += tokens
+        stats.sources = len(packed)
+        stats.sources_tokens = used if packed else 0
+        return "\n".join(packed)
+
+    @staticmethod
+    def __record(stats: PromptStats):
+        logger.info(
+            "Prompt: %d tokens (system %d, history %d in %d turns, %d turns dropped, "
+            "question %d, sources %d in %d sources, %d dropped)",
+            stats.total_tokens, stats.system_tokens, stats.history_tokens, stats.history_turns,
+            stats.history_turns_dropped, stats.question_tokens, stats.sources_tokens, stats.sources,
+            stats.sources_dropped)
+        metrics.increment("prompt.requests")
+        metrics.increment("prompt.tokens", stats.total_tokens)
+        metrics.increment("prompt.tokens.history", stats.history_tokens)
+        metrics.increment("prompt.tokens.sources", stats.sources_tokens)
+        metrics.increment("prompt.history_turns_dropped", stats.history_turns_dropped)
+        metrics.increment("prompt.sources_dropped", stats.sources_dropped)
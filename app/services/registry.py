@@ -0,0 +1,127 @@
+from quart import Quart, current_app
+from app.constants import CHAT_STORE_DUAL
+from app.extensions import get_async_cosmos_client
+from app.services.chat_content_repository import ChatContentRepository
+from app.services.chat_service import ChatService
+from app.services.chat_deletion_service import ChatDeletionService
+from app.services.context_assembler import ContextAssembler
+from app.services.embedding_cache import ChunkEmbeddingStore, EmbeddingCache, SqliteVectorStore
+from app.services.file_service import FileService
+from app.services.ingestion_queue import IngestionQueue
+from app.services.openai_service import ANSWER_RESPONSE_TOKEN_LIMIT, OpenaiService
+from app.services.prompt_assembler import PromptAssembler, TokenCounter
+from app.services.searchai_service import SearchManager
+from app.services.token_ledger import TokenLedger
+
+
+async def init_services(app: Quart):
+    """
+    Builds the app-scoped service instances once at startup.
+    Cosmos containers, blob container clients, file processors and splitters
+    are resolved here instead of on every request.
+    """
+    chat_content_repository = await ChatContentRepository.create(
+        get_async_cosmos_client(), app.config["COSMOSDB_DATABASE"],
+        app.config.get("CHAT_CONTENT_STORE_MODE", CHAT_STORE_DUAL))
+    embedding_cache_path = app.config.get("EMBEDDING_CACHE_PATH")
+    embedding_cache = EmbeddingCache(
+        maxsize=app.config.get("EMBEDDING_CACHE_SIZE", 1024),
+        disk_store=SqliteVectorStore(
+            embedding_cache_path, max_bytes=app.config.get("EMBEDDING_CACHE_MAX_MB", 256) * 1024 * 1024)
+        if embedding_cache_path else None)
+    # token counts are shared by the context and the prompt assembly
+    token_counter = TokenCounter(maxsize=app.config.get("TOKEN_COUNTER_CACHE_SIZE", 4096))
+    prompt_assembler = PromptAssembler(
+        token_counter, response_tokens=ANSWER_RESPONSE_TOKEN_LIMIT,
+        sources_budget=app.config.get("PROMPT_SOURCES_TOKEN_BUDGET", 3000),
+        history_budget=app.config.get("PROMPT_HISTORY_TOKEN_BUDGET"))
+    token_ledger = TokenLedger(chat_content_repository, token_counter,
+                               maxsize=app.config.get("TOKEN_LEDGER_SIZE", 1024))
+    openai_service = OpenaiService(chat_content_repository, embedding_cache, prompt_assembler, token_ledger)
+    app.config['token_ledger'] = token_ledger
+    app.config['chat_content_repository'] = chat_content_repository
+    app.config['openai_service'] = openai_service
+    app.config['chat_service'] = ChatService(chat_content_repository)
+    file_service = FileService()
+    chunk_embedding_store_path = app.config.get("CHUNK_EMBEDDING_STORE_PATH")
+    chunk_embedding_store = ChunkEmbeddingStore(SqliteVectorStore(
+        chunk_embedding_store_path,
+        max_bytes=app.config.get("CHUNK_EMBEDDING_STORE_MAX_MB", 1024) * 1024 * 1024)) \
+        if chunk_embedding_store_path else None
+    search_manager = SearchManager(
+        openai_service=openai_service, chunk_embedding_store=chunk_embedding_store)
+    app.config['file_service'] = file_service
+    app.config['search_manager'] = search_manager
+    app.config['context_assembler'] = ContextAssembler(
+        search_manager.stored_embeddings, token_counter,
+        max_sources=app.config.get("CONTEXT_MAX_SOURCES", 3),
+        mmr_lambda=app.config.get("CONTEXT_MMR_LAMBDA", 0.5),
+        candidates=app.config.get("CONTEXT_CANDIDATES", 10))
+    # workers are started with the server (see create_app)
+    app.config['ingestion_queue'] = IngestionQueue(
+        app, file_service, search_manager,
+        workers=app.config.get("INGESTION_WORKERS", 2),
+        max_attempts=app.config.get("INGESTION_MAX_ATTEMPTS", 3),
+        retry_backoff=app.config.get("INGESTION_RETRY_BACKOFF", 30),
+        poll_interval=app.config.get("INGESTION_POLL_INTERVAL", 5),
+        job_timeout=app.config.get("INGESTION_JOB_TIMEOUT", 1800),
+        upload_grace=app.config.get("INGESTION_UPLOAD_GRACE", 3600))
+    app.config['chat_deletion_service'] = ChatDeletionService(
+        file_service, search_manager, chat_content_repository,
+        max_concurrency=app.config.get("DELETION_MAX_CONCURRENCY", 8))
+
+
+def get_openai_service() -> OpenaiService:
+    service = current_app.config.get('openai_service')
+    if service is None:
+        raise RuntimeError('OpenaiService has not been initialized.')
+    return service
+
+
+def get_chat_service() -> ChatService:
+    service = current_app.config.get('chat_service')
+    if service is None:
+        raise RuntimeError('ChatService has not been initialized.')
+    return service
+
+
+def get_file_service() -> FileService:
+    service = current_app.config.get('file_service')
+    if service is None:
+        raise RuntimeError('FileService has not been initialized.')
+    return service
+
+
+def get_search_manager() -> SearchManager:
+    service = current_app.config.get('search_manager')
+    if service is None:
+        raise RuntimeError('SearchManager has not been initialized.')
+    return service
+
+
+def get_context_assembler() -> ContextAssembler:
+    service = current_app.config.get('context_assembler')
+    if service is None:
+        raise RuntimeError('ContextAssembler has not been initialized.')
+    return service
+
+
+def get_chat_deletion_service() -> ChatDeletionService:
+    service = current_app.config.get('chat_deletion_service')
+    if service is None:
+        raise RuntimeError('ChatDeletionService has not been initialized.')
+    return service
+
+
+def get_token_ledger() -> TokenLedger:
+    service = current_app.config.get('token_ledger')
+    if service is None:
+        raise RuntimeError('TokenLedger has not been initialized.')
+    return service
+
+
+def get_ingestion_queue() -> IngestionQueue:
+    service = current_app.config.get('ingestion_queue')
+    if service is None:
+        raise RuntimeError('IngestionQueue has not been initialized.')
+    return service
@@ -0,0 +1,129 @@
+import re
+import time
+import random
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional, TypeVar
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from app.utils import metrics
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+T = TypeVar("T")
+
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError,
+                    APIConnectionError, InternalServerError)
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class RetryDeadlineExceeded(Exception):
+    pass
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parses "20", "20ms", "1s" or "6m0s" style durations into seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the service asked us to wait, read from the headers of the failed response."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after_header = headers.get("retry-after")
+    if retry_after_header:
+        seconds = parse_duration(retry_after_header)
+        if seconds is not None:
+            return seconds
+        try:
+            retry_at = parsedate_to_datetime(retry_after_header)
+            return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+
+    resets = [parse_duration(headers[name])
+              for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+              if headers.get(name)]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class RetryPolicy:
+    """
+    Retries Azure OpenAI calls on 429, timeouts, connection errors and 5xx.
+    A 429 is retried after exactly the delay given by `retry-after-ms`,
+    `retry-after` or `x-ratelimit-reset-*`; other errors (or a 429 without
+    those headers) use exponential backoff with jitter. No retry is started
+    that would end after `deadline` seconds from the first attempt. Retry counts
+    and time spent waiting go to the metrics as `openai.retry.<name>.*`.
+    """
+
+    def __init__(self, name: str, max_attempts: int = 8, deadline: float = 60,
+                 backoff_min: float = 1, backoff_max: float = 30):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+    async def call(self, fn: Callable[[], Awaitable[T]],
+                   on_retry: Optional[Callable[[Exception, float], None]] = None,
+                   deadline: Optional[float] = None) -> T:
+        deadline = self.deadline if deadline is None else deadline
+        started_at = time.monotonic()
+        waited = 0.0
+        attempt = 1
+        while True:
+            try:
+                result = await fn()
+                if attempt > 1:
+                    logger.info("%s succeeded after %d attempts, %.2fs spent waiting",
+                                self.name, attempt, waited)
+                return result
+            except RETRYABLE_ERRORS as e:
+                delay = self.__delay(e, attempt)
+                elapsed = time.monotonic() - started_at
+                if attempt >= self.max_attempts:
+                    metrics.increment(f"openai.retry.{self.name}.exhausted")
+                    raise
+                if elapsed + delay > deadline:
+                    metrics.increment(f"openai.retry.{self.name}.deadline_exceeded")
+                    raise RetryDeadlineExceeded(
+                        f"{self.name}: retrying in {delay:.2f}s would exceed the {deadline}s deadline") from e
+                if on_retry:
+                    on_retry(e, delay)
+                logger.info("%s failed with %s, retrying in %.2fs (attempt %d/%d)",
+                            self.name, type(e).__name__, delay, attempt, self.max_attempts)
+                metrics.increment(f"openai.retry.{self.name}.retries")
+                metrics.increment(f"openai.retry.{self.name}.wait_seconds", delay)
+                await asyncio.sleep(delay)
+                waited += delay
+                attempt += 1
+
+    def __delay(self, error: Exception, attempt: int) -> float:
+        if isinstance(error, RateLimitError):
+            requested = retry_after(error)
+            if requested is not None:
+                return requested
+        backoff = min(self.backoff_max, self.backoff_min * 2 ** (attempt - 1))
+        return random.uniform(backoff / 2, backoff)
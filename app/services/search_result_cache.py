@@ -0,0 +1,80 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Set
+from app.utils import metrics
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+# tag of entries whose scope is unknown, dropped by every invalidation
+ANY_SCOPE = "*"
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Future, tags: Set[str]):
+        self.task = task
+        self.tags = tags
+
+
+class SearchResultCache:
+    """
+    LRU cache of search results with a TTL. Every entry carries tags (such
+    as `file:<id>`) and `invalidate` drops exactly the entries sharing a tag.
+    Concurrent lookups of the same key share one upstream call; a call that
+    was running while its tags were invalidated is not stored.
+    Counts go to the metrics as `search_cache.*`.
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, tuple[float, Set[str], Any]] = OrderedDict()
+        self.inflight: dict[Hashable, _Flight] = {}
+
+    async def get_or_fetch(self, key: Hashable, tags: Set[str], fetch: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, _, value = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                metrics.increment("search_cache.hit")
+                return value
+            del self.entries[key]
+
+        flight = self.inflight.get(key)
+        if flight is not None:
+            metrics.increment("search_cache.coalesced")
+        else:
+            metrics.increment("search_cache.miss")
+            flight = _Flight(asyncio.ensure_future(fetch()), tags)
+            self.inflight[key] = flight
+            flight.task.add_done_callback(
+                lambda task: self.__complete(key, flight))
+        # a cancelled caller must not cancel the call the other callers wait for
+        return await asyncio.shield(flight.task)
+
+    def invalidate(self, tags: Set[str]):
+        tags = tags | {ANY_SCOPE}
+        stale = [key for key, (_, entry_tags, _) in self.entries.items()
+                 if entry_tags & tags]
+        for key in stale:
+            del self.entries[key]
+        # running calls may have read the old contents, let the next caller start over
+        for key in [key for key, flight in self.inflight.items() if flight.tags & tags]:
+            del self.inflight[key]
+        if stale:
+            metrics.increment("search_cache.invalidated", len(stale))
+            logger.info("Invalidated %d cached search results", len(stale))
+
+    def __complete(self, key: Hashable, flight: _Flight):
+        if self.inflight.get(key) is not flight:
+            return
+        del self.inflight[key]
+        if flight.task.cancelled() or flight.task.exception() is not None:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl,
+                             flight.tags, flight.task.result())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
@@ -1,15 +1,18 @@
 import os
 import re
 import asyncio
-import base64
 from dataclasses import dataclass
+from functools import partial
 from quart import current_app
 from azure.search.documents.indexes.models import (
+    BinaryQuantizationCompression,
     HnswAlgorithmConfiguration,
     HnswParameters,
     SearchableField,
     SearchField,
     SearchFieldDataType,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
     SearchIndex,
     SemanticConfiguration,
     SemanticField,
@@ -17,6 +20,7 @@ from azure.search.documents.indexes.models import (
     SemanticSearch,
     SimpleField,
     VectorSearch,
+    VectorSearchCompression,
     VectorSearchProfile,
 )
 from azure.search.documents.models import (
@@ -24,17 +28,28 @@ from azure.search.documents.models import (
     QueryType,
     VectorQuery,
 )
-from typing import Any, List, Optional, cast
+from typing import Any, Awaitable, Callable, List, Optional, cast
 from typing import List, Optional
 
 from app.models.file import File
 from app.services.textsplitter import SplitPage
 from app.services.openai_service import OpenaiService
+from app.services.embedding_cache import ChunkEmbeddingStore
+from app.services.search_result_cache import ANY_SCOPE, SearchResultCache
+from app.services.local_search_engine import LocalSearchEngine
 from app.extensions import get_searchai_client, get_searchai_index_client
+from app.utils import metrics
 from app.utils.log_utils import get_logger
 from app.utils.commom import nonewlines
 logger = get_logger("aoai_backend")
 
+# fields returned by search unless asked otherwise, the embedding is left out
+RESULT_FIELDS = ["id", "content", "file_id", "chat_type", "category",
+                 "sourcepage", "sourcefile", "storageUrl"]
+
+FILE_IDS_FILTER = re.compile(r"search\.in\(file_id, '([^']*)'\)")
+CHAT_TYPE_FILTER = re.compile(r"chat_type eq '([^']*)'")
+
 
 class Section:
     """
@@ -46,11 +61,10 @@ class Section:
         self.content = content
         self.category = category
 
-    def filename_to_id(self):
-        filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", self.content.name)
-        filename_hash = base64.b16encode(
-            self.content.name.encode("utf-8")).decode("ascii")
-        return f"file-{filename_ascii}-{filename_hash}"
+    @staticmethod
+    def document_id(file_id: str, ordinal: int) -> str:
+        """Key of the `ordinal`-th section of a file, so a file's keys can be rebuilt from its chunk count."""
+        return f"{file_id}-{ordinal}"
 
 
 @dataclass
@@ -105,12 +119,164 @@ class Document:
         return None
 
 
+@dataclass
+class VectorProfile:
+    """How the embedding field is indexed. Changing it requires a new index (see script/rebuild_index.py)."""
+    dimensions: int = 1536
+    # none / scalar / binary
+    compression: str = "none"
+    # rescore the oversampled quantized candidates with the full-precision vectors
+    rescore: bool = True
+    oversampling: float = 4
+    # keep a retrievable copy of the vectors
+    stored: bool = False
+    # HNSW graph degree, build-time and query-time candidate list sizes
+    m: int = 4
+    ef_construction: int = 400
+    ef_search: int = 500
+
+    @classmethod
+    def from_config(cls, config) -> "VectorProfile":
+        return cls(
+            dimensions=config.get("SEARCH_VECTOR_DIMENSIONS", 1536),
+            compression=config.get("SEARCH_VECTOR_COMPRESSION", "none"),
+            rescore=config.get("SEARCH_VECTOR_RESCORE", True),
+            oversampling=config.get("SEARCH_VECTOR_OVERSAMPLING", 4),
+            stored=config.get("SEARCH_EMBEDDING_STORED", False),
+            m=config.get("SEARCH_HNSW_M", 4),
+            ef_construction=config.get("SEARCH_HNSW_EF_CONSTRUCTION", 400),
+            ef_search=config.get("SEARCH_HNSW_EF_SEARCH", 500),
+        )
+
+    def build_compression(self) -> Optional[VectorSearchCompression]:
+        if self.compression == "none":
+            return None
+        options = dict(
+            compression_name=f"{self.compression}_compression",
+            rerank_with_original_vectors=self.rescore,
+            default_oversampling=self.oversampling if self.rescore else None,
+        )
+        if self.compression == "scalar":
+            return ScalarQuantizationCompression(
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8"), **options)
+        if self.compression == "binary":
+            return BinaryQuantizationCompression(**options)
+        raise ValueError(f"Unknown vector compression: {self.compression}")
+
+
+def build_index(name: str, profile: VectorProfile) -> SearchIndex:
+    compression = profile.build_compression()
+    fields = [
+        SimpleField(name="id", type="Edm.String", key=True),
+        SearchableField(
+            name="content",
+            type="Edm.String",
+            analyzer_name="en.microsoft",
+        ),
+        SearchField(
+            name="embedding",
+            type=SearchFieldDataType.Collection(
+                SearchFieldDataType.Single),
+            hidden=True,
+            stored=profile.stored,
+            searchable=True,
+            filterable=False,
+            sortable=False,
+            facetable=False,
+            vector_search_dimensions=profile.dimensions,
+            vector_search_profile_name="default",
+        ),
+        SimpleField(
+            name="file_id",
+            type="Edm.String",
+            filterable=True,
+            facetable=True,
+        ),
+        SimpleField(
+            name="chat_type",
+            type="Edm.String",
+            filterable=True,
+        ),
+        SimpleField(
+            name="sourcepage",
+            type="Edm.String",
+            filterable=True,
+            facetable=True,
+        ),
+        SimpleField(
+            name="sourcefile",
+            type="Edm.String",
+            filterable=True,
+            facetable=True,
+        ),
+        SimpleField(
+            name="storageUrl",
+            type="Edm.String",
+            filterable=True,
+            facetable=False,
+        ),
+
+        SimpleField(
+            name="category",
+            type="Edm.String",
+            filterable=True,
+            facetable=True),
+    ]
+
+    return SearchIndex(
+        name=name,
+        fields=fields,
+        semantic_search=SemanticSearch(
+            configurations=[
+                SemanticConfiguration(
+                    name="default",
+                    prioritized_fields=SemanticPrioritizedFields(
+                        title_field=None, content_fields=[SemanticField(field_name="content")]
+                    ),
+                )
+            ]
+        ),
+        vector_search=VectorSearch(
+            algorithms=[
+                HnswAlgorithmConfiguration(
+                    name="hnsw_config",
+                    parameters=HnswParameters(
+                        m=profile.m,
+                        ef_construction=profile.ef_construction,
+                        ef_search=profile.ef_search,
+                        metric="cosine",
+                    ),
+                )
+            ],
+            profiles=[
+                VectorSearchProfile(
+                    name="default",
+                    algorithm_configuration_name="hnsw_config",
+                    compression_name=compression.compression_name if compression else None,
+                ),
+            ],
+            compressions=[compression] if compression else None,
+        )
+    )
+
+
 class SearchManager:
-    def __init__(self):
+    def __init__(self, openai_service: Optional[OpenaiService] = None,
+                 chunk_embedding_store: Optional[ChunkEmbeddingStore] = None):
         self.search_index_client = get_searchai_index_client()
         self.search_client = get_searchai_client()
         self.search_index_name = current_app.config.get("SEARCH_INDEX")
-        self.openai_service = OpenaiService()
+        self.openai_service = openai_service or OpenaiService()
+        self.chunk_embedding_store = chunk_embedding_store
+        self.result_cache = SearchResultCache(
+            maxsize=current_app.config.get("SEARCH_CACHE_SIZE", 512),
+            ttl=current_app.config.get("SEARCH_CACHE_TTL", 300))
+        # scopes of up to this many sections are searched in process
+        self.local_search_max_chunks = current_app.config.get("LOCAL_SEARCH_MAX_CHUNKS", 200)
+        self.local_engine = LocalSearchEngine(
+            self.__load_local_documents,
+            max_chunks=current_app.config.get("LOCAL_SEARCH_CACHE_CHUNKS", 20000))
+        self.index_ready = False
 
     def __sourcepage_from_file_page(cls, filename, page=0) -> str:
         if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -120,106 +286,33 @@ class SearchManager:
 
     async def create_index(self):
         logger.info("Ensuring search index %s exists", self.search_index_name)
-
-        fields = [
-            SimpleField(name="id", type="Edm.String", key=True),
-            SearchableField(
-                name="content",
-                type="Edm.String",
-                analyzer_name="en.microsoft",
-            ),
-            SearchField(
-                name="embedding",
-                type=SearchFieldDataType.Collection(
-                    SearchFieldDataType.Single),
-                hidden=False,
-                searchable=True,
-                filterable=False,
-                sortable=False,
-                facetable=False,
-                vector_search_dimensions=1536,
-                vector_search_profile_name="default",
-            ),
-            SimpleField(
-                name="file_id",
-                type="Edm.String",
-                filterable=True,
-                facetable=True,
-            ),
-            SimpleField(
-                name="chat_type",
-                type="Edm.String",
-                filterable=True,
-            ),
-            SimpleField(
-                name="sourcepage",
-                type="Edm.String",
-                filterable=True,
-                facetable=True,
-            ),
-            SimpleField(
-                name="sourcefile",
-                type="Edm.String",
-                filterable=True,
-                facetable=True,
-            ),
-            SimpleField(
-                name="storageUrl",
-                type="Edm.String",
-                filterable=True,
-                facetable=False,
-            ),
-
-            SimpleField(
-                name="category",
-                type="Edm.String",
-                filterable=True,
-                facetable=True),
-        ]
-
-        index = SearchIndex(
-            name=self.search_index_name,
-            fields=fields,
-            semantic_search=SemanticSearch(
-                configurations=[
-                    SemanticConfiguration(
-                        name="default",
-                        prioritized_fields=SemanticPrioritizedFields(
-                            title_field=None, content_fields=[SemanticField(field_name="content")]
-                        ),
-                    )
-                ]
-            ),
-            vector_search=VectorSearch(
-                algorithms=[
-                    HnswAlgorithmConfiguration(
-                        name="hnsw_config",
-                        parameters=HnswParameters(metric="cosine"),
-                    )
-                ],
-                profiles=[
-                    VectorSearchProfile(
-                        name="default",
-                        algorithm_configuration_name="hnsw_config",
-                    ),
-                ]
-            )
-        )
+        index = build_index(self.search_index_name,
+                            VectorProfile.from_config(current_app.config))
         if self.search_index_name not in [name async for name in self.search_index_client.list_index_names()]:
             logger.info("Creating %s search index", self.search_index_name)
             await self.search_index_client.create_index(index)
+        self.index_ready = True
 
-    async def update_content(self, sections: List[Section]):
-        await self.create_index()
+    async def update_content(self, sections: List[Section],
+                             on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None):
+        """Indexes `sections`, calling `on_progress(indexed, total)` after every batch."""
+        if not self.index_ready:
+            await self.create_index()
 
         MAX_BATCH_SIZE = 1000
         section_batches = [sections[i: i + MAX_BATCH_SIZE]
                            for i in range(0, len(sections), MAX_BATCH_SIZE)]
 
-        for batch_index, batch in enumerate(section_batches):
-            documents = [
-                {
-                    "id": f"{section.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
+        ordinals: dict[str, int] = {}
+        usage = {"chunks": 0, "reused": 0, "tokens_saved": 0, "requests_saved": 0}
+        local_documents = []
+        for batch in section_batches:
+            documents = []
+            for section in batch:
+                ordinal = ordinals.get(section.content.id, 0)
+                ordinals[section.content.id] = ordinal + 1
+                documents.append({
+                    "id": Section.document_id(section.content.id, ordinal),
                     "content": section.split_page.text,
                     "category": section.category,
                     "sourcepage": (
@@ -232,23 +325,113 @@ class SearchManager:
                     "storageUrl": section.content.file_url,
                     "file_id": section.content.id,
                     "chat_type": section.content.chat_type,
+                })
 
-                }
-                for section_index, section in enumerate(batch)
-            ]
-
-            embeddings = await self.openai_service.create_embedding_batch(texts=[section.split_page.text for section in batch])
+            embeddings = await self.__embed_texts([section.split_page.text for section in batch], usage)
             for i, document in enumerate(documents):
                 document["embedding"] = embeddings[i]
 
             await self.search_client.upload_documents(documents)
+            local_documents.extend(documents)
+            if on_progress is not None:
+                await on_progress(len(local_documents), len(sections))
+
+        self.invalidate_results([section.content for section in sections])
+        # keep small files at hand for the local engine
+        self.local_engine.add([document for document in local_documents
+                               if ordinals[document["file_id"]] <= self.local_search_max_chunks])
+        logger.info(
+            "Embedded %d sections, %d reused from the chunk store (saved %d tokens, %d requests)",
+            usage["chunks"], usage["reused"], usage["tokens_saved"], usage["requests_saved"])
+        metrics.increment("ingest.embeddings.reused", usage["reused"])
+        metrics.increment("ingest.embeddings.tokens_saved", usage["tokens_saved"])
+        metrics.increment("ingest.embeddings.requests_saved", usage["requests_saved"])
+
+    async def __load_local_documents(self, file_ids: List[str]) -> List[dict[str, Any]]:
+        """
+        Sections of the given files for the local engine, with their embeddings from
+        the chunk store. Sections not in the store are left out, they are not embedded.
+        """
+        results = await self.search_client.search(
+            search_text="", filter=self.build_filter(None, file_ids), top=1000, select=RESULT_FIELDS)
+        documents = [{k: v for k, v in document.items() if not k.startswith("@")}
+                     async for document in results]
+        embeddings = await self.stored_embeddings([document["content"] for document in documents])
+        return [dict(document, embedding=embeddings[document["content"]])
+                for document in documents if document["content"] in embeddings]
+
+    async def stored_embeddings(self, texts: List[str]) -> dict[str, List[float]]:
+        """Embeddings of section texts found in the chunk store, by text. Nothing is embedded."""
+        if self.chunk_embedding_store is None:
+            return {}
+        return await self.chunk_embedding_store.get_many(self.openai_service.embedding_model_key, texts)
+
+    @property
+    def stores_chunk_embeddings(self) -> bool:
+        return self.chunk_embedding_store is not None
+
+    def returns_embeddings(self, files: Optional[List[File]]) -> bool:
+        """Whether search can return "embedding" for this scope: the local engine only, the index hides it."""
+        return self.__is_local_scope(files)
+
+    async def __embed_texts(self, texts: List[str], usage: dict[str, int]) -> List[List[float]]:
+        """
+        Embeds `texts`, taking already known chunks from the chunk store and
+        embedding every distinct new text once. Adds the savings to `usage`.
+        """
+        usage["chunks"] += len(texts)
+        if self.chunk_embedding_store is None:
+            return await self.openai_service.create_embedding_batch(texts=texts)
+
+        deployment = self.openai_service.embedding_model_key
+        known = await self.chunk_embedding_store.get_many(deployment, texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in known))
+        if missing:
+            embeddings = await self.openai_service.create_embedding_batch(texts=missing)
+            new = dict(zip(missing, embeddings))
+            await self.chunk_embedding_store.put_many(deployment, new)
+            known.update(new)
+
+        full_tokens, full_requests = self.openai_service.estimate_embedding_usage(texts)
+        spent_tokens, spent_requests = self.openai_service.estimate_embedding_usage(missing)
+        usage["reused"] += len(texts) - len(missing)
+        usage["tokens_saved"] += full_tokens - spent_tokens
+        usage["requests_saved"] += full_requests - spent_requests
+        return [known[text] for text in texts]
+
+    async def remove_files(self, files: List[File]):
+        """
+        Removes the sections of the given files. Files ingested with a chunk count are
+        deleted by key in one batched call, older files fall back to remove_contents.
+        """
+        MAX_BATCH_SIZE = 1000
+        document_ids = [
+            {"id": Section.document_id(file.id, ordinal)}
+            for file in files if file.chunk_count is not None
+            for ordinal in range(file.chunk_count)
+        ]
+        for i in range(0, len(document_ids), MAX_BATCH_SIZE):
+            removed_docs = await self.search_client.delete_documents(document_ids[i: i + MAX_BATCH_SIZE])
+            logger.info("Removed %d sections from index", len(removed_docs))
+        self.invalidate_results(files)
+        self.local_engine.remove([file.id for file in files])
 
-    async def remove_content(self, file_id: str, chat_type: str):
+        legacy_files: dict[str, List[str]] = {}
+        for file in files:
+            if file.chunk_count is None:
+                legacy_files.setdefault(file.chat_type, []).append(file.id)
+        for chat_type, file_ids in legacy_files.items():
+            await self.remove_contents(file_ids, chat_type)
+
+    async def remove_contents(self, file_ids: List[str], chat_type: str):
+        """Removes the sections of all given files by searching with a single filter until none are left."""
+        if not file_ids:
+            return
         while True:
-            filter = f"file_id eq '{file_id}' and chat_type eq '{chat_type}'"
+            filter = self.build_filter(chat_type, file_ids)
             max_results = 1000
             result = await self.search_client.search(
-                search_text="", filter=filter, top=max_results, include_total_count=True
+                search_text="", filter=filter, top=max_results, include_total_count=True, select=["id"]
             )
             result_count = await result.get_count()
             if result_count == 0:
@@ -260,6 +443,33 @@ class SearchManager:
             logger.info("Removed %d sections from index", len(removed_docs))
             # It can take a few seconds for search results to reflect changes, so wait a bit
             await asyncio.sleep(2)
+        self.result_cache.invalidate(self.__scope_tags(file_ids, chat_type))
+        self.local_engine.remove(file_ids)
+
+    def invalidate_results(self, files: List[File]):
+        """Drops the cached search results that may include sections of `files`."""
+        tags = set()
+        for file in files:
+            tags |= self.__scope_tags([file.id], file.chat_type)
+        self.result_cache.invalidate(tags)
+
+    @staticmethod
+    def __scope_tags(file_ids: List[str], chat_type: Optional[str]) -> set[str]:
+        return {f"file:{file_id}" for file_id in file_ids} | {f"chat_type:{chat_type}"}
+
+    @staticmethod
+    def __filter_tags(filter: Optional[str]) -> set[str]:
+        """
+        Tags of the files a filter built by build_filter can match: its file ids,
+        or its chat type when it is not restricted to files.
+        """
+        match = FILE_IDS_FILTER.search(filter or "")
+        if match:
+            return {f"file:{file_id}" for file_id in match.group(1).split(",")}
+        match = CHAT_TYPE_FILTER.search(filter or "")
+        if match:
+            return {f"chat_type:{match.group(1)}"}
+        return {ANY_SCOPE}
 
     async def search(
         self,
@@ -270,6 +480,79 @@ class SearchManager:
         use_semantic_ranker: bool = True,
         minimum_search_score: Optional[float] = 0.0,
         minimum_reranker_score: Optional[float] = 0.0,
+        select: Optional[List[str]] = None,
+        files: Optional[List[File]] = None,
+    ) -> List[Document]:
+        """
+        Returns the fields in `select` (RESULT_FIELDS by default). "embedding" is only
+        returned by the LocalSearchEngine (see returns_embeddings), the index hides it.
+        Results are cached by query text, filter, top, ranker, score thresholds and fields.
+        The vector queries are not part of the key, they are derived from the query text.
+
+        When `files` (the files the filter is restricted to) have at most
+        LOCAL_SEARCH_MAX_CHUNKS sections in total and their vectors are at hand
+        without embedding anything, the LocalSearchEngine answers instead of
+        Azure AI Search; its documents have no captions.
+        """
+        select = select or RESULT_FIELDS
+        key = (query_text, filter, top, use_semantic_ranker,
+               minimum_search_score, minimum_reranker_score, tuple(select))
+        # the index keeps "embedding" hidden
+        fetch = partial(self.__search, top, query_text, filter, vectors, use_semantic_ranker,
+                        minimum_search_score, minimum_reranker_score,
+                        [field for field in select if field != "embedding"])
+        if self.__is_local_scope(files):
+            fetch = partial(self.__search_local, top, query_text, files, vectors, minimum_search_score, select,
+                            fetch)
+        documents = await self.result_cache.get_or_fetch(key, self.__filter_tags(filter), fetch)
+        return list(documents)
+
+    def __is_local_scope(self, files: Optional[List[File]]) -> bool:
+        """Small scopes whose vectors are at hand: held since ingestion here, or in the chunk store."""
+        if not files or any(file.chunk_count is None for file in files) or \
+                sum(file.chunk_count for file in files) > self.local_search_max_chunks:
+            return False
+        return self.chunk_embedding_store is not None or self.local_engine.holds([file.id for file in files])
+
+    async def __search_local(self, top: int, query_text: Optional[str], files: List[File],
+                             vectors: List[VectorQuery], minimum_search_score: Optional[float],
+                             select: List[str],
+                             fallback: Callable[[], Awaitable[List[Document]]]) -> List[Document]:
+        documents = await self.local_engine.search(
+            top, query_text, {file.id: file.chunk_count for file in files}, vectors, minimum_search_score, select)
+        if documents is None:
+            # sections not all searchable or at hand yet
+            return await fallback()
+        return [self.__to_document(document) for document in documents]
+
+    @staticmethod
+    def __to_document(document: dict[str, Any]) -> Document:
+        return Document(
+            id=document.get("id"),
+            content=document.get("content"),
+            embedding=document.get("embedding"),
+            file_id=document.get("file_id"),
+            chat_type=document.get("chat_type"),
+            category=document.get("category"),
+            sourcepage=document.get("sourcepage"),
+            sourcefile=document.get("sourcefile"),
+            storageUrl=document.get("storageUrl"),
+            captions=cast(List[QueryCaptionResult],
+                          document.get("@search.captions")),
+            score=document.get("@search.score"),
+            reranker_score=document.get("@search.reranker_score"),
+        )
+
+    async def __search(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: List[VectorQuery],
+        use_semantic_ranker: bool,
+        minimum_search_score: Optional[float],
+        minimum_reranker_score: Optional[float],
+        select: List[str],
     ) -> List[Document]:
         search_text = query_text
         search_vectors = vectors
@@ -278,6 +561,7 @@ class SearchManager:
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 query_caption="extractive|highlight-false",
                 vector_queries=search_vectors,
                 query_type=QueryType.SEMANTIC,
@@ -289,29 +573,14 @@ class SearchManager:
                 search_text=search_text,
                 filter=filter,
                 top=top,
+                select=select,
                 vector_queries=search_vectors,
             )
 
         documents: List[Document] = []
         async for page in results.by_page():
             async for document in page:
-                documents.append(
-                    Document(
-                        id=document.get("id"),
-                        content=document.get("content"),
-                        embedding=document.get("embedding"),
-                        file_id=document.get("file_id"),
-                        chat_type=document.get("chat_type"),
-                        category=document.get("category"),
-                        sourcepage=document.get("sourcepage"),
-                        sourcefile=document.get("sourcefile"),
-                        storageUrl=document.get("storageUrl"),
-                        captions=cast(List[QueryCaptionResult],
-                                      document.get("@search.captions")),
-                        score=document.get("@search.score"),
-                        reranker_score=document.get("@search.reranker_score"),
-                    )
-                )
+                documents.append(self.__to_document(document))
 
             qualified_documents = [
                 doc
@@ -338,10 +607,11 @@ class SearchManager:
         self, results: List[Document], use_semantic_captions: bool
     ) -> list[str]:
         if use_semantic_captions:
+            # documents of the local engine have no captions, their content is used instead
             return [
                 doc.sourcepage + ": " +
-                nonewlines(" . ".join([cast(str, c.text)
-                           for c in (doc.captions or [])]))
+                nonewlines(" . ".join([cast(str, c.text) for c in doc.captions])
+                           if doc.captions else doc.content or "")
                 for doc in results
             ]
         else:
@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Any, List, Optional
+from app.services.chat_content_repository import ChatContentRepository
+from app.services.prompt_assembler import TokenCounter
+from app.utils import metrics
+
+
+@dataclass
+class TurnTokens:
+    """Token counts of a past question/answer turn, with the text lengths they were counted for."""
+    user_chars: int
+    user_tokens: int
+    bot_chars: int
+    bot_tokens: int
+
+    def matches(self, item: dict[str, Any]) -> bool:
+        return self.user_chars == len(item["user"]) and self.bot_chars == len(item["bot"])
+
+    @property
+    def tokens(self) -> int:
+        return self.user_tokens + self.bot_tokens
+
+
+class TokenLedger:
+    """
+    Remembers the token counts of the past turns of each chat, so that building
+    a prompt only tokenizes the new question instead of the whole history.
+
+    Counts are kept in an LRU of `maxsize` chats and saved on the chat contents
+    (`question_tokens`/`answer_tokens`), from which a chat evicted from memory
+    or served by another worker is reloaded with one query. A turn whose text
+    length differs from the one counted (e.g. edited by the client) is counted
+    again.
+    """
+
+    def __init__(self, chat_content_repository: ChatContentRepository, token_counter: TokenCounter,
+                 maxsize: int = 1024):
+        self.chat_content_repository = chat_content_repository
+        self.token_counter = token_counter
+        self.maxsize = maxsize
+        self.chats: OrderedDict[str, List[TurnTokens]] = OrderedDict()
+
+    async def turn_tokens(self, chat_id: str, chat_type: str, history) -> List[int]:
+        """Returns the tokens of each past turn of `history` (all but the last item)."""
+        past = history[:-1]
+        if not past:
+            return []
+        turns = self.chats.get(chat_id)
+        if turns is None or len(turns) < len(past):
+            turns = await self.__load(chat_id, chat_type)
+        self.__remember(chat_id, turns)
+
+        tokens = []
+        for index, item in enumerate(past):
+            if index < len(turns) and turns[index].matches(item):
+                metrics.increment("token_ledger.hit")
+            else:
+                metrics.increment("token_ledger.miss")
+                turn = self.__count(item["user"], item["bot"])
+                if index < len(turns):
+                    turns[index] = turn
+                else:
+                    turns.append(turn)
+            tokens.append(turns[index].tokens)
+        return tokens
+
+    def record(self, chat_id: str, index: int, question: str, answer: str) -> TurnTokens:
+        """Counts the turn numbered `index` (from 1), to be saved with the chat content."""
+        turn = self.__count(question, answer)
+        turns = self.chats.get(chat_id)
+        if turns is None and index == 1:
+            turns = []
+            self.__remember(chat_id, turns)
+        if turns is not None:
+            if index <= len(turns):
+                turns[index - 1] = turn
+            elif index == len(turns) + 1:
+                turns.append(turn)
+        return turn
+
+    async def __load(self, chat_id: str, chat_type: str) -> List[TurnTokens]:
+        metrics.increment("token_ledger.loaded")
+        turns = []
+        for item in await self.chat_content_repository.list(chat_id, chat_type):
+            question = item.get("question") or ""
+            answer = item.get("answer") or ""
+            if item.get("question_tokens") is None or item.get("answer_tokens") is None:
+                # saved before the counts were
+                turns.append(self.__count(question, answer))
+            else:
+                turns.append(TurnTokens(len(question), item["question_tokens"],
+                                        len(answer), item["answer_tokens"]))
+        return turns
+
+    def __count(self, question: Optional[str], answer: Optional[str]) -> TurnTokens:
+        question = question or ""
+        answer = answer or ""
+        return TurnTokens(len(question), self.token_counter.count(question),
+                          len(answer), self.token_counter.count(answer))
+
+    def __remember(self, chat_id: str, turns: List[TurnTokens]):
+        self.chats[chat_id] = turns
+        self.chats.move_to_end(chat_id)
+        while len(self.chats) > self.maxsize:
+            self.chats.popitem(last=False)
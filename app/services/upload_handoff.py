@@ -0,0 +1,90 @@
+import time
+import asyncio
+import tempfile
+import threading
+from io import BytesIO
+from typing import IO, Optional
+from app.utils import metrics
+
+
+class Spool():
+    """
+    Content written chunk by chunk, kept in memory up to `max_memory` bytes
+    and moved to a temporary file on disk beyond. Unlike SpooledTemporaryFile
+    the content is always an IOBase, which the Azure SDKs require of a body.
+    Writes to memory happen inline; the move to disk and writes to the file
+    run in a thread so as not to block the event loop.
+    """
+
+    def __init__(self, max_memory: int, directory: Optional[str] = None):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.content: IO[bytes] = BytesIO()
+
+    async def write(self, chunk: bytes):
+        if isinstance(self.content, BytesIO):
+            if self.content.tell() + len(chunk) <= self.max_memory:
+                self.content.write(chunk)
+                return
+            self.content = await asyncio.to_thread(self.__rollover, self.content)
+        await asyncio.to_thread(self.content.write, chunk)
+
+    def __rollover(self, content: BytesIO) -> IO[bytes]:
+        spooled = tempfile.TemporaryFile(dir=self.directory)
+        spooled.write(content.getbuffer())
+        return spooled
+
+    def finish(self) -> IO[bytes]:
+        self.content.seek(0)
+        return self.content
+
+    def close(self):
+        self.content.close()
+
+
+class UploadHandoff():
+    """
+    Keeps the content of files uploaded to this worker until their ingestion
+    job has parsed them, so that the job does not download from storage what
+    was just uploaded. A job running on another worker, or after `ttl`
+    seconds, reads from storage as before.
+    """
+
+    def __init__(self, max_memory: int = 4 * 1024 * 1024, ttl: int = 3600, directory: Optional[str] = None):
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.directory = directory
+        self.entries: dict[str, tuple[IO[bytes], float]] = {}
+        self.lock = threading.Lock()
+
+    def spool(self) -> Spool:
+        return Spool(self.max_memory, self.directory)
+
+    def put(self, file_id: str, content: IO[bytes]):
+        with self.lock:
+            self.__expire()
+            self.entries[file_id] = (content, time.monotonic())
+
+    def open(self, file_id: str) -> Optional[IO[bytes]]:
+        """The content of `file_id` from its start, or None if it was not uploaded here."""
+        with self.lock:
+            self.__expire()
+            entry = self.entries.get(file_id)
+        if entry is None:
+            metrics.increment("upload_handoff.miss")
+            return None
+        metrics.increment("upload_handoff.hit")
+        content, _ = entry
+        content.seek(0)
+        return content
+
+    def release(self, file_id: str):
+        with self.lock:
+            entry = self.entries.pop(file_id, None)
+        if entry is not None:
+            entry[0].close()
+
+    def __expire(self):
+        deadline = time.monotonic() - self.ttl
+        for file_id in [file_id for file_id, (_, added) in self.entries.items() if added < deadline]:
+            self.entries.pop(file_id)[0].close()
@@ -1,8 +1,7 @@
 import jwt
-import requests
-from jwt.algorithms import RSAAlgorithm
 from functools import wraps
 from quart import current_app, request, jsonify, g
+from app.extensions import get_jwks_key_store, get_token_claims_cache
 from app.utils.log_utils import get_logger
 
 logger = get_logger("aoai_backend")
@@ -11,16 +10,21 @@ logger = get_logger("aoai_backend")
 async def verify_token(token):
     TENANT_ID = current_app.config["MSAL_TENANT_ID"]
     CLIENT_ID = current_app.config["MSAL_CLIENT_ID"]
-    OPENID_CONFIG_URL = f"https://login.microsoftonline.com/{TENANT_ID}/discovery/v2.0/keys"
     ISSUER = f"https://sts.windows.net/{TENANT_ID}/"
+    key_store = get_jwks_key_store()
+    claims_cache = get_token_claims_cache()
+    cached_token = claims_cache.get(token, key_store.has_key)
+    if cached_token is not None:
+        return cached_token, None, None
     try:
-        jwks = requests.get(OPENID_CONFIG_URL).json()
-        public_keys = {key['kid']: key for key in jwks['keys']}
         unverified_header = jwt.get_unverified_header(token)
         kid = unverified_header.get('kid')
-        if kid not in public_keys:
-            raise ValueError("Invalid 'kid' in token header")
-        rsa_key = RSAAlgorithm.from_jwk(public_keys[kid])
+        try:
+            rsa_key = await key_store.get_rsa_key(kid)
+        except Exception:
+            return None, 503, "Unable to fetch signing keys"
+        if rsa_key is None:
+            return None, 401, "Invalid 'kid' in token header"
 
         decoded_token = jwt.decode(
             token,
@@ -29,6 +33,7 @@ async def verify_token(token):
             audience=CLIENT_ID,
             issuer=ISSUER
         )
+        claims_cache.put(token, decoded_token, kid)
         return decoded_token, None, None
     except jwt.ExpiredSignatureError:
         return None, 401, "Token has expired"
@@ -52,8 +57,8 @@ def token_required(f):
             return jsonify({"error": "Invalid authorization header format"}), 401
 
         token_data, status, message = await verify_token(token)
-        if status == 401:
-            return jsonify({"error": message}), 401
+        if status is not None:
+            return jsonify({"error": message}), status
 
         g.email = token_data.get('email') or token_data.get('upn')
         family_name = token_data.get('family_name')
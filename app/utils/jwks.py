@@ -0,0 +1,109 @@
+import time
+import asyncio
+import aiohttp
+from typing import Any, Optional
+from jwt.algorithms import RSAAlgorithm
+from app.utils.log_utils import get_logger
+
+logger = get_logger("aoai_backend")
+
+JWKS_URL_TEMPLATE = "https://login.microsoftonline.com/{tenant_id}/discovery/v2.0/keys"
+
+
+class JwksKeyStore():
+    """
+    Process-wide cache of the signing keys published by Microsoft Entra ID.
+
+    Keys are fetched asynchronously and kept for `ttl` seconds. Once the TTL
+    has passed the current keys keep being served while a refresh runs in the
+    background. An unknown `kid` forces one refresh (at most once every
+    `min_refresh_interval` seconds), and concurrent callers share the same
+    in-flight fetch. When the endpoint is unreachable the last known keys stay
+    in use.
+    """
+
+    def __init__(self, jwks_url: str, ttl: float = 3600, min_refresh_interval: float = 60, timeout: float = 10):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys: dict[str, dict] = {}
+        self._rsa_keys: dict[str, Any] = {}
+        self._fetched_at: float = 0
+        self._last_attempt_at: float = 0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    async def get_key(self, kid: str) -> Optional[dict]:
+        """Returns the JWK for `kid`, or None when the key is unknown even after a refresh."""
+        if not self._keys:
+            await self.refresh()
+        elif self.is_stale:
+            # serve the cached keys and refresh in the background
+            self._start_refresh()
+
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._last_attempt_at > self.min_refresh_interval:
+            logger.info("Unknown kid %s, refreshing JWKS", kid)
+            await self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    async def get_rsa_key(self, kid: str) -> Optional[Any]:
+        """Returns the parsed RSA public key for `kid`, parsing each JWK only once."""
+        rsa_key = self._rsa_keys.get(kid)
+        if rsa_key is not None and not self.is_stale:
+            return rsa_key
+        key = await self.get_key(kid)
+        if key is None:
+            return None
+        rsa_key = self._rsa_keys.get(kid)
+        if rsa_key is None:
+            rsa_key = RSAAlgorithm.from_jwk(key)
+            self._rsa_keys[kid] = rsa_key
+        return rsa_key
+
+    def has_key(self, kid: str) -> bool:
+        return kid in self._keys
+
+    async def refresh(self):
+        """Fetches the keys, sharing a single in-flight request between callers."""
+        await asyncio.shield(self._start_refresh())
+
+    async def close(self):
+        if self._refresh_task and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch())
+        return self._refresh_task
+
+    async def _fetch(self):
+        self._last_attempt_at = time.monotonic()
+        try:
+            if self._session is None or self._session.closed:
+                self._session = aiohttp.ClientSession(
+                    timeout=aiohttp.ClientTimeout(total=self.timeout))
+            async with self._session.get(self.jwks_url) as response:
+                response.raise_for_status()
+                jwks = await response.json()
+            keys = {key["kid"]: key for key in jwks["keys"]}
+            # drop parsed keys that were rotated out or changed
+            self._rsa_keys = {kid: rsa_key for kid, rsa_key in self._rsa_keys.items()
+                              if keys.get(kid) == self._keys.get(kid)}
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            logger.info("Fetched %d signing keys from JWKS", len(self._keys))
+        except Exception as e:
+            if not self._keys:
+                logger.exception(f"JWKSの取得に失敗しました。: {e}")
+                raise
+            logger.warning(
+                f"JWKSの取得に失敗しました。キャッシュ済みの鍵を利用します。: {e}")
@@ -0,0 +1,22 @@
+from collections import defaultdict
+
+_counters: dict[str, float] = defaultdict(float)
+
+
+def increment(name: str, value: float = 1):
+    """Adds `value` to the process-wide counter `name`."""
+    _counters[name] += value
+
+
+def set_value(name: str, value: float):
+    """Overwrites the counter `name`, for values such as ratios that are not cumulative."""
+    _counters[name] = value
+
+
+def get_counter(name: str) -> float:
+    return _counters.get(name, 0)
+
+
+def snapshot() -> dict[str, float]:
+    """Returns a copy of all counters, sorted by name."""
+    return {name: _counters[name] for name in sorted(_counters)}
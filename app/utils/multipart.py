@@ -0,0 +1,79 @@
+from typing import AsyncIterable, AsyncIterator, Optional, Union
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+# form fields are read into memory, file parts are streamed
+MAX_FIELD_SIZE = 1024 * 1024
+
+
+class MultipartPart():
+    """A part of a multipart/form-data body, readable once and only before the next part."""
+
+    def __init__(self, reader: "MultipartReader", name: str, filename: Optional[str], headers: Headers):
+        self.reader = reader
+        self.name = name
+        # None for form fields, possibly "" for an empty file input
+        self.filename = filename
+        self.headers = headers
+        self.complete = False
+
+    @property
+    def content_type(self) -> Optional[str]:
+        return self.headers.get("Content-Type")
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while not self.complete:
+            event = await self.reader.next_event()
+            if not isinstance(event, Data):
+                raise ValueError("Malformed multipart body")
+            self.complete = not event.more_data
+            if event.data:
+                yield event.data
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.chunks()])
+
+
+class MultipartReader():
+    """
+    Reads a multipart/form-data body part by part as it arrives, with the
+    decoder Quart's own form parser uses, instead of parsing the whole body
+    before the handler runs. Raises RequestEntityTooLarge once more than
+    `max_size` bytes were read, which Quart only checks against the declared
+    Content-Length (a chunked body has none).
+    """
+
+    def __init__(self, body: AsyncIterable[bytes], boundary: bytes, max_size: Optional[int] = None):
+        self.body = body.__aiter__()
+        self.decoder = MultipartDecoder(boundary, max_form_memory_size=MAX_FIELD_SIZE)
+        self.max_size = max_size
+        self.received = 0
+
+    async def parts(self) -> AsyncIterator[MultipartPart]:
+        while True:
+            event = await self.next_event()
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, (Field, File)):
+                part = MultipartPart(self, event.name,
+                                     event.filename if isinstance(event, File) else None, event.headers)
+                yield part
+                # skip what the caller did not read
+                async for _ in part.chunks():
+                    pass
+
+    async def next_event(self) -> Union[Field, File, Data, Epilogue]:
+        event = self.decoder.next_event()
+        while isinstance(event, NeedData):
+            try:
+                chunk = await self.body.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            else:
+                self.received += len(chunk)
+                if self.max_size is not None and self.received > self.max_size:
+                    raise RequestEntityTooLarge()
+            self.decoder.receive_data(chunk)
+            event = self.decoder.next_event()
+        return event
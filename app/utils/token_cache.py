@@ -0,0 +1,54 @@
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+from app.utils import metrics
+
+
+class TokenClaimsCache():
+    """
+    Bounded LRU of verified token claims, keyed by the SHA-256 digest of the raw token.
+
+    An entry is only returned until the token's `exp`, and only while the key
+    that signed it (`kid`) is still published, so rotated keys evict their
+    tokens on the next lookup.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[dict, float, str]] = OrderedDict()
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str, is_key_valid: Callable[[str], bool]) -> Optional[dict]:
+        key = self.digest(token)
+        entry = self._entries.get(key)
+        if entry is not None:
+            claims, expires_at, kid = entry
+            if expires_at > time.time() and is_key_valid(kid):
+                self._entries.move_to_end(key)
+                metrics.increment("auth.claims_cache.hit")
+                return claims
+            del self._entries[key]
+            metrics.increment("auth.claims_cache.evicted")
+        metrics.increment("auth.claims_cache.miss")
+        return None
+
+    def put(self, token: str, claims: dict[str, Any], kid: str):
+        expires_at = claims.get("exp")
+        if expires_at is None:
+            return
+        key = self.digest(token)
+        self._entries[key] = (claims, float(expires_at), kid)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            metrics.increment("auth.claims_cache.evicted")
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,145 @@
+"""
+Compares the auth overhead of `token_required` before and after the JWKS key store.
+
+A local aiohttp server publishes a JWKS document with an artificial delay that
+stands in for the round trip to login.microsoftonline.com. The "before" path
+mirrors the original `verify_token` (blocking `requests.get` on every call),
+the "after" path goes through `JwksKeyStore` and the "cached" path adds the
+`TokenClaimsCache` in front of it, as `verify_token` does.
+
+    python -m script.bench_auth --requests 200 --concurrency 20 --latency-ms 80
+"""
+import sys
+import time
+import json
+import asyncio
+import argparse
+import threading
+import statistics
+from os.path import abspath, dirname
+
+import jwt
+import requests
+from aiohttp import web
+from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.utils.jwks import JwksKeyStore  # noqa: E402
+from app.utils.token_cache import TokenClaimsCache  # noqa: E402
+
+KID = "bench-kid"
+AUDIENCE = "bench-client"
+ISSUER = "https://sts.windows.net/bench-tenant/"
+
+
+def build_keys():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk["kid"] = KID
+    token = jwt.encode(
+        {"aud": AUDIENCE, "iss": ISSUER, "email": "bench@example.com",
+         "exp": int(time.time()) + 3600},
+        private_key, algorithm="RS256", headers={"kid": KID})
+    return {"keys": [jwk]}, token
+
+
+def start_jwks_server(jwks: dict, latency: float) -> str:
+    """Serves the JWKS from its own thread so the blocking "before" path cannot stall it."""
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    address: list[str] = []
+
+    async def keys(_request):
+        await asyncio.sleep(latency)
+        return web.json_response(jwks)
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get("/keys", keys)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        address.append(f"http://127.0.0.1:{runner.addresses[0][1]}/keys")
+        started.set()
+
+    def target():
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=target, daemon=True).start()
+    started.wait()
+    return address[0]
+
+
+def verify_before(url: str, token: str):
+    jwks = requests.get(url).json()
+    public_keys = {key['kid']: key for key in jwks['keys']}
+    kid = jwt.get_unverified_header(token).get('kid')
+    rsa_key = RSAAlgorithm.from_jwk(public_keys[kid])
+    return jwt.decode(token, rsa_key, algorithms=["RS256"], audience=AUDIENCE, issuer=ISSUER)
+
+
+async def verify_after(store: JwksKeyStore, token: str):
+    kid = jwt.get_unverified_header(token).get('kid')
+    rsa_key = RSAAlgorithm.from_jwk(await store.get_key(kid))
+    return jwt.decode(token, rsa_key, algorithms=["RS256"], audience=AUDIENCE, issuer=ISSUER)
+
+
+async def verify_cached(store: JwksKeyStore, cache: TokenClaimsCache, token: str):
+    claims = cache.get(token, store.has_key)
+    if claims is not None:
+        return claims
+    kid = jwt.get_unverified_header(token).get('kid')
+    rsa_key = await store.get_rsa_key(kid)
+    claims = jwt.decode(token, rsa_key, algorithms=["RS256"], audience=AUDIENCE, issuer=ISSUER)
+    cache.put(token, claims, kid)
+    return claims
+
+
+async def run(name: str, call, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(total)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{name:<8} total={elapsed:7.2f}s  throughput={total / elapsed:8.1f} req/s  "
+          f"p50={statistics.median(latencies):8.2f}ms  p95={latencies[int(len(latencies) * 0.95) - 1]:8.2f}ms")
+
+
+async def main(args):
+    jwks, token = build_keys()
+    url = start_jwks_server(jwks, args.latency_ms / 1000)
+    store = JwksKeyStore(url)
+    cache = TokenClaimsCache()
+    try:
+        async def before():
+            verify_before(url, token)
+
+        async def after():
+            await verify_after(store, token)
+
+        async def cached():
+            await verify_cached(store, cache, token)
+
+        await run("before", before, args.requests, args.concurrency)
+        await run("after", after, args.requests, args.concurrency)
+        await run("cached", cached, args.requests, args.concurrency)
+    finally:
+        await store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=80)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,138 @@
+"""
+Prompt building time per turn of long chats, with and without the token ledger.
+
+Every turn of `--turns`-turn conversations builds the two prompts of an answer
+request (the search query and the answer) three ways:
+
+- build_messages: the original path, `build_messages` re-tokenizes the whole
+  history for both prompts
+- counter: PromptAssembler with the TokenCounter cache only, every past
+  message is still hashed to find its count
+- ledger: PromptAssembler with the counts of the past turns from TokenLedger,
+  only the new question is tokenized
+
+Chat contents are kept in an in-memory stand-in of the chat store.
+
+    python -m script.bench_history_tokens --conversations 5 --turns 50
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from os.path import abspath, dirname
+
+from openai_messages_token_helper import build_messages, get_token_limit
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.constants import GPT_4O_MODEL  # noqa: E402
+from app.services.prompt_assembler import PromptAssembler, Source, TokenCounter  # noqa: E402
+from app.services.token_ledger import TokenLedger  # noqa: E402
+
+SYSTEM_PROMPT = "You are an assistant. Please provide helpful, accurate, and concise responses."
+QUERY_PROMPT = "Generate a search query based on the conversation and the new question."
+FEW_SHOTS = [
+    {"role": "user", "content": "How did crypto do last year?"},
+    {"role": "assistant", "content": "Summarize Cryptocurrency Market Dynamics from last year"},
+]
+TOOLS = [{"type": "function", "function": {
+    "name": "search_sources", "description": "Retrieve sources from the Azure AI Search index",
+    "parameters": {"type": "object", "properties": {"search_query": {"type": "string"}},
+                   "required": ["search_query"]}}}]
+WORDS = ("the contract renewal policy applies to every employee and the request must be approved "
+         "契約 更新 手続き 申請 承認 社員 規程 期限 担当 部署 確認 書類").split()
+
+
+class ChatStoreStandIn:
+    def __init__(self):
+        self.items: dict[str, list[dict]] = {}
+
+    async def add(self, chat_id, chat_type, index, question, answer, question_tokens=None, answer_tokens=None):
+        self.items.setdefault(chat_id, []).append(
+            dict(index=index, question=question, answer=answer,
+                 question_tokens=question_tokens, answer_tokens=answer_tokens))
+
+    async def list(self, chat_id, chat_type):
+        return self.items.get(chat_id, [])
+
+
+def text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def build_with_build_messages(history, sources):
+    past = []
+    for item in history[:-1]:
+        past.append({"role": "user", "content": item["user"]})
+        past.append({"role": "assistant", "content": item["bot"]})
+    build_messages(model=GPT_4O_MODEL, system_prompt=QUERY_PROMPT, tools=TOOLS, few_shots=FEW_SHOTS,
+                   past_messages=past, new_user_content="Generate search query for: " + history[-1]["user"],
+                   max_tokens=get_token_limit(GPT_4O_MODEL) - 100)
+    build_messages(model=GPT_4O_MODEL, system_prompt=SYSTEM_PROMPT, past_messages=past,
+                   new_user_content=history[-1]["user"] + "\n\nSources:\n" +
+                   "\n".join(source.render() for source in sources),
+                   max_tokens=get_token_limit(GPT_4O_MODEL) - 2048)
+
+
+def build_with_assembler(assembler: PromptAssembler, history, sources, turn_tokens=None):
+    assembler.build_query(QUERY_PROMPT, FEW_SHOTS, TOOLS, history,
+                          "Generate search query for: " + history[-1]["user"], 100, turn_tokens)
+    assembler.build(SYSTEM_PROMPT, history, sources, turn_tokens=turn_tokens)
+
+
+async def run(name: str, args) -> dict[int, list[float]]:
+    rng = random.Random(args.seed)
+    token_counter = TokenCounter()
+    assembler = PromptAssembler(token_counter, sources_budget=args.sources_tokens)
+    store = ChatStoreStandIn()
+    ledger = TokenLedger(store, token_counter)
+    latencies: dict[int, list[float]] = {}
+    for conversation in range(args.conversations):
+        chat_id = f"chat-{conversation}"
+        history = []
+        for turn in range(1, args.turns + 1):
+            history.append({"user": text(rng, args.question_words)})
+            sources = [Source(f"doc{i}.pdf#page={turn}", text(rng, args.source_words), rng.random())
+                       for i in range(3)]
+            start = time.perf_counter()
+            if name == "build_messages":
+                build_with_build_messages(history, sources)
+            elif name == "counter":
+                build_with_assembler(assembler, history, sources)
+            else:
+                turn_tokens = await ledger.turn_tokens(chat_id, "gpt", history)
+                build_with_assembler(assembler, history, sources, turn_tokens)
+            latencies.setdefault(turn, []).append((time.perf_counter() - start) * 1000)
+
+            answer = text(rng, args.answer_words)
+            if name == "ledger":
+                counted = ledger.record(chat_id, turn, history[-1]["user"], answer)
+                await store.add(chat_id, "gpt", turn, history[-1]["user"], answer,
+                                counted.user_tokens, counted.bot_tokens)
+            history[-1]["bot"] = answer
+    return latencies
+
+
+async def main(args):
+    print(f"{args.conversations} conversations of {args.turns} turns, both prompts built every turn")
+    print(f"{'path':<15} {'total ms':>9} {'turn 1 ms':>10} {f'turn {args.turns // 2} ms':>11} "
+          f"{f'turn {args.turns} ms':>11}")
+    for name in ("build_messages", "counter", "ledger"):
+        latencies = await run(name, args)
+        total = sum(sum(values) for values in latencies.values()) / args.conversations
+        print(f"{name:<15} {total:>9.1f} {statistics.median(latencies[1]):>10.3f} "
+              f"{statistics.median(latencies[args.turns // 2]):>11.3f} "
+              f"{statistics.median(latencies[args.turns]):>11.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--question-words", type=int, default=30)
+    parser.add_argument("--answer-words", type=int, default=200)
+    parser.add_argument("--source-words", type=int, default=300)
+    parser.add_argument("--sources-tokens", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(main(parser.parse_args()))
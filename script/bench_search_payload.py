@@ -0,0 +1,132 @@
+"""
+Response payload and parse time of search hits with and without the embedding.
+
+For every `--top`, the same hybrid query is sent to the index with all
+retrievable fields (what `SearchManager.search` did before `select`) and with
+`RESULT_FIELDS`, and the response body size and the time to decode it into
+`Document`s are reported. Once the embedding is hidden both runs return the
+same fields; use `--synthetic` to measure with generated hits instead
+(1536-dimension vectors, ~1000 characters of content each).
+
+    python -m script.bench_search_payload --query "有給休暇の申請方法" --top 3 10 50
+    python -m script.bench_search_payload --synthetic --top 3 10 50
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from os.path import abspath, dirname
+from typing import List, Optional
+
+import aiohttp
+from openai import AsyncAzureOpenAI
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.config import Config  # noqa: E402
+from app.constants import EMBEDING_MODEL  # noqa: E402
+from app.services.searchai_service import Document, RESULT_FIELDS  # noqa: E402
+
+API_VERSION = "2024-07-01"
+
+
+def parse(body: bytes) -> List[Document]:
+    return [
+        Document(
+            id=document.get("id"),
+            content=document.get("content"),
+            embedding=document.get("embedding"),
+            file_id=document.get("file_id"),
+            chat_type=document.get("chat_type"),
+            category=document.get("category"),
+            sourcepage=document.get("sourcepage"),
+            sourcefile=document.get("sourcefile"),
+            storageUrl=document.get("storageUrl"),
+            captions=document.get("@search.captions"),
+            score=document.get("@search.score"),
+            reranker_score=document.get("@search.rerankerScore"),
+        )
+        for document in json.loads(body)["value"]
+    ]
+
+
+def synthetic_body(top: int, with_embedding: bool) -> bytes:
+    documents = []
+    for i in range(top):
+        document = {
+            "@search.score": random.random(),
+            "id": f"file-{i}-0",
+            "content": "あ" * 1000,
+            "file_id": f"file-{i}",
+            "chat_type": "retrieve",
+            "category": None,
+            "sourcepage": f"file-{i}.pdf#page=1",
+            "sourcefile": f"file-{i}.pdf",
+            "storageUrl": f"https://example.blob.core.windows.net/files/file-{i}.pdf",
+        }
+        if with_embedding:
+            document["embedding"] = [random.uniform(-0.1, 0.1) for _ in range(1536)]
+        documents.append(document)
+    return json.dumps({"value": documents}).encode("utf-8")
+
+
+async def fetch_body(session: aiohttp.ClientSession, query: str, vector: List[float],
+                     top: int, select: Optional[List[str]]) -> bytes:
+    body = {
+        "search": query,
+        "top": top,
+        "vectorQueries": [{"kind": "vector", "vector": vector, "fields": "embedding", "k": 50}],
+    }
+    if select:
+        body["select"] = ",".join(select)
+    async with session.post(
+            f"https://{Config.SEARCH_SERVICE}.search.windows.net/indexes/{Config.SEARCH_INDEX}/docs/search",
+            params={"api-version": API_VERSION}, json=body,
+            headers={"api-key": Config.SEARCH_KEY}) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+def report(top: int, name: str, bodies: List[bytes]):
+    parse_ms = []
+    for body in bodies:
+        start = time.perf_counter()
+        parse(body)
+        parse_ms.append((time.perf_counter() - start) * 1000)
+    size = statistics.mean(len(body) for body in bodies)
+    print(f"top={top:<4} {name:<16} payload={size / 1024:9.1f} KiB  "
+          f"parse p50={statistics.median(parse_ms):7.2f}ms")
+
+
+async def main(args):
+    if args.synthetic:
+        for top in args.top:
+            report(top, "all fields", [synthetic_body(top, True) for _ in range(args.runs)])
+            report(top, "RESULT_FIELDS", [synthetic_body(top, False) for _ in range(args.runs)])
+        return
+
+    openai_client = AsyncAzureOpenAI(
+        api_key=Config.AZURE_OPENAI_KEY, api_version=Config.AZURE_OPENAI_API_VERSION,
+        azure_endpoint=f"https://{Config.AZURE_OPENAI_SERVICE}.openai.azure.com")
+    embedding = await openai_client.embeddings.create(
+        model=Config.OPENAI_MODEL[EMBEDING_MODEL], input=args.query)
+    vector = embedding.data[0].embedding
+    await openai_client.close()
+
+    async with aiohttp.ClientSession() as session:
+        for top in args.top:
+            for name, select in (("all fields", None), ("RESULT_FIELDS", RESULT_FIELDS)):
+                bodies = [await fetch_body(session, args.query, vector, top, select)
+                          for _ in range(args.runs)]
+                report(top, name, bodies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--query", default="test")
+    parser.add_argument("--top", type=int, nargs="+", default=[3, 10, 50])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--synthetic", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,119 @@
+"""
+Per-request latency of building services per request versus resolving them from the registry.
+
+The Cosmos, storage and search clients are replaced by stand-ins whose
+control-plane calls (`create_database_if_not_exists`,
+`create_container_if_not_exists`) take `--latency-ms`, like the Azure SDK
+round trips do. The "per-request" path reproduces what the original handlers
+paid on every call (a database and a container round trip for each
+ChatService/OpenaiService, plus rebuilding FileService's processors). The
+handler body itself is empty, so the numbers isolate what the registry removes
+from every request.
+
+    python -m script.bench_service_init --requests 50 --latency-ms 40
+"""
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from os.path import abspath, dirname
+
+from quart import Quart
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.services.file_service import FileService  # noqa: E402
+from app.services.registry import (init_services, get_chat_service, get_file_service,  # noqa: E402
+                                   get_openai_service, get_search_manager)
+
+
+class SlowCosmosStandIn:
+    round_trips = 0
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def create_database_if_not_exists(self, id):
+        return self._round_trip()
+
+    def create_container_if_not_exists(self, id, partition_key):
+        return self._round_trip()
+
+    def _round_trip(self):
+        SlowCosmosStandIn.round_trips += 1
+        time.sleep(self.latency)
+        return self
+
+
+class AsyncCosmosStandIn:
+    async def create_database_if_not_exists(self, id):
+        return self
+
+    async def create_container_if_not_exists(self, id, partition_key):
+        return self
+
+
+class StorageStandIn:
+    def get_container_client(self, container):
+        return self
+
+
+def build_app(latency: float) -> Quart:
+    app = Quart(__name__)
+    app.config.update(
+        OPENAI_MODEL={"gpt-4o": "gpt-4o", "text-embedding-ada-002": "text-embedding-ada-002"},
+        COSMOSDB_DATABASE="bench",
+        STORAGE_CONTAINER="bench",
+        SEARCH_INDEX="bench",
+        DOCUMENTINTELLIGENCE_SERVICE="https://bench.cognitiveservices.azure.com/",
+        DOCUMENTINTELLIGENCE_KEY="bench",
+        openai_client=object(),
+        cosmos_client=SlowCosmosStandIn(latency),
+        async_cosmos_client=AsyncCosmosStandIn(),
+        storage_client=StorageStandIn(),
+        async_storage_client=StorageStandIn(),
+        searchai_client=object(),
+        search_index_client=object(),
+    )
+    return app
+
+
+def per_request(cosmos: SlowCosmosStandIn):
+    # ChatService, OpenaiService and the OpenaiService inside SearchManager
+    # each resolved the database and the chat container
+    for _ in range(3):
+        cosmos.create_database_if_not_exists(id="bench").create_container_if_not_exists(
+            id="bench", partition_key=None)
+    return FileService()
+
+
+def from_registry():
+    return get_chat_service(), get_file_service(), get_search_manager(), get_openai_service()
+
+
+def measure(name: str, resolve, total: int):
+    SlowCosmosStandIn.round_trips = 0
+    latencies = []
+    for _ in range(total):
+        start = time.perf_counter()
+        resolve()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    print(f"{name:<12} p50={statistics.median(latencies):8.2f}ms  "
+          f"p95={latencies[int(len(latencies) * 0.95) - 1]:8.2f}ms  "
+          f"cosmos round trips/request={SlowCosmosStandIn.round_trips / total:.1f}")
+
+
+async def main(args):
+    app = build_app(args.latency_ms / 1000)
+    async with app.app_context():
+        measure("per-request", lambda: per_request(app.config["cosmos_client"]), args.requests)
+        await init_services(app)
+        measure("registry", from_registry, args.requests)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,71 @@
+"""
+Uploads files the way the frontend does with direct uploads, to try the flow
+end to end against a running backend: POST /files/uploads for SAS URLs, PUT
+of each file straight to storage, POST /files/<id>/complete, then polling of
+/files/<id>/status until the file is ingested.
+
+Against Azurite, start the backend with
+AZURE_STORAGE_ACCOUNT_URL=http://127.0.0.1:10000/devstoreaccount1 and the
+well-known devstoreaccount1 key as AZURE_STORAGE_KEY.
+
+    python -m script.direct_upload --api http://localhost:5000/api --token $TOKEN \\
+        --chat-id <chat_id> --category <category> docs/a.pdf docs/b.docx
+"""
+import os
+import sys
+import time
+import argparse
+
+import requests
+
+FILE_STATUS_UPLOADING = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--api", default="http://localhost:5000/api")
+    parser.add_argument("--token", default=os.getenv("TOKEN"), help="bearer token of the user")
+    parser.add_argument("--chat-id", required=True)
+    parser.add_argument("--chat-type", default="gpt")
+    parser.add_argument("--category", required=True)
+    parser.add_argument("--timeout", type=int, default=600, help="seconds to wait for ingestion")
+    args = parser.parse_args()
+
+    api = requests.Session()
+    api.headers["Authorization"] = f"Bearer {args.token}"
+    res = api.post(f"{args.api}/files/uploads", json={
+        "chat_id": args.chat_id,
+        "chat_type": args.chat_type,
+        "category": args.category,
+        "files": [{"name": os.path.basename(path), "size": os.path.getsize(path)} for path in args.paths],
+    })
+    res.raise_for_status()
+    sessions = res.json()["files"]
+
+    for path, upload in zip(args.paths, sessions):
+        started = time.perf_counter()
+        with open(path, "rb") as f:
+            # a single Put Blob, up to 5000 MiB
+            requests.put(upload["upload_url"], data=f, headers=upload["headers"]).raise_for_status()
+        print(f"{upload['name']}: uploaded in {time.perf_counter() - started:.2f}s")
+        api.post(f"{args.api}/files/{upload['file_id']}/complete").raise_for_status()
+
+    deadline = time.monotonic() + args.timeout
+    pending = {upload["file_id"] for upload in sessions}
+    while pending and time.monotonic() < deadline:
+        time.sleep(2)
+        for file_id in sorted(pending):
+            progress = api.get(f"{args.api}/files/{file_id}/status").json()
+            if progress["status"] != FILE_STATUS_UPLOADING:
+                pending.discard(file_id)
+                job = progress["job"] or {}
+                print(f"{progress['name']}: status {progress['status']}, "
+                      f"{progress['chunk_count']} chunks, {job.get('last_error') or 'ok'}")
+    if pending:
+        print(f"still ingesting after {args.timeout}s: {', '.join(sorted(pending))}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Online migration of chat contents from `ChatInformation` (partitioned by /type)
+to `ChatContents` (partitioned by /chat_id).
+
+Rollout:
+  1. deploy with CHAT_CONTENT_STORE_MODE=dual, so new turns are written to both containers
+  2. python -m script.migrate_chat_contents copy      (resumable, re-run after an interruption)
+  3. python -m script.migrate_chat_contents verify
+  4. switch to CHAT_CONTENT_STORE_MODE=partitioned
+  5. python -m script.migrate_chat_contents measure   (RU and latency, old vs new layout)
+
+`copy` pages through each legacy partition and upserts every item into the new
+container, so it is idempotent and safe to run alongside dual writes. Its
+progress (continuation token per partition, item count and RU charge) is saved
+to the checkpoint file after every page.
+"""
+import sys
+import json
+import time
+import argparse
+import statistics
+from os.path import abspath, dirname, exists
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.cosmos import CosmosClient, PartitionKey, ContainerProxy
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.config import Config  # noqa: E402
+from app.constants import CHAT_CONTAINER, CHAT_CONTENT_CONTAINER  # noqa: E402
+
+CHAT_TYPES = ["gpt", "retrieve"]
+
+
+def request_charge(container: ContainerProxy) -> float:
+    return float(container.client_connection.last_response_headers.get("x-ms-request-charge", 0))
+
+
+def open_containers():
+    client = CosmosClient(url=Config.COSMOSDB_ENDPOINT, credential=Config.COSMOSDB_KEY)
+    database = client.create_database_if_not_exists(id=Config.COSMOSDB_DATABASE)
+    legacy = database.create_container_if_not_exists(
+        id=CHAT_CONTAINER, partition_key=PartitionKey(path="/type"))
+    partitioned = database.create_container_if_not_exists(
+        id=CHAT_CONTENT_CONTAINER, partition_key=PartitionKey(path="/chat_id"))
+    return legacy, partitioned
+
+
+def load_checkpoint(path: str) -> dict:
+    if exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return {chat_type: {"continuation": None, "copied": 0, "done": False, "read_ru": 0.0, "write_ru": 0.0}
+            for chat_type in CHAT_TYPES}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+
+
+def copy(args):
+    legacy, partitioned = open_containers()
+    checkpoint = load_checkpoint(args.checkpoint)
+
+    def upsert(item: dict) -> float:
+        body = {k: v for k, v in item.items() if not k.startswith("_")}
+        charge = []
+        # last_response_headers is shared between threads, so read the charge from the hook
+        partitioned.upsert_item(body, response_hook=lambda headers, _: charge.append(
+            float(headers.get("x-ms-request-charge", 0))))
+        return sum(charge)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for chat_type in CHAT_TYPES:
+            state = checkpoint[chat_type]
+            if state["done"]:
+                print(f"{chat_type}: already copied {state['copied']} items")
+                continue
+            pages = legacy.query_items(
+                query="SELECT * FROM c WHERE c.type=@type",
+                parameters=[dict(name="@type", value=chat_type)],
+                partition_key=chat_type,
+                max_item_count=args.page_size,
+            ).by_page(state["continuation"])
+            for page in pages:
+                items = list(page)
+                state["read_ru"] += request_charge(legacy)
+                state["write_ru"] += sum(executor.map(upsert, items))
+                state["copied"] += len(items)
+                state["continuation"] = pages.continuation_token
+                save_checkpoint(args.checkpoint, checkpoint)
+                print(f"{chat_type}: copied {state['copied']} items "
+                      f"(read {state['read_ru']:.1f} RU, write {state['write_ru']:.1f} RU)")
+                if not state["continuation"]:
+                    break
+            state["done"] = True
+            save_checkpoint(args.checkpoint, checkpoint)
+
+
+def verify(args):
+    legacy, partitioned = open_containers()
+    COUNT_QUERY = "SELECT VALUE COUNT(1) FROM c"
+    legacy_count = sum(
+        list(legacy.query_items(COUNT_QUERY, partition_key=chat_type))[0] for chat_type in CHAT_TYPES)
+    partitioned_count = list(partitioned.query_items(
+        COUNT_QUERY, enable_cross_partition_query=True))[0]
+    print(f"{CHAT_CONTAINER}: {legacy_count} items / {CHAT_CONTENT_CONTAINER}: {partitioned_count} items")
+    if partitioned_count < legacy_count:
+        print("The copy is incomplete, run `copy` again before switching to the partitioned mode.")
+        sys.exit(1)
+
+
+def measure(args):
+    legacy, partitioned = open_containers()
+    sample = list(partitioned.query_items(
+        "SELECT DISTINCT VALUE c.chat_id FROM c", enable_cross_partition_query=True,
+        max_item_count=args.sample))[:args.sample]
+
+    def run(name: str, query_chat):
+        charges, latencies = [], []
+        for chat_id in sample:
+            start = time.perf_counter()
+            container, items = query_chat(chat_id)
+            latencies.append((time.perf_counter() - start) * 1000)
+            charges.append(request_charge(container))
+        latencies.sort()
+        print(f"{name:<32} RU avg={statistics.mean(charges):7.2f}  "
+              f"latency p50={statistics.median(latencies):7.2f}ms  "
+              f"p95={latencies[max(int(len(latencies) * 0.95) - 1, 0)]:7.2f}ms")
+
+    def query_legacy(chat_id):
+        # as the original getChatContents did
+        items = list(legacy.query_items(
+            query="SELECT * FROM c WHERE c.chat_id=@chat_id ORDER BY c.index",
+            parameters=[dict(name="@chat_id", value=chat_id)],
+            enable_cross_partition_query=True))
+        return legacy, items
+
+    def query_partitioned(chat_id):
+        items = list(partitioned.query_items(
+            query="SELECT * FROM c WHERE c.chat_id=@chat_id ORDER BY c.index",
+            parameters=[dict(name="@chat_id", value=chat_id)],
+            partition_key=chat_id))
+        return partitioned, items
+
+    print(f"{len(sample)} chats")
+    run(f"{CHAT_CONTAINER} (cross-partition)", query_legacy)
+    run(f"{CHAT_CONTENT_CONTAINER} (single partition)", query_partitioned)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    copy_parser = subparsers.add_parser("copy")
+    copy_parser.add_argument("--checkpoint", default="migrate_chat_contents.checkpoint.json")
+    copy_parser.add_argument("--page-size", type=int, default=500)
+    copy_parser.add_argument("--concurrency", type=int, default=8)
+    copy_parser.set_defaults(func=copy)
+    verify_parser = subparsers.add_parser("verify")
+    verify_parser.set_defaults(func=verify)
+    measure_parser = subparsers.add_parser("measure")
+    measure_parser.add_argument("--sample", type=int, default=50)
+    measure_parser.set_defaults(func=measure)
+    args = parser.parse_args()
+    args.func(args)
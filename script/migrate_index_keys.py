@@ -0,0 +1,94 @@
+"""
+Re-keys the search index documents of files ingested before deterministic chunk keys.
+
+Old documents are keyed by the file *name* (`file-<name>-<base16 name>-page-<n>`).
+For every `files` row whose `chunk_count` is still NULL, this tool reads the
+file's documents, uploads them again under `<file id>-<ordinal>` (ordinal in
+the old page order), deletes the old keys and records `chunk_count`, after which
+the file can be removed by key without polling. Files that are already migrated
+are skipped, so the tool can be re-run after an interruption.
+
+Run `alembic upgrade head` first so that `files.chunk_count` exists, and run
+this tool before `script/upgrade_index_schema.py hide-embedding`: documents are
+copied with their vectors, which cannot be read back once the field is hidden.
+
+    python -m script.migrate_index_keys [--dry-run]
+"""
+import re
+import sys
+import asyncio
+import argparse
+from os.path import abspath, dirname
+
+from sqlalchemy import update
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.config import Config  # noqa: E402
+from app.models.file import File  # noqa: E402
+from app.services.searchai_service import Section  # noqa: E402
+
+LEGACY_ORDINAL = re.compile(r"-page-(\d+)$")
+MAX_BATCH_SIZE = 1000
+
+
+def legacy_ordinal(document_id: str) -> int:
+    match = LEGACY_ORDINAL.search(document_id)
+    return int(match.group(1)) if match else 0
+
+
+async def migrate_file(search_client: SearchClient, file: File, dry_run: bool) -> int:
+    results = await search_client.search(search_text="", filter=f"file_id eq '{file.id}'")
+    documents = [{k: v for k, v in document.items() if not k.startswith("@")}
+                 async for document in results]
+    if any("embedding" not in document for document in documents):
+        raise RuntimeError(f"{file.id}: the embedding field is not retrievable, the documents cannot be copied")
+    documents.sort(key=lambda document: legacy_ordinal(document["id"]))
+
+    old_ids = [document["id"] for document in documents]
+    for ordinal, document in enumerate(documents):
+        document["id"] = Section.document_id(file.id, ordinal)
+    stale_ids = sorted(set(old_ids) - {document["id"] for document in documents})
+
+    if dry_run:
+        return len(documents)
+    for i in range(0, len(documents), MAX_BATCH_SIZE):
+        await search_client.upload_documents(documents[i: i + MAX_BATCH_SIZE])
+    for i in range(0, len(stale_ids), MAX_BATCH_SIZE):
+        await search_client.delete_documents([{"id": document_id} for document_id in stale_ids[i: i + MAX_BATCH_SIZE]])
+    return len(documents)
+
+
+async def main(args):
+    engine = create_async_engine(Config.DATABASE_URI)
+    SessionLocal = sessionmaker(bind=engine, class_=AsyncSession)
+    search_client = SearchClient(endpoint=f"https://{Config.SEARCH_SERVICE}.search.windows.net/",
+                                 index_name=Config.SEARCH_INDEX,
+                                 credential=AzureKeyCredential(Config.SEARCH_KEY))
+    try:
+        async with SessionLocal() as session:
+            result = await session.execute(select(File).where(File.chunk_count.is_(None)))
+            files = result.scalars().all()
+        print(f"{len(files)} files to migrate")
+
+        for index, file in enumerate(files, start=1):
+            chunk_count = await migrate_file(search_client, file, args.dry_run)
+            if not args.dry_run:
+                async with SessionLocal() as session:
+                    await session.execute(
+                        update(File).where(File.id == file.id).values(chunk_count=chunk_count))
+                    await session.commit()
+            print(f"[{index}/{len(files)}] {file.id} ({file.name}): {chunk_count} chunks")
+    finally:
+        await search_client.close()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true")
+    asyncio.run(main(parser.parse_args()))
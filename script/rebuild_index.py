@@ -0,0 +1,268 @@
+"""
+Blue/green rebuild of the search index with a different vector profile.
+
+    python -m script.rebuild_index build --target aichat-v2 --compression scalar
+    python -m script.rebuild_index compare --target aichat-v2 --queries queries.txt --top 10
+    python -m script.rebuild_index swap --target aichat-v2
+
+`build` creates the target index (the profile is taken from the SEARCH_VECTOR_*
+settings, overridable on the command line) and copies every file's sections
+from the current index (AZURE_SEARCH_INDEX), re-embedding the content with the
+target dimensions. Files already copied are skipped, so run it again right
+before the swap to pick up files ingested in the meantime.
+
+`compare` runs each query against both indexes and reports recall@top against
+an exhaustive (exact) search on the current index, latency and index size.
+
+`swap` checks that every file has been copied and prints the settings to
+deploy. The pinned azure-search-documents has no index aliases, so the app
+switches indexes through AZURE_SEARCH_INDEX; the old index is left in place
+for rollback and can be deleted with `drop --target <old name>` afterwards.
+Set AZURE_OPENAI_EMBEDDING_DIMENSIONS together with SEARCH_VECTOR_DIMENSIONS
+when the dimensions change, otherwise query vectors will not match the index.
+
+Vectors are requested with the target dimensions when the embedding model
+takes them: AZURE_OPENAI_EMBEDDING_DIMENSIONS is set, or the model
+(AZURE_OPENAI_EMBEDDING_MODEL, else the deployment name) is text-embedding-3-*.
+ada-002 rejects the parameter and only produces 1536 dimensions.
+"""
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from os.path import abspath, dirname
+from typing import List
+
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from openai import NOT_GIVEN, AsyncAzureOpenAI
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+from azure.search.documents.models import VectorizedQuery
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.config import Config  # noqa: E402
+from app.constants import EMBEDING_MODEL  # noqa: E402
+from app.models.file import File  # noqa: E402
+from app.services.retry_policy import RetryPolicy  # noqa: E402
+from app.services.searchai_service import RESULT_FIELDS, VectorProfile, build_index  # noqa: E402
+
+ENDPOINT = f"https://{Config.SEARCH_SERVICE}.search.windows.net/"
+EMBEDDING_BATCH_SIZE = 16
+MAX_BATCH_SIZE = 1000
+
+
+def takes_dimensions() -> bool:
+    """Whether the embedding model takes the `dimensions` parameter, from the configuration."""
+    if Config.AZURE_OPENAI_EMBEDDING_DIMENSIONS:
+        return True
+    model = Config.AZURE_OPENAI_EMBEDDING_MODEL or Config.OPENAI_MODEL[EMBEDING_MODEL] or ""
+    return model.startswith("text-embedding-3")
+
+
+class Embedder:
+    def __init__(self):
+        self.client = AsyncAzureOpenAI(
+            api_key=Config.AZURE_OPENAI_KEY, api_version=Config.AZURE_OPENAI_API_VERSION,
+            azure_endpoint=f"https://{Config.AZURE_OPENAI_SERVICE}.openai.azure.com", max_retries=0)
+        self.retry_policy = RetryPolicy("rebuild_index", deadline=600)
+        self.takes_dimensions = takes_dimensions()
+
+    async def embed(self, texts: List[str], dimensions: int) -> List[List[float]]:
+        if not self.takes_dimensions:
+            if dimensions != 1536:
+                raise SystemExit(f"{dimensions} dimensions need a text-embedding-3 deployment, "
+                                 "set AZURE_OPENAI_EMBEDDING_MODEL if its name does not say so")
+            # ada-002 rejects the parameter
+            dimensions = NOT_GIVEN
+        embeddings = []
+        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            response = await self.retry_policy.call(lambda: self.client.embeddings.create(
+                model=Config.OPENAI_MODEL[EMBEDING_MODEL], input=texts[i: i + EMBEDDING_BATCH_SIZE],
+                dimensions=dimensions))
+            embeddings.extend(data.embedding for data in response.data)
+        return embeddings
+
+    async def close(self):
+        await self.client.close()
+
+
+def search_client(index_name: str) -> SearchClient:
+    return SearchClient(endpoint=ENDPOINT, index_name=index_name,
+                        credential=AzureKeyCredential(Config.SEARCH_KEY))
+
+
+async def list_files() -> List[File]:
+    engine = create_async_engine(Config.DATABASE_URI)
+    try:
+        async with sessionmaker(bind=engine, class_=AsyncSession)() as session:
+            result = await session.execute(select(File))
+            return result.scalars().all()
+    finally:
+        await engine.dispose()
+
+
+async def count_documents(client: SearchClient, file_id: str) -> int:
+    results = await client.search(search_text="", filter=f"file_id eq '{file_id}'",
+                                  include_total_count=True, top=0)
+    return await results.get_count()
+
+
+def target_profile(args) -> VectorProfile:
+    profile = VectorProfile.from_config(Config.__dict__)
+    if args.dimensions:
+        profile.dimensions = args.dimensions
+    if args.compression:
+        profile.compression = args.compression
+    if args.no_rescore:
+        profile.rescore = False
+    if args.oversampling:
+        profile.oversampling = args.oversampling
+    return profile
+
+
+async def build(index_client: SearchIndexClient, args):
+    profile = target_profile(args)
+    if args.target not in [name async for name in index_client.list_index_names()]:
+        await index_client.create_index(build_index(args.target, profile))
+        print(f"created {args.target}: {profile}")
+
+    files = await list_files()
+    embedder = Embedder()
+    source, target = search_client(Config.SEARCH_INDEX), search_client(args.target)
+    try:
+        for number, file in enumerate(files, start=1):
+            if await count_documents(target, file.id) > 0:
+                continue
+            results = await source.search(search_text="", filter=f"file_id eq '{file.id}'", select=RESULT_FIELDS)
+            documents = [{k: v for k, v in document.items() if not k.startswith("@")}
+                         async for document in results]
+            if not documents:
+                continue
+            embeddings = await embedder.embed([document["content"] for document in documents], profile.dimensions)
+            for document, embedding in zip(documents, embeddings):
+                document["embedding"] = embedding
+            for i in range(0, len(documents), MAX_BATCH_SIZE):
+                await target.upload_documents(documents[i: i + MAX_BATCH_SIZE])
+            print(f"[{number}/{len(files)}] {file.id}: {len(documents)} sections")
+    finally:
+        await embedder.close()
+        await source.close()
+        await target.close()
+
+
+async def timed_search(client: SearchClient, vector: List[float], top: int, exhaustive: bool = False):
+    start = time.perf_counter()
+    results = await client.search(
+        search_text=None, select=["id"], top=top,
+        vector_queries=[VectorizedQuery(vector=vector, k_nearest_neighbors=top,
+                                        fields="embedding", exhaustive=exhaustive)])
+    ids = [document["id"] async for document in results]
+    return ids, (time.perf_counter() - start) * 1000
+
+
+async def compare(index_client: SearchIndexClient, args):
+    with open(args.queries, encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    source_name, target_name = Config.SEARCH_INDEX, args.target
+    dimensions = {}
+    for name in (source_name, target_name):
+        index = await index_client.get_index(name)
+        dimensions[name] = next(
+            field.vector_search_dimensions for field in index.fields if field.name == "embedding")
+
+    embedder = Embedder()
+    clients = {source_name: search_client(source_name), target_name: search_client(target_name)}
+    recalls = {source_name: [], target_name: []}
+    latencies = {source_name: [], target_name: []}
+    try:
+        for query in queries:
+            source_vector, = await embedder.embed([query], dimensions[source_name])
+            truth, _ = await timed_search(clients[source_name], source_vector, args.top, exhaustive=True)
+            if not truth:
+                continue
+            target_vector, = (await embedder.embed([query], dimensions[target_name])
+                              if dimensions[target_name] != dimensions[source_name] else [source_vector])
+            for name, vector in ((source_name, source_vector), (target_name, target_vector)):
+                ids, latency = await timed_search(clients[name], vector, args.top)
+                recalls[name].append(len(set(ids) & set(truth)) / len(truth))
+                latencies[name].append(latency)
+
+        print(f"{len(recalls[source_name])} queries, recall@{args.top} against an exhaustive search on {source_name}")
+        for name in (source_name, target_name):
+            stats = await index_client.get_index_statistics(name)
+            latency = sorted(latencies[name])
+            print(f"{name:<32} recall={statistics.mean(recalls[name]):.3f}  "
+                  f"latency p50={statistics.median(latency):7.2f}ms "
+                  f"p95={latency[max(int(len(latency) * 0.95) - 1, 0)]:7.2f}ms  "
+                  f"storage={stats['storage_size'] / 1024 / 1024:9.1f}MiB "
+                  f"vector index={stats['vector_index_size'] / 1024 / 1024:9.1f}MiB")
+    finally:
+        await embedder.close()
+        for client in clients.values():
+            await client.close()
+
+
+async def swap(index_client: SearchIndexClient, args):
+    files = await list_files()
+    source, target = search_client(Config.SEARCH_INDEX), search_client(args.target)
+    try:
+        missing = [file.id for file in files
+                   if await count_documents(target, file.id) < await count_documents(source, file.id)]
+    finally:
+        await source.close()
+        await target.close()
+    if missing:
+        print(f"{len(missing)} files are not fully copied yet, run `build` again: {', '.join(missing[:10])}")
+        sys.exit(1)
+    index = await index_client.get_index(args.target)
+    field = next(field for field in index.fields if field.name == "embedding")
+    print("Deploy with:")
+    print(f"  AZURE_SEARCH_INDEX={args.target}")
+    print(f"  SEARCH_VECTOR_DIMENSIONS={field.vector_search_dimensions}")
+    if takes_dimensions():
+        print(f"  AZURE_OPENAI_EMBEDDING_DIMENSIONS={field.vector_search_dimensions}")
+    print(f"{Config.SEARCH_INDEX} is kept for rollback.")
+
+
+async def drop(index_client: SearchIndexClient, args):
+    if args.target == Config.SEARCH_INDEX:
+        print(f"{args.target} is the index in use (AZURE_SEARCH_INDEX)")
+        sys.exit(1)
+    await index_client.delete_index(args.target)
+    print(f"deleted {args.target}")
+
+
+async def main(args):
+    index_client = SearchIndexClient(endpoint=ENDPOINT, credential=AzureKeyCredential(Config.SEARCH_KEY))
+    try:
+        await args.func(index_client, args)
+    finally:
+        await index_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--target", required=True)
+    build_parser.add_argument("--dimensions", type=int)
+    build_parser.add_argument("--compression", choices=["none", "scalar", "binary"])
+    build_parser.add_argument("--no-rescore", action="store_true")
+    build_parser.add_argument("--oversampling", type=float)
+    build_parser.set_defaults(func=build)
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("--target", required=True)
+    compare_parser.add_argument("--queries", required=True, help="one query per line")
+    compare_parser.add_argument("--top", type=int, default=10)
+    compare_parser.set_defaults(func=compare)
+    swap_parser = subparsers.add_parser("swap")
+    swap_parser.add_argument("--target", required=True)
+    swap_parser.set_defaults(func=swap)
+    drop_parser = subparsers.add_parser("drop")
+    drop_parser.add_argument("--target", required=True)
+    drop_parser.set_defaults(func=drop)
+    asyncio.run(main(parser.parse_args()))
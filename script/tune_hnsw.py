@@ -0,0 +1,191 @@
+"""
+Recall@k versus latency of HNSW parameters, against an exact NumPy ground truth.
+
+Chunk vectors of the configured embedding deployment (and
+AZURE_OPENAI_EMBEDDING_DIMENSIONS) are sampled from the chunk embedding store
+(CHUNK_EMBEDDING_STORE_PATH, see ChunkEmbeddingStore) or generated with
+`--synthetic`. Queries are embedded from `--queries` (one per line) or, without
+it, held-out chunks are used as queries. The exact top-k of every query is
+computed with a brute-force cosine pass, then hnswlib, a local stand-in for
+the Azure AI Search HNSW index, is built and queried for every combination of
+`--m`, `--ef-construction`, `--ef-search` and `--k`.
+
+Azure AI Search searches with max(efSearch, k) candidates, so does this tool.
+The cheapest setting that reaches `--target-recall` is printed for each k as
+SEARCH_HNSW_* / SEARCH_KNN settings (applied to indexes created from then on,
+see script/rebuild_index.py).
+
+hnswlib is only needed for this tool: pip install hnswlib
+
+    python -m script.tune_hnsw --sample 20000 --queries queries.txt
+    python -m script.tune_hnsw --synthetic --sample 20000 --m 4 8 16 --ef-search 50 100 500
+"""
+import os
+import sys
+import time
+import sqlite3
+import asyncio
+import argparse
+import statistics
+from os.path import abspath, dirname
+from typing import List, Optional
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.config import Config  # noqa: E402
+from app.constants import EMBEDING_MODEL  # noqa: E402
+from app.services.embedding_cache import embedding_model_key  # noqa: E402
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def load_store_vectors(path: Optional[str], sample: int, model: str) -> np.ndarray:
+    if not path or path == ":memory:" or not os.path.isfile(path):
+        raise SystemExit(f"no chunk embedding store at {path!r}, "
+                         "set CHUNK_EMBEDDING_STORE_PATH or --store, or use --synthetic")
+    try:
+        # read only, so that a wrong path is not turned into an empty store
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = connection.execute(
+                "SELECT vector FROM vectors WHERE model = ? ORDER BY RANDOM() LIMIT ?",
+                (model, sample)).fetchall()
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        raise SystemExit(f"{path} is not a readable chunk embedding store ({e}), "
+                         "start the app once to upgrade it or use --synthetic")
+    if not rows:
+        raise SystemExit(f"{path} has no vectors of {model}, ingest some files first or use --synthetic")
+    return np.stack([np.frombuffer(data, dtype=np.float32) for data, in rows])
+
+
+def synthetic_vectors(sample: int, dimensions: int, seed: int) -> np.ndarray:
+    # clustered like real corpora, where chunks of a document sit close together
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(sample // 50, 1), dimensions))
+    vectors = centers[rng.integers(len(centers), size=sample)] + \
+        rng.normal(scale=0.6, size=(sample, dimensions))
+    return vectors.astype(np.float32)
+
+
+async def embed_queries(path: str) -> np.ndarray:
+    from openai import NOT_GIVEN, AsyncAzureOpenAI
+
+    with open(path, encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    client = AsyncAzureOpenAI(
+        api_key=Config.AZURE_OPENAI_KEY, api_version=Config.AZURE_OPENAI_API_VERSION,
+        azure_endpoint=f"https://{Config.AZURE_OPENAI_SERVICE}.openai.azure.com")
+    try:
+        embeddings = []
+        for i in range(0, len(queries), 16):
+            response = await client.embeddings.create(
+                model=Config.OPENAI_MODEL[EMBEDING_MODEL], input=queries[i: i + 16],
+                dimensions=Config.AZURE_OPENAI_EMBEDDING_DIMENSIONS or NOT_GIVEN)
+            embeddings.extend(data.embedding for data in response.data)
+    finally:
+        await client.close()
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k most similar corpus vectors per query, best first (inputs normalized)."""
+    similarities = queries @ corpus.T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[max(int(len(values) * p) - 1, 0)]
+
+
+def main(args):
+    if hnswlib is None:
+        raise SystemExit("hnswlib is required: pip install hnswlib")
+
+    if args.synthetic:
+        vectors = synthetic_vectors(args.sample + args.num_queries, args.dimensions, args.seed)
+    else:
+        model = embedding_model_key(Config.OPENAI_MODEL[EMBEDING_MODEL], Config.AZURE_OPENAI_EMBEDDING_DIMENSIONS)
+        vectors = load_store_vectors(args.store, args.sample + (0 if args.queries else args.num_queries), model)
+    if args.queries:
+        corpus, queries = vectors, asyncio.run(embed_queries(args.queries))
+        if queries.shape[1] != corpus.shape[1]:
+            raise SystemExit(f"queries have {queries.shape[1]} dimensions, chunks {corpus.shape[1]}")
+    else:
+        corpus, queries = vectors[args.num_queries:], vectors[:args.num_queries]
+    corpus, queries = normalize(corpus), normalize(queries)
+    max_k = max(args.k)
+    print(f"{len(corpus)} chunks, {len(queries)} queries, {corpus.shape[1]} dimensions")
+
+    start = time.perf_counter()
+    truth = exact_top_k(corpus, queries, max_k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"exact search (NumPy brute force): {exact_ms:.2f}ms per query")
+
+    results = []
+    print(f"{'m':>3} {'efC':>5} {'efS':>5} {'k':>4} {'build s':>8} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for m in args.m:
+        for ef_construction in args.ef_construction:
+            index = hnswlib.Index(space="cosine", dim=corpus.shape[1])
+            index.init_index(max_elements=len(corpus), M=m, ef_construction=ef_construction, random_seed=args.seed)
+            start = time.perf_counter()
+            index.add_items(corpus, np.arange(len(corpus)), num_threads=args.threads)
+            build_seconds = time.perf_counter() - start
+            for ef_search in args.ef_search:
+                for k in args.k:
+                    index.set_ef(max(ef_search, k))
+                    latencies, recalls = [], []
+                    for query, expected in zip(queries, truth):
+                        start = time.perf_counter()
+                        labels, _ = index.knn_query(query, k=k, num_threads=1)
+                        latencies.append((time.perf_counter() - start) * 1000)
+                        recalls.append(len(set(labels[0]) & set(expected[:k])) / k)
+                    result = dict(m=m, ef_construction=ef_construction, ef_search=ef_search, k=k,
+                                  recall=statistics.mean(recalls), p50=statistics.median(latencies),
+                                  p95=percentile(latencies, 0.95))
+                    results.append(result)
+                    print(f"{m:>3} {ef_construction:>5} {ef_search:>5} {k:>4} {build_seconds:>8.2f} "
+                          f"{result['recall']:>7.3f} {result['p50']:>8.3f} {result['p95']:>8.3f}")
+
+    print(f"\ncheapest settings with recall >= {args.target_recall}:")
+    for k in args.k:
+        candidates = [r for r in results if r["k"] == k and r["recall"] >= args.target_recall]
+        if not candidates:
+            print(f"  k={k}: none, widen the sweep")
+            continue
+        best = min(candidates, key=lambda r: r["p95"])
+        print(f"  k={k}: SEARCH_HNSW_M={best['m']} SEARCH_HNSW_EF_CONSTRUCTION={best['ef_construction']} "
+              f"SEARCH_HNSW_EF_SEARCH={best['ef_search']} SEARCH_KNN={k} "
+              f"(recall {best['recall']:.3f}, p95 {best['p95']:.3f}ms)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", default=Config.CHUNK_EMBEDDING_STORE_PATH)
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--dimensions", type=int, default=Config.SEARCH_VECTOR_DIMENSIONS,
+                        help="dimensions of --synthetic vectors")
+    parser.add_argument("--sample", type=int, default=20000)
+    parser.add_argument("--queries", help="queries to embed, one per line")
+    parser.add_argument("--num-queries", type=int, default=200,
+                        help="held-out chunks used as queries when --queries is not given")
+    parser.add_argument("--m", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[100, 400])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[50, 100, 200, 500])
+    parser.add_argument("--k", type=int, nargs="+", default=[3, 10, 50])
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+"""
+Upgrades the schema of an existing search index in place.
+
+    python -m script.upgrade_index_schema status
+    python -m script.upgrade_index_schema hide-embedding
+
+`hide-embedding` marks the `embedding` field as non-retrievable (`hidden`),
+which Azure AI Search allows on a live index, so search hits no longer carry
+the vectors even when a caller forgets `select`. Vector search is unaffected.
+
+`stored=False` additionally drops the retrievable copy of the vectors from
+storage, but it can only be set when the field is created. Indexes created by
+`SearchManager.create_index` get it (unless SEARCH_EMBEDDING_STORED=true); an
+existing index keeps its stored copy until it is rebuilt.
+
+Files ingested before deterministic chunk keys are re-keyed by copying their
+documents *with* vectors (`script/migrate_index_keys.py`), so this tool refuses
+to hide the field while such files remain.
+"""
+import sys
+import asyncio
+import argparse
+from os.path import abspath, dirname
+
+from sqlalchemy import func
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.indexes.aio import SearchIndexClient
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from app.config import Config  # noqa: E402
+from app.models.file import File  # noqa: E402
+
+
+def embedding_field(index):
+    return next(field for field in index.fields if field.name == "embedding")
+
+
+async def count_unmigrated_files() -> int:
+    engine = create_async_engine(Config.DATABASE_URI)
+    try:
+        async with sessionmaker(bind=engine, class_=AsyncSession)() as session:
+            result = await session.execute(
+                select(func.count()).select_from(File).where(File.chunk_count.is_(None)))
+            return result.scalar_one()
+    finally:
+        await engine.dispose()
+
+
+async def status(index_client: SearchIndexClient, args):
+    field = embedding_field(await index_client.get_index(Config.SEARCH_INDEX))
+    print(f"{Config.SEARCH_INDEX}.embedding: retrievable={not field.hidden} stored={field.stored}")
+
+
+async def hide_embedding(index_client: SearchIndexClient, args):
+    unmigrated = await count_unmigrated_files()
+    if unmigrated:
+        print(f"{unmigrated} files still use the old document keys, run script/migrate_index_keys.py first.")
+        sys.exit(1)
+    index = await index_client.get_index(Config.SEARCH_INDEX)
+    field = embedding_field(index)
+    if field.hidden:
+        print(f"{Config.SEARCH_INDEX}.embedding is already hidden")
+        return
+    field.hidden = True
+    await index_client.create_or_update_index(index)
+    print(f"{Config.SEARCH_INDEX}.embedding is now hidden")
+
+
+async def main(args):
+    index_client = SearchIndexClient(endpoint=f"https://{Config.SEARCH_SERVICE}.search.windows.net/",
+                                     credential=AzureKeyCredential(Config.SEARCH_KEY))
+    try:
+        await args.func(index_client, args)
+    finally:
+        await index_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status").set_defaults(func=status)
+    subparsers.add_parser("hide-embedding").set_defaults(func=hide_embedding)
+    asyncio.run(main(parser.parse_args()))
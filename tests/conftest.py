@@ -0,0 +1,40 @@
+import asyncio
+from typing import Awaitable, Callable, TypeVar
+import pytest
+from quart import Quart
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from app.database import Base
+from app.models.file import File
+from app.models.ingestionjob import IngestionJob
+
+T = TypeVar("T")
+
+
+@pytest.fixture
+def app() -> Quart:
+    return Quart(__name__)
+
+
+@pytest.fixture
+def run(app: Quart, tmp_path) -> Callable[[Callable[[], Awaitable[T]]], T]:
+    """
+    Runs `scenario()` in an app context whose database is a fresh SQLite file
+    holding the files and ingestion_jobs tables (a file rather than memory, so
+    that concurrent sessions have their own connection, as with MySQL).
+    """
+    def run(scenario: Callable[[], Awaitable[T]]) -> T:
+        async def main() -> T:
+            engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all, tables=[File.__table__, IngestionJob.__table__])
+            app.config['db_engine'] = engine
+            app.config['SessionLocal'] = sessionmaker(
+                autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+            try:
+                async with app.app_context():
+                    return await scenario()
+            finally:
+                await engine.dispose()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,53 @@
+import pytest
+from app.services.blob_downloader import RangeNotSatisfiable, content_disposition, parse_range
+
+
+@pytest.mark.parametrize("header, size, expected", [
+    ("bytes=0-99", 1000, (0, 99)),
+    ("bytes=100-", 1000, (100, 999)),
+    # the end is clamped to the last byte
+    ("bytes=900-2000", 1000, (900, 999)),
+    # suffix ranges: the last N bytes
+    ("bytes=-100", 1000, (900, 999)),
+    ("bytes=-2000", 1000, (0, 999)),
+    (" bytes=0-0 ", 1000, (0, 0)),
+])
+def test_parse_range(header, size, expected):
+    assert parse_range(header, size) == expected
+
+
+@pytest.mark.parametrize("header", [
+    None,
+    "",
+    "bytes=-",
+    # several ranges and other units are answered with the whole content
+    "bytes=0-9,20-29",
+    "items=0-9",
+    "bytes=abc",
+    # invalid: last before first
+    "bytes=10-5",
+])
+def test_parse_range_ignores_unsupported_headers(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),
+    ("bytes=1000-2000", 1000),
+    ("bytes=-0", 1000),
+    # no byte of an empty blob can be sent
+    ("bytes=0-", 0),
+    ("bytes=-100", 0),
+])
+def test_parse_range_not_satisfiable(header, size):
+    with pytest.raises(RangeNotSatisfiable) as error:
+        parse_range(header, size)
+    assert error.value.status_code == 416
+    assert error.value.size == size
+
+
+def test_content_disposition_keeps_non_ascii_names_in_filename_star():
+    assert content_disposition("報告書 2024.pdf") == \
+        "attachment; filename=\"2024.pdf\"; filename*=UTF-8''%E5%A0%B1%E5%91%8A%E6%9B%B8%202024.pdf"
+    assert content_disposition("資料.pdf").startswith('attachment; filename=".pdf"')
+    assert content_disposition("資料") == "attachment; filename=\"download\"; filename*=UTF-8''%E8%B3%87%E6%96%99"
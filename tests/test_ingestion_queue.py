@@ -0,0 +1,227 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Optional
+from sqlalchemy import update
+from sqlalchemy.future import select
+from app.constants import (FILE_STATUS_UPLOADING, FILE_STATUS_SUCCESS, FILE_STATUS_FAILURE,
+                           JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED)
+from app.database import get_db_session, db_transaction
+from app.models.file import File
+from app.models.ingestionjob import IngestionJob
+from app.services.ingestion_queue import IngestionQueue
+
+
+class FakeFileService:
+    def __init__(self, error: Optional[Exception] = None):
+        self.file_processors = {".pdf": None}
+        self.error = error
+        self.released: List[str] = []
+        self.deleted: List[str] = []
+
+    async def deleteUpload(self, file_id: str):
+        self.deleted.append(file_id)
+
+    def releaseUpload(self, file_id: str):
+        self.released.append(file_id)
+
+    async def parse_file(self, file: File, category: Optional[str] = None) -> List[str]:
+        if self.error is not None:
+            raise self.error
+        return ["section"] * 3
+
+
+class FakeSearchManager:
+    async def update_content(self, sections, on_progress=None):
+        if on_progress is not None:
+            await on_progress(len(sections), len(sections))
+
+    async def remove_files(self, files):
+        pass
+
+
+def make_queue(app, worker_id: str, file_service: Optional[FakeFileService] = None, **kwargs) -> IngestionQueue:
+    queue = IngestionQueue(app, file_service or FakeFileService(), FakeSearchManager(), workers=1, **kwargs)
+    queue.worker_id = worker_id
+    return queue
+
+
+async def claim(queue: IngestionQueue) -> Optional[IngestionJob]:
+    return await queue._IngestionQueue__claim()
+
+
+async def run_job(queue: IngestionQueue, job: IngestionJob):
+    await queue._IngestionQueue__run(job)
+
+
+async def add_file(file_id: str = "file-1") -> File:
+    file = File(id=file_id, name="a.pdf", chat_id="chat-1", chat_type="gpt", file_url="url", file_size_mb=1,
+                status=FILE_STATUS_UPLOADING, category="category", created_by="test", updated_by="test")
+    async with db_transaction() as session:
+        session.add(file)
+    return await get_file(file_id)
+
+
+async def get_job(job_id: int) -> IngestionJob:
+    async with get_db_session() as session:
+        return (await session.execute(select(IngestionJob).where(IngestionJob.id == job_id))).scalars().first()
+
+
+async def get_file(file_id: str) -> File:
+    async with get_db_session() as session:
+        return (await session.execute(select(File).where(File.id == file_id))).scalars().first()
+
+
+async def set_job(job_id: int, **values):
+    async with db_transaction() as session:
+        await session.execute(update(IngestionJob).where(IngestionJob.id == job_id).values(**values))
+
+
+def test_claim_is_won_by_one_worker(run, app):
+    async def scenario():
+        file = await add_file()
+        first, second = make_queue(app, "worker-1"), make_queue(app, "worker-2")
+        job_id = (await first.enqueue([file], "category", "test"))[0]["id"]
+
+        claimed = [job for job in await asyncio.gather(claim(first), claim(second)) if job is not None]
+
+        assert [job.id for job in claimed] == [job_id]
+        job = await get_job(job_id)
+        assert job.status == JOB_RUNNING
+        assert job.attempts == 1
+        assert job.locked_by == claimed[0].locked_by
+        # nothing left to claim
+        assert await claim(first) is None
+        assert await claim(second) is None
+
+    run(scenario)
+
+
+def test_claim_skips_jobs_not_due(run, app):
+    async def scenario():
+        file = await add_file()
+        queue = make_queue(app, "worker-1")
+        job_id = (await queue.enqueue([file], "category", "test"))[0]["id"]
+        await set_job(job_id, run_after=datetime.now() + timedelta(minutes=1))
+
+        assert await claim(queue) is None
+
+    run(scenario)
+
+
+def test_failed_job_is_retried_with_exponential_backoff(run, app):
+    async def scenario():
+        file = await add_file()
+        file_service = FakeFileService(error=RuntimeError("parse failed"))
+        queue = make_queue(app, "worker-1", file_service, max_attempts=3, retry_backoff=30)
+        job_id = (await queue.enqueue([file], "category", "test"))[0]["id"]
+
+        for attempt, delay in ((1, 30), (2, 60)):
+            job = await claim(queue)
+            assert job.attempts == attempt
+            started = datetime.now()
+            await run_job(queue, job)
+
+            job = await get_job(job_id)
+            assert job.status == JOB_QUEUED
+            assert job.last_error == "parse failed"
+            assert job.locked_by is None
+            assert timedelta(seconds=delay - 1) <= job.run_after - started <= timedelta(seconds=delay + 1)
+            # not due before the backoff
+            assert await claim(queue) is None
+            await set_job(job_id, run_after=datetime.now())
+
+        # the last attempt fails the job and the file for good
+        job = await claim(queue)
+        assert job.attempts == 3
+        await run_job(queue, job)
+
+        job = await get_job(job_id)
+        assert job.status == JOB_FAILED
+        assert (await get_file(file.id)).status == FILE_STATUS_FAILURE
+        assert file_service.released == [file.id]
+        assert await claim(queue) is None
+
+    run(scenario)
+
+
+def test_succeeded_job_updates_the_file(run, app):
+    async def scenario():
+        file = await add_file()
+        file_service = FakeFileService()
+        queue = make_queue(app, "worker-1", file_service)
+        job_id = (await queue.enqueue([file], "category", "test"))[0]["id"]
+
+        await run_job(queue, await claim(queue))
+
+        job = await get_job(job_id)
+        assert job.status == JOB_SUCCEEDED
+        assert job.progress == 100
+        file = await get_file(file.id)
+        assert file.status == FILE_STATUS_SUCCESS
+        assert file.chunk_count == 3
+        assert file_service.released == [file.id]
+
+    run(scenario)
+
+
+def test_job_of_a_dead_worker_is_requeued_after_the_timeout(run, app):
+    async def scenario():
+        file = await add_file()
+        dead, alive = make_queue(app, "worker-1", job_timeout=60), make_queue(app, "worker-2", job_timeout=60)
+        job_id = (await dead.enqueue([file], "category", "test"))[0]["id"]
+        assert (await claim(dead)).id == job_id
+
+        # still within the timeout
+        await set_job(job_id, locked_at=datetime.now() - timedelta(seconds=30))
+        assert await claim(alive) is None
+
+        await set_job(job_id, locked_at=datetime.now() - timedelta(seconds=61))
+        job = await claim(alive)
+        assert job.id == job_id
+        assert job.locked_by == "worker-2"
+        assert job.attempts == 2
+
+    run(scenario)
+
+
+def test_stop_requeues_the_jobs_of_this_worker(run, app):
+    async def scenario():
+        file = await add_file()
+        queue = make_queue(app, "worker-1")
+        job_id = (await queue.enqueue([file], "category", "test"))[0]["id"]
+        await claim(queue)
+
+        await queue.stop()
+
+        job = await get_job(job_id)
+        assert job.status == JOB_QUEUED
+        assert job.locked_by is None
+
+    run(scenario)
+
+
+def test_direct_uploads_never_completed_are_failed_after_the_grace(run, app):
+    async def scenario():
+        expired, in_grace, completed = await add_file("file-1"), await add_file("file-2"), await add_file("file-3")
+        async with db_transaction() as session:
+            await session.execute(
+                update(File).where(File.id.in_([expired.id, in_grace.id]))
+                .values(file_size_mb=None))
+            await session.execute(update(File).where(File.id == expired.id)
+                                  .values(upload_expires_at=datetime.now() - timedelta(seconds=61)))
+            await session.execute(update(File).where(File.id.in_([in_grace.id, completed.id]))
+                                  .values(upload_expires_at=datetime.now() - timedelta(seconds=30)))
+        file_service = FakeFileService()
+        queue = make_queue(app, "worker-1", file_service, upload_grace=60)
+
+        assert await claim(queue) is None
+
+        assert (await get_file(expired.id)).status == FILE_STATUS_FAILURE
+        assert (await get_file(in_grace.id)).status == FILE_STATUS_UPLOADING
+        assert (await get_file(completed.id)).status == FILE_STATUS_UPLOADING
+        assert file_service.deleted == [expired.id]
+        # failed once
+        await claim(queue)
+        assert file_service.deleted == [expired.id]
+
+    run(scenario)
@@ -0,0 +1,77 @@
+import asyncio
+from typing import AsyncIterator, List
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+from app.utils.multipart import MultipartReader
+
+BOUNDARY = b"----boundary"
+
+
+def form(*parts: bytes, close: bool = True) -> bytes:
+    body = b"".join(b"--" + BOUNDARY + b"\r\n" + part + b"\r\n" for part in parts)
+    return body + (b"--" + BOUNDARY + b"--\r\n" if close else b"")
+
+
+def field(name: str, value: bytes) -> bytes:
+    return f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode() + value
+
+
+def file(name: str, filename: str, content: bytes) -> bytes:
+    return (f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n').encode() + content
+
+
+async def chunked(body: bytes, size: int) -> AsyncIterator[bytes]:
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+def read_parts(body: bytes, size: int = 1024, **kwargs) -> List[tuple]:
+    async def read():
+        reader = MultipartReader(chunked(body, size), BOUNDARY, **kwargs)
+        return [(part.name, part.filename, part.content_type, await part.read()) async for part in reader.parts()]
+    return asyncio.run(read())
+
+
+# a chunk size of 1 or 7 puts the boundaries across chunks
+@pytest.mark.parametrize("size", [1, 7, 1024])
+def test_parts_are_read_whatever_the_chunking(size):
+    content = b"%PDF-1.7\r\n" + b"\r\n--" * 100 + bytes(range(256)) * 20
+    body = form(field("chat_id", "チャット".encode()), file("files", "a.pdf", content), file("files", "b.pdf", b""))
+
+    assert read_parts(body, size) == [
+        ("chat_id", None, None, "チャット".encode()),
+        ("files", "a.pdf", "application/pdf", content),
+        ("files", "b.pdf", "application/pdf", b""),
+    ]
+
+
+def test_unread_parts_are_skipped():
+    async def read():
+        reader = MultipartReader(chunked(body, 5), BOUNDARY)
+        return [part.name async for part in reader.parts()]
+
+    body = form(file("files", "a.pdf", b"x" * 1000), field("category", b"manuals"))
+    assert asyncio.run(read()) == ["files", "category"]
+
+
+def test_empty_file_input_has_an_empty_filename():
+    assert read_parts(form(file("files", "", b""))) == [("files", "", "application/pdf", b"")]
+
+
+def test_truncated_body_is_rejected():
+    body = form(file("files", "a.pdf", b"x" * 1000))
+    with pytest.raises(ValueError):
+        read_parts(body[:500], 64)
+
+
+def test_body_without_closing_boundary_is_rejected():
+    with pytest.raises(ValueError):
+        read_parts(form(field("category", b"manuals"), close=False))
+
+
+def test_body_over_max_size_is_rejected():
+    body = form(file("files", "a.pdf", b"x" * 10000))
+    assert read_parts(body, 64, max_size=len(body))[0][3] == b"x" * 10000
+    with pytest.raises(RequestEntityTooLarge):
+        read_parts(body, 64, max_size=len(body) - 1)
@@ -0,0 +1,91 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import httpx
+import pytest
+from openai import RateLimitError
+from app.services.retry_policy import RetryDeadlineExceeded, RetryPolicy, parse_duration, retry_after
+
+
+def rate_limit_error(headers: dict[str, str]) -> RateLimitError:
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://example.openai.azure.com"))
+    return RateLimitError("Rate limit reached", response=response, body=None)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("20", 20),
+    ("1.5", 1.5),
+    ("20ms", 0.02),
+    ("1s", 1),
+    ("6m0s", 360),
+    ("1h2m3s", 3723),
+])
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == pytest.approx(expected)
+
+
+def test_parse_duration_rejects_other_values():
+    assert parse_duration("soon") is None
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    # retry-after-ms wins over retry-after
+    ({"retry-after-ms": "200", "retry-after": "10"}, 0.2),
+    ({"retry-after": "7"}, 7),
+    ({"Retry-After": "6m0s"}, 360),
+    # the longest of the two resets
+    ({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "6m0s"}, 360),
+    # invalid values fall through to the next header
+    ({"retry-after-ms": "invalid", "x-ratelimit-reset-tokens": "20ms"}, 0.02),
+    ({"retry-after": "later", "x-ratelimit-reset-requests": "2s"}, 2),
+])
+def test_retry_after(headers, expected):
+    assert retry_after(rate_limit_error(headers)) == pytest.approx(expected)
+
+
+def test_retry_after_without_headers():
+    assert retry_after(rate_limit_error({})) is None
+    assert retry_after(ValueError("no response")) is None
+
+
+def test_retry_after_http_date():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 28 <= retry_after(rate_limit_error({"retry-after": format_datetime(retry_at, usegmt=True)})) <= 30
+    # a date in the past means now
+    retry_at = datetime.now(timezone.utc) - timedelta(seconds=30)
+    assert retry_after(rate_limit_error({"retry-after": format_datetime(retry_at, usegmt=True)})) == 0
+
+
+def test_call_waits_the_requested_delay():
+    errors = [rate_limit_error({"retry-after-ms": "10"})]
+    delays = []
+
+    async def fn():
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    result = asyncio.run(RetryPolicy("test").call(fn, on_retry=lambda error, delay: delays.append(delay)))
+    assert result == "ok"
+    assert delays == [0.01]
+
+
+def test_call_gives_up_when_the_delay_passes_the_deadline():
+    async def fn():
+        raise rate_limit_error({"retry-after": "120"})
+
+    with pytest.raises(RetryDeadlineExceeded):
+        asyncio.run(RetryPolicy("test", deadline=60).call(fn))
+
+
+def test_call_does_not_retry_other_errors():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        raise ValueError("not retryable")
+
+    with pytest.raises(ValueError):
+        asyncio.run(RetryPolicy("test").call(fn))
+    assert len(calls) == 1
@@ -0,0 +1,20 @@
+import asyncio
+from io import BytesIO
+from app.services.upload_handoff import Spool
+
+
+def test_spool_moves_to_disk_beyond_max_memory(tmp_path):
+    async def scenario():
+        spool = Spool(max_memory=10, directory=str(tmp_path))
+        await spool.write(b"0123456789")
+        assert isinstance(spool.content, BytesIO)
+        await spool.write(b"abc")
+        assert not isinstance(spool.content, BytesIO)
+        await spool.write(b"def")
+        content = spool.finish()
+        try:
+            return content.read()
+        finally:
+            spool.close()
+
+    assert asyncio.run(scenario()) == b"0123456789abcdef"